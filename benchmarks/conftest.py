@@ -0,0 +1,65 @@
+"""
+    Fixtures for the fastq2bcl benchmarks.
+
+    Synthetic inputs are generated once per mode and size in
+    $FASTQ2BCL_BENCH_DIR (default: pytest base temp dir).
+    Sizes are set with $FASTQ2BCL_BENCH_READS, e.g. "100000,1000000,10000000".
+
+    Run with:
+    pytest benchmarks --no-cov --benchmark-json benchmark.json
+
+    Or as a smoke test, running each benchmark once without timing:
+    FASTQ2BCL_BENCH_READS=1000 pytest benchmarks --no-cov --benchmark-disable
+"""
+import os
+from pathlib import Path
+
+import pytest
+
+from fastq2bcl.synthetic import MODES, write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def bench_reads():
+    return [
+        int(n) for n in os.environ.get("FASTQ2BCL_BENCH_READS", "100000").split(",")
+    ]
+
+
+def pytest_generate_tests(metafunc):
+    if "synthetic_run" in metafunc.fixturenames:
+        params = [(mode, reads) for reads in bench_reads() for mode in MODES]
+        metafunc.parametrize(
+            "synthetic_run",
+            params,
+            ids=[f"{mode}-{reads}" for mode, reads in params],
+            indirect=True,
+        )
+
+
+@pytest.fixture(scope="session")
+def bench_dir(tmp_path_factory):
+    if "FASTQ2BCL_BENCH_DIR" in os.environ:
+        return Path(os.environ["FASTQ2BCL_BENCH_DIR"])
+    return tmp_path_factory.mktemp("bench")
+
+
+@pytest.fixture(scope="session")
+def synthetic_run(request, bench_dir):
+    """
+    Tuple (mode, reads, files) with files a dict of r1, r2, i1, i2 paths
+    """
+    mode, reads = request.param
+    rundir = bench_dir / f"{mode}-{reads}"
+    files = {
+        "r1": rundir / "R1.fastq.gz",
+        "r2": rundir / "R2.fastq.gz" if mode in ["pair", "dual_index"] else None,
+        "i1": rundir / "I1.fastq.gz" if mode == "dual_index" else None,
+        "i2": rundir / "I2.fastq.gz" if mode == "dual_index" else None,
+    }
+    if not all(path.is_file() for path in files.values() if path is not None):
+        files = write_synthetic_run(rundir, reads, mode)
+    return mode, reads, files
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.intermediate import assemble_clusters
+from fastq2bcl.layout import create_layout, plan_blocks, write_cycle_block
+from fastq2bcl.parser import parse_seqdesc_fields
+from fastq2bcl.reader import VALIDATE_LEVELS, iter_fastq_records, read_fastq_segments
+from fastq2bcl.synthetic import write_interleaved_fastq
+from fastq2bcl.writer import encode_bcl_bytes
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def record_rate(benchmark, name, count):
+    """store count / mean time in the benchmark json (not with --benchmark-disable)"""
+    if benchmark.stats is None:
+        return
+    benchmark.extra_info[name] = count / benchmark.stats.stats.mean
+
+
+def test_reader(benchmark, synthetic_run):
+    """records/s of the synchronized fastq reader"""
+    mode, reads, files = synthetic_run
+    count = benchmark.pedantic(
+        lambda: sum(1 for _ in iter_fastq_records(**files)), rounds=3
+    )
+    assert count == reads
+    record_rate(benchmark, "records_per_second", reads)
+
+
+@pytest.mark.parametrize("validate", VALIDATE_LEVELS)
+def test_reader_validate(benchmark, synthetic_run, validate):
+    """records/s of the reader with each level of record id checks"""
+    mode, reads, files = synthetic_run
+    if mode != "dual_index":
+        pytest.skip("four files only")
+    count = benchmark.pedantic(
+        lambda: sum(1 for _ in iter_fastq_records(**files, validate=validate)),
+        rounds=3,
+    )
+    assert count == reads
+    record_rate(benchmark, "records_per_second", reads)
+
+
+def test_reader_interleaved(benchmark, synthetic_run, tmp_path):
+    """records/s of the interleaved reader, to compare with the R1 and R2 files"""
+    mode, reads, files = synthetic_run
+    if mode != "pair":
+        pytest.skip("interleaved pairs only")
+    interleaved = write_interleaved_fastq(
+        tmp_path / "interleaved.fastq.gz", files["r1"], files["r2"]
+    )
+    count = benchmark.pedantic(
+        lambda: sum(
+            1
+            for _ in iter_fastq_records(interleaved, None, None, None, interleaved=True)
+        ),
+        rounds=3,
+    )
+    assert count == reads
+    record_rate(benchmark, "records_per_second", reads)
+
+
+def test_header_parse(benchmark, synthetic_run):
+    """headers/s of the sequence description parser"""
+    mode, reads, files = synthetic_run
+    titles = [records[0][0] for records in iter_fastq_records(**files)]
+    benchmark.pedantic(lambda: [parse_seqdesc_fields(t) for t in titles], rounds=3)
+    record_rate(benchmark, "headers_per_second", reads)
+
+
+def test_encode(benchmark, synthetic_run):
+    """bases/s of bcl byte encoding"""
+    mode, reads, files = synthetic_run
+    bases = np.frombuffer(
+        b"".join(r[0][1].encode() for r in iter_fastq_records(**files)), np.uint8
+    )
+    quals = np.full(len(bases), 37, dtype=np.uint8)
+    benchmark.pedantic(encode_bcl_bytes, args=(bases, quals), rounds=3)
+    record_rate(benchmark, "bases_per_second", len(bases))
+
+
+def test_assemble(benchmark, synthetic_run):
+    """clusters/s of the cycle-major matrix assembly"""
+    mode, reads, files = synthetic_run
+    columns = read_fastq_segments(**files)
+    clusters, _ = benchmark.pedantic(
+        assemble_clusters, args=(columns, False, False), rounds=3
+    )
+    assert clusters.shape[1] == reads
+    record_rate(benchmark, "clusters_per_second", reads)
+
+
+def test_bcl_write(benchmark, synthetic_run, tmp_path):
+    """MB/s of bcl files writes: preallocated layout filled by blocks, as write_run"""
+    mode, reads, files = synthetic_run
+    clusters, _ = assemble_clusters(read_fastq_segments(**files), False, False)
+    cycles = range(clusters.shape[0])
+
+    def write_cycles():
+        paths = create_layout(tmp_path, cycles, reads)
+        for cycle, start, stop in plan_blocks(cycles, reads, 1):
+            write_cycle_block(paths[cycle], start, clusters[cycle, start:stop])
+
+    benchmark.pedantic(write_cycles, rounds=3)
+    record_rate(benchmark, "megabytes_per_second", clusters.nbytes / 1e6)
+
+
+def test_end_to_end(benchmark, synthetic_run, tmp_path):
+    """clusters/s of a full conversion"""
+    mode, reads, files = synthetic_run
+    benchmark.pedantic(fastq2bcl, args=(tmp_path,), kwargs=files, rounds=1)
+    record_rate(benchmark, "clusters_per_second", reads)
@@ -0,0 +1,71 @@
+"""
+    Startup benchmarks: wall time of ``fastq2bcl --version`` and ``--plan``
+    in a new interpreter, with a guard on the modules imported
+    (``python -X importtime``).
+"""
+import re
+import subprocess
+import sys
+
+import pytest
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+# modules that must not be imported to print the version or a plan
+HEAVY_MODULES = {
+    "--version": ["numpy", "Bio", "rich", "concurrent.futures"],
+    "--plan": ["numpy", "Bio", "rich", "concurrent.futures"],
+}
+# same entry point as the fastq2bcl console script
+ENTRY_POINT = "from fastq2bcl.cli import run; run()"
+# ceiling of the cumulative import time of fastq2bcl.cli in microseconds
+CLI_IMPORT_CEILING = 150_000
+
+
+def cli_command(option, tmp_path):
+    if option == "--version":
+        return ["--version"]
+    return [
+        "-o",
+        str(tmp_path),
+        "-r1",
+        "data/test/01_single/test_single.fastq.gz",
+        "--plan",
+    ]
+
+
+def import_times(args):
+    """
+    Run the cli with -X importtime, return a dict of module: cumulative us
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", ENTRY_POINT, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        m = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if m:
+            times[m.group(2)] = int(m.group(1))
+    return times
+
+
+@pytest.mark.parametrize("option", ["--version", "--plan"])
+def test_startup(benchmark, tmp_path, option):
+    """wall time of the cli in a new interpreter"""
+    args = cli_command(option, tmp_path)
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, "-c", ENTRY_POINT, *args],),
+        kwargs={"check": True, "capture_output": True},
+        rounds=5,
+    )
+    times = import_times(args)
+    benchmark.extra_info["cli_import_us"] = times["fastq2bcl.cli"]
+    for module in HEAVY_MODULES[option]:
+        assert module not in times, f"{option} imports {module}"
+    assert times["fastq2bcl.cli"] < CLI_IMPORT_CEILING
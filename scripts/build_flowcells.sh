@@ -12,6 +12,9 @@ EXAMPLE_SAMPLESHEET_GITURL='https://raw.githubusercontent.com/nf-core/test-datas
 EXAMPLE_FLOWCELL='220422_M11111_0222_000000000-K9H97'
 EXAMPLE_SAMPLE_PATH='Data/Intensities/BaseCalls/Sample1_S1_L001_R1_001.fastq.gz'
 BCL2FASTQ=`realpath scripts/bcl2fastq_docker.sh`
+# build cache shared between runs (set FASTQ2BCL_CACHE_DIR="" to disable)
+CACHE_DIR=${FASTQ2BCL_CACHE_DIR-.fastq2bcl_cache}
+CACHE_MAX_SIZE=${FASTQ2BCL_CACHE_MAX_SIZE:-2G}
 
 VERSION=0.1.0
 USAGE="Usage: build_flowcells.sh -ihv <example|test|clean>"
@@ -99,7 +102,10 @@ case "$command" in
                     echo "Error: command_args is unset."
                     exit 1
                 else
-                    # build flowcell
+                    # build flowcell (restored by hard-link from the build cache when possible)
+                    if [[ -n ${CACHE_DIR} ]]; then
+                        command_args="--cache-dir $CACHE_DIR --cache-max-size $CACHE_MAX_SIZE --cache-mode link $command_args"
+                    fi
                     echo "Running command: fastq2bcl -o $BUILD_DIR/$dirname $command_args > $BUILD_DIR/$dirname/fastq2blc.log 2>&1"
                     fastq2bcl -o $BUILD_DIR/$dirname $command_args > $BUILD_DIR/$dirname/fastq2blc.log 2>&1
 
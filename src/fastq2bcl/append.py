@@ -0,0 +1,132 @@
+import logging
+import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.checksums import find_checksums
+from fastq2bcl.bcl import HEADER_SIZE, find_cycle_bcls, read_run_info
+from fastq2bcl.layout import BCL_HEADER_SIZE, write_block
+from fastq2bcl.manifest import load_manifest, mark_complete, save_manifest
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.verify import check_run, read_header_count
+from fastq2bcl.writer import CONTROL_FILE, FILTER_FILE, LOCS_FILE, encode_locs
+
+_logger = logging.getLogger(__name__)
+
+
+def check_compatible(rundir, mask):
+    """
+    Raise ValueError if the reads of RunInfo.xml of rundir differ from mask
+    (list of reads, see run.set_mask) or the run directory is not valid
+    """
+    reads = read_run_info(rundir)
+    expected = [
+        {"cycles": int(read["cycles"]), "index": read["index"], "id": str(read["id"])}
+        for read in mask
+    ]
+    if reads != expected:
+        found = "".join(f"{r['cycles']}{r['index']}" for r in reads)
+        wanted = "".join(f"{r['cycles']}{r['index']}" for r in expected)
+        raise ValueError(f"Can not append {wanted} reads to {rundir} with {found}")
+    problems = check_run(rundir)
+    if problems:
+        raise ValueError(f"Can not append to {rundir}: {'; '.join(problems)}")
+
+
+def unshare(path):
+    """
+    Replace a hard-linked file (e.g. restored from a build cache with
+    --cache-mode link) by a copy, so that writing it leaves the other links intact
+    """
+    path = Path(path)
+    if path.stat().st_nlink < 2:
+        return False
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+    _logger.info(f"Copied hard-linked {path} before appending")
+    return True
+
+
+def append_records(path, header_size, record_size, records):
+    """
+    Append records (bytes-like, record_size bytes for each new cluster) to a
+    file written as a header ending with the uint32 cluster count, then patch
+    the count in place. Return the new cluster count.
+
+    Records are written before the header: an interrupted append leaves a file
+    longer than its header count, reported by check_run.
+    """
+    records = memoryview(records).cast("B")
+    size, count = read_header_count(path, header_size)
+    unshare(path)
+    write_block(path, size, records)
+    count += len(records) // record_size
+    write_block(path, header_size - 4, struct.pack("<I", count))
+    return count
+
+
+def append_run(
+    rundir, mask, clusters, positions, filter_flags=None, threads=1, timer=None
+):
+    """
+    Append clusters to an existing run directory written by fastq2bcl: new
+    records are written at the end of every bcl, filter, control and locs file
+    and the cluster count headers are patched in place, the cost is the size of
+    the new clusters. Stats files do not depend on the clusters.
+
+    mask: reads of the appended clusters (list, see run.set_mask), must match
+        RunInfo.xml of rundir
+    clusters: uint8 matrix of bcl bytes with one row per cycle
+    positions: int matrix with x and y of each new cluster
+    filter_flags: pass filter flag of each new cluster, None for all passing
+    threads: number of threads appending to the cycle files
+    Return the cluster count of the run
+    """
+    if timer is None:
+        timer = StageTimer()
+    rundir = Path(rundir)
+    cycles, added = clusters.shape
+    with timer.stage("append_check"):
+        check_compatible(rundir, mask)
+        bcls = find_cycle_bcls(rundir)
+        if len(bcls) != cycles:
+            raise ValueError(f"{rundir} has {len(bcls)} cycles, appending {cycles}")
+        if any(path.suffix == ".gz" for path in bcls):
+            raise ValueError(f"Can not append to compressed bcl files in {rundir}")
+    if filter_flags is None:
+        filter_flags = np.ones(added, dtype=np.uint8)
+
+    records = [
+        (rundir / FILTER_FILE, HEADER_SIZE, 1, np.asarray(filter_flags, np.uint8)),
+        (rundir / CONTROL_FILE, HEADER_SIZE, 2, bytes(2 * added)),
+        (rundir / LOCS_FILE, HEADER_SIZE, 8, encode_locs(positions)),
+    ]
+    records += [
+        (path, BCL_HEADER_SIZE, 1, np.ascontiguousarray(clusters[cycle]))
+        for cycle, path in enumerate(bcls)
+    ]
+    nbytes = sum(memoryview(data).nbytes for *_, data in records)
+    with timer.stage("append", nbytes):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            counts = list(pool.map(lambda record: append_records(*record), records))
+    cluster_count = counts[0]
+
+    # the manifest records the new sizes, checksums of the run are stale
+    _, checksums_path = find_checksums(rundir)
+    if checksums_path is not None:
+        _logger.warning(f"Removing {checksums_path}, out of date after the append")
+        checksums_path.unlink()
+    manifest = load_manifest(rundir)
+    if manifest is not None:
+        manifest["cluster_count"] = cluster_count
+        for path, *_ in records:
+            mark_complete(rundir, manifest, path)
+        manifest.setdefault("appended", []).append(added)
+        save_manifest(rundir, manifest)
+    _logger.info(f"Appended {added} clusters to {rundir}: {cluster_count} clusters")
+    return cluster_count
@@ -0,0 +1,185 @@
+import gzip
+import io
+import logging
+import sys
+import tarfile
+import time
+from pathlib import PurePosixPath
+
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.staging import publish, staging_path
+from fastq2bcl.writer import generate_run_info_xml, tile_members
+
+_logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ["none", "gzip", "zstd"]
+# compression of an archive from the suffix of its name
+SUFFIXES = {".gz": "gzip", ".tgz": "gzip", ".zst": "zstd", ".tzst": "zstd"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def tar_compression(path):
+    """
+    Compression of a tar archive from its name: gzip (.tar.gz, .tgz),
+    zstd (.tar.zst, .tzst) or none (.tar and stdout)
+    """
+    return SUFFIXES.get(PurePosixPath(str(path)).suffix, "none")
+
+
+class ChunksReader(io.RawIOBase):
+    """
+    Read a list of buffers as a single file, without joining them
+    """
+
+    def __init__(self, chunks):
+        self.chunks = [memoryview(chunk).cast("B") for chunk in chunks]
+        self.index = 0
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.index < len(self.chunks):
+            chunk = self.chunks[self.index]
+            if self.offset < len(chunk):
+                size = min(len(buffer), len(chunk) - self.offset)
+                buffer[:size] = chunk[self.offset : self.offset + size]
+                self.offset += size
+                return size
+            self.index += 1
+            self.offset = 0
+        return 0
+
+
+def open_compressed(fileobj, compression):
+    """
+    Binary writer compressing to fileobj. Closing it does not close fileobj.
+    """
+    if compression == "none":
+        return None
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            # python >= 3.14
+            from compression import zstd
+
+            return zstd.ZstdFile(fileobj, "wb", level=ZSTD_LEVEL)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "zstd output needs the zstandard package: pip install fastq2bcl[zstd]"
+            )
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+            fileobj, closefd=False
+        )
+    raise ValueError(f"Unknown compression {compression}, use one of {COMPRESSIONS}")
+
+
+def run_members(run_id, seqdesc_fields, mask, clusters, positions, filter_flags=None):
+    """
+    Files of a run in the order of a run directory written by fastq2bcl:
+    RunInfo.xml, then the files of its tile (see writer.tile_members).
+
+    Yield tuples (path relative to the run directory, list of buffers)
+    """
+    run_info = generate_run_info_xml(
+        run_id,
+        seqdesc_fields["run_number"],
+        seqdesc_fields["flowcell_id"],
+        seqdesc_fields["instrument"],
+        mask,
+    )
+    yield "RunInfo.xml", [run_info.encode()]
+    yield from tile_members(clusters, positions, filter_flags)
+
+
+def write_run_tar(
+    path,
+    run_id,
+    seqdesc_fields,
+    mask,
+    clusters,
+    positions,
+    filter_flags=None,
+    compression=None,
+    timer=None,
+    durability="batch",
+):
+    """
+    Stream a run directory into a tar archive, without writing its files on disk.
+    Members are emitted in order from the clusters matrix in memory, under the
+    run_id directory.
+
+    path: archive path, "-" for stdout or a binary file object
+    mask: list of reads (see run.set_mask)
+    compression: none, gzip or zstd, default from the archive name (see tar_compression)
+    durability: sync of an archive path before it is renamed from its staging
+        path (see staging.publish)
+    Return the number of bytes of the files in the archive
+    """
+    if timer is None:
+        timer = StageTimer()
+    if compression is None:
+        compression = "none" if hasattr(path, "write") else tar_compression(path)
+    if compression not in COMPRESSIONS:
+        raise ValueError(
+            f"Unknown compression {compression}, use one of {COMPRESSIONS}"
+        )
+
+    # file objects (and stdout) are flushed, not closed
+    to_file = not hasattr(path, "write") and str(path) != "-"
+    if hasattr(path, "write"):
+        out = path
+    elif not to_file:
+        out = sys.stdout.buffer
+    else:
+        out = open(staging_path(path), "wb")
+    compressed = open_compressed(out, compression)
+    mtime = int(time.time())
+    directories = set()
+    total = 0
+    complete = False
+    try:
+        with tarfile.open(fileobj=compressed or out, mode="w|") as tar:
+            for relpath, chunks in run_members(
+                run_id, seqdesc_fields, mask, clusters, positions, filter_flags
+            ):
+                name = PurePosixPath(run_id, relpath)
+                # parent directories before their first file
+                for parent in reversed(list(name.parents)[:-1]):
+                    if parent not in directories:
+                        info = tarfile.TarInfo(str(parent))
+                        info.type = tarfile.DIRTYPE
+                        info.mode = 0o755
+                        info.mtime = mtime
+                        tar.addfile(info)
+                        directories.add(parent)
+                info = tarfile.TarInfo(str(name))
+                info.size = sum(memoryview(chunk).nbytes for chunk in chunks)
+                info.mode = 0o644
+                info.mtime = mtime
+                with timer.stage("write_tar", info.size):
+                    tar.addfile(info, io.BufferedReader(ChunksReader(chunks)))
+                total += info.size
+        complete = True
+    finally:
+        if compressed is not None:
+            compressed.close()
+        if not to_file:
+            out.flush()
+        else:
+            out.close()
+            if not complete:
+                # failed archives leave no staging file behind
+                staging_path(path).unlink(missing_ok=True)
+    if to_file:
+        # archives are written to a staging file, renamed when complete
+        publish(staging_path(path), path, durability)
+    _logger.info(f"Written {total} bytes of {run_id} to {path} ({compression})")
+    return total
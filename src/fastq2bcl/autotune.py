@@ -0,0 +1,189 @@
+import logging
+import math
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from fastq2bcl.layout import write_block
+
+_logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+# cgroup v1 reports a huge number when memory is not limited
+UNLIMITED_MEMORY = 1 << 60
+PROBE_SIZE = 16 * 1024 * 1024
+PROBE_BLOCK = 1024 * 1024
+# smallest worker count reaching this fraction of the best probe throughput
+PROBE_EFFICIENCY = 0.9
+# target duration of a block write: longer blocks amortize the task overhead
+BLOCK_SECONDS = 0.05
+BLOCK_MIN_BYTES = 64 * 1024
+# fraction of the memory limit for the blocks in flight
+BLOCK_MEMORY_FRACTION = 0.1
+
+
+def read_cgroup_value(path):
+    """
+    First line of a cgroup file split in fields, None if missing
+    """
+    try:
+        with open(path, "rt") as f_in:
+            return f_in.readline().split()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """
+    CPU quota of the cgroup (cgroup v2 cpu.max or v1 cfs quota) as a number of
+    cpus, None if not limited
+    """
+    root = Path(root)
+    fields = read_cgroup_value(root / "cpu.max")
+    if fields and fields[0] != "max":
+        return int(fields[0]) / int(fields[1])
+    quota = read_cgroup_value(root / "cpu" / "cpu.cfs_quota_us")
+    period = read_cgroup_value(root / "cpu" / "cpu.cfs_period_us")
+    if quota and period and int(quota[0]) > 0:
+        return int(quota[0]) / int(period[0])
+    return None
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """
+    Memory limit of the cgroup (cgroup v2 memory.max or v1 memory.limit_in_bytes)
+    in bytes, None if not limited
+    """
+    root = Path(root)
+    fields = read_cgroup_value(root / "memory.max")
+    if fields and fields[0] != "max":
+        return int(fields[0])
+    fields = read_cgroup_value(root / "memory" / "memory.limit_in_bytes")
+    if fields and int(fields[0]) < UNLIMITED_MEMORY:
+        return int(fields[0])
+    return None
+
+
+def available_cpus(root=CGROUP_ROOT):
+    """
+    Cpus usable by the process: affinity mask bounded by the cgroup quota
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:  # pragma: no cover
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit(root)
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+
+def probe_write_throughput(outdir, workers, size=PROBE_SIZE):
+    """
+    Write size bytes in outdir with a number of concurrent threads writing
+    blocks like the cycle writers (see layout.write_block), fsync and return
+    the throughput in bytes/s
+    """
+    block = bytes(PROBE_BLOCK)
+    blocks = max(1, size // PROBE_BLOCK)
+    fd, path = tempfile.mkstemp(prefix=".fastq2bcl_probe.", dir=outdir)
+    try:
+        os.ftruncate(fd, blocks * PROBE_BLOCK)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(
+                pool.map(
+                    lambda i: write_block(path, i * PROBE_BLOCK, block), range(blocks)
+                )
+            )
+        os.fsync(fd)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    return blocks * PROBE_BLOCK / max(elapsed, 1e-9)
+
+
+def autotune(outdir, cluster_count, cycles, executor="auto", root=CGROUP_ROOT):
+    """
+    Choose workers, executor and block size of the cycle writes.
+
+    Workers: the smallest count, up to the available cpus, whose write throughput
+    in outdir is at least PROBE_EFFICIENCY of the best probed count (more writers
+    than the filesystem can serve only add contention, e.g. on NFS).
+    Block size: BLOCK_SECONDS of writing at the probed throughput, bounded so the
+    blocks in flight fit in BLOCK_MEMORY_FRACTION of the cgroup memory limit.
+
+    Return a dict with threads, executor, block_clusters and the probe results
+    """
+    cpus = available_cpus(root)
+    memory_limit = cgroup_memory_limit(root)
+    candidates = sorted({min(cpus, 2**i) for i in range(cpus.bit_length() + 1)})
+    probes = {}
+    if cluster_count and cycles and len(candidates) > 1:
+        for workers in candidates:
+            probes[workers] = probe_write_throughput(outdir, workers)
+        best = max(probes.values())
+        threads = min(
+            w for w, rate in probes.items() if rate >= PROBE_EFFICIENCY * best
+        )
+        rate = probes[threads]
+    else:
+        threads = 1
+        rate = None
+
+    block_bytes = BLOCK_MIN_BYTES
+    if rate:
+        block_bytes = max(block_bytes, int(rate * BLOCK_SECONDS))
+    if memory_limit:
+        block_bytes = min(
+            block_bytes, int(memory_limit * BLOCK_MEMORY_FRACTION / threads)
+        )
+    decision = {
+        "threads": threads,
+        # threads write the shared matrix without copies
+        "executor": "threads" if executor == "auto" else executor,
+        # one byte for each cluster in a block of a cycle
+        "block_clusters": max(1, block_bytes),
+        "cpus": cpus,
+        "memory_limit": memory_limit,
+        "probes": probes,
+    }
+    _logger.info(f"Autotune: {decision}")
+    return decision
+
+
+class AdaptiveLimit:
+    """
+    Number of block writes allowed in flight, lowered when the write latency
+    climbs above the latency of the first blocks and raised again when it recovers.
+    """
+
+    def __init__(self, maximum, window=8, slowdown=2.0):
+        self.maximum = maximum
+        self.limit = maximum
+        self.window = window
+        self.slowdown = slowdown
+        self.baseline = None
+        self.latencies = []
+
+    def update(self, seconds_per_byte):
+        """
+        Record the latency of a completed block write and return the new limit
+        """
+        self.latencies.append(seconds_per_byte)
+        if len(self.latencies) < self.window:
+            return self.limit
+        latency = sorted(self.latencies)[len(self.latencies) // 2]
+        self.latencies = []
+        if self.baseline is None:
+            self.baseline = latency
+        elif latency > self.slowdown * self.baseline and self.limit > 1:
+            self.limit -= 1
+            _logger.info(f"Write latency climbing, {self.limit} writers")
+        elif latency <= self.baseline and self.limit < self.maximum:
+            self.limit += 1
+            _logger.info(f"Write latency recovered, {self.limit} writers")
+        return self.limit
@@ -0,0 +1,219 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.run import mock_run_id, write_run
+from fastq2bcl.intermediate import assemble_clusters
+from fastq2bcl.manifest import new_manifest
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.reader import HEADER_QUALITY, SEGMENTS, pad_rows
+from fastq2bcl.staging import prepare_staging, publish
+from fastq2bcl.writer import encode_bcl_bytes
+
+_logger = logging.getLogger(__name__)
+
+# lane and tile written by the bcl writers
+LANE = 1
+TILE = 1101
+
+
+def encode_segment(bases, quals=None, lengths=None):
+    """
+    Encode the reads of a segment of a batch.
+
+    bases: 2-D uint8 array of ascii bases (one row per cluster) or a sequence of
+    str/bytes (reads can have different lengths)
+    quals: 2-D uint8 array of phred qualities or a sequence of str/bytes of
+    fastq qualities (phred + 33). None for HEADER_QUALITY on all bases.
+    lengths: length of each read when bases and quals (phred) are flat uint8
+    arrays of the concatenated reads (e.g. the buffers of an Arrow column, see
+    tables)
+
+    Return a tuple (padded matrix of bcl bytes, lengths)
+    """
+    if lengths is not None:
+        lengths = np.asarray(lengths, dtype=np.int32)
+        bases = np.asarray(bases, dtype=np.uint8)
+        if quals is not None:
+            quals = np.asarray(quals, dtype=np.uint8)
+        if int(lengths.sum()) != len(bases):
+            raise ValueError("bases and lengths have different lengths")
+    elif isinstance(bases, np.ndarray):
+        if bases.ndim != 2:
+            raise ValueError("bases array must have one row per cluster")
+        lengths = np.full(len(bases), bases.shape[1], dtype=np.int32)
+        bases = bases.astype(np.uint8, copy=False).ravel()
+    else:
+        reads = [b.encode() if isinstance(b, str) else bytes(b) for b in bases]
+        lengths = np.fromiter(map(len, reads), dtype=np.int32, count=len(reads))
+        bases = np.frombuffer(b"".join(reads), dtype=np.uint8)
+
+    if quals is None:
+        phred = np.full(len(bases), HEADER_QUALITY, dtype=np.uint8)
+    elif isinstance(quals, np.ndarray):
+        phred = quals.astype(np.uint8, copy=False).ravel()
+    else:
+        quals = [q.encode() if isinstance(q, str) else bytes(q) for q in quals]
+        phred = np.frombuffer(b"".join(quals), dtype=np.uint8) - 33
+    if len(phred) != len(bases):
+        raise ValueError("bases and qualities have different lengths")
+
+    return pad_rows(encode_bcl_bytes(bases, phred), lengths), lengths
+
+
+def default_positions(first, count):
+    """
+    Positions of clusters without coordinates, from their number (as the
+    synthetic generator does)
+    """
+    numbers = np.arange(first, first + count)
+    return np.stack([numbers // 10_000 + 1_000, numbers % 10_000 + 1_000], axis=1)
+
+
+def read_batches(batches):
+    """
+    Encode an iterable of record batches in columns (see read_fastq_segments).
+
+    Each batch is a dict with:
+    R1, and optionally I1, I2, R2, index and UMI: a tuple (bases, quals) or
+    (bases, quals, lengths) (see encode_segment) or only bases
+    positions: optional (clusters, 2) int array with x and y of each cluster
+    filter: optional array of pass filter flags (1 pass, 0 filtered)
+    lane and tile: optional, only lane 1 and tile 1101 are written
+
+    All the batches must have the same segments.
+    """
+    parts = {}
+    positions = []
+    filters = []
+    names = None
+    cluster_count = 0
+    for batch in batches:
+        if batch.get("lane", LANE) != LANE or batch.get("tile", TILE) != TILE:
+            raise ValueError(f"Only lane {LANE} and tile {TILE} are supported")
+        batch_names = [name for name in SEGMENTS if name in batch]
+        if names is None:
+            names = batch_names
+        if batch_names != names or "R1" not in names:
+            raise ValueError(f"Batch with segments {batch_names}, expected {names}")
+
+        count = None
+        for name in names:
+            segment = batch[name]
+            if not isinstance(segment, tuple):
+                segment = (segment, None)
+            encoded, lengths = encode_segment(*segment)
+            if count is not None and len(lengths) != count:
+                raise ValueError(
+                    f"Segment {name} has {len(lengths)} reads, not {count}"
+                )
+            count = len(lengths)
+            parts.setdefault(name, []).append((encoded, lengths))
+
+        batch_positions = batch.get("positions")
+        if batch_positions is None:
+            batch_positions = default_positions(cluster_count, count)
+        positions.append(np.asarray(batch_positions, dtype=np.int32).reshape(-1, 2))
+        batch_filter = batch.get("filter")
+        if batch_filter is None:
+            batch_filter = np.ones(count, dtype=np.uint8)
+        filters.append(np.asarray(batch_filter, dtype=np.uint8))
+        cluster_count += count
+
+    columns = {
+        "positions": np.concatenate(positions or [np.zeros((0, 2), np.int32)]),
+        "filter": np.concatenate(filters or [np.zeros(0, np.uint8)]),
+    }
+    for name, segment_parts in parts.items():
+        width = max(encoded.shape[1] for encoded, _ in segment_parts)
+        columns[name] = np.concatenate(
+            [
+                np.pad(encoded, ((0, 0), (0, width - encoded.shape[1])))
+                for encoded, _ in segment_parts
+            ]
+        )
+        columns[f"{name}_lengths"] = np.concatenate(
+            [lengths for _, lengths in segment_parts]
+        )
+    _logger.info(f"Read {cluster_count} clusters from batches")
+    return columns
+
+
+def mask_from_columns(columns):
+    """
+    Mask string from the longest read of each segment: R1 and R2 are reads,
+    index and UMI (together), I1 and I2 are indexed reads
+    """
+
+    def width(*names):
+        return sum(
+            int(columns[f"{name}_lengths"].max())
+            for name in names
+            if f"{name}_lengths" in columns
+        )
+
+    reads = [
+        (width("R1"), "N"),
+        (width("index", "UMI"), "Y"),
+        (width("I1"), "Y"),
+        (width("I2"), "Y"),
+        (width("R2"), "N"),
+    ]
+    return "".join(f"{cycles}{kind}" for cycles, kind in reads if cycles)
+
+
+def convert_batches(
+    outdir,
+    batches,
+    instrument="SIM",
+    run_number="1",
+    flowcell_id="FC0001",
+    mask_string=None,
+    threads=1,
+    executor="auto",
+    timer=None,
+    durability="batch",
+):
+    """
+    Write a run directory from in-memory record batches (see read_batches)
+    with the same writers of fastq2bcl, without fastq files.
+    durability: see staging.publish
+
+    Return a tuple (run_id, rundir, mask_string)
+    """
+    if timer is None:
+        timer = StageTimer()
+    fields = {
+        "instrument": instrument,
+        "run_number": str(run_number),
+        "flowcell_id": flowcell_id,
+    }
+    run_id = mock_run_id(fields)
+    rundir = Path(outdir).absolute() / run_id
+
+    with timer.stage("read_batches"):
+        columns = read_batches(batches)
+    if not mask_string:
+        mask_string = mask_from_columns(columns)
+    with timer.stage("assemble"):
+        clusters, positions = assemble_clusters(columns, False, False)
+
+    manifest = new_manifest({}, mask_string, False, False, {"source": "batches"})
+    staging = prepare_staging(rundir)
+    write_run(
+        staging,
+        run_id,
+        fields,
+        mask_string,
+        clusters,
+        positions,
+        manifest,
+        threads,
+        executor,
+        filter_flags=columns["filter"],
+        timer=timer,
+    )
+    with timer.stage("publish"):
+        publish(staging, rundir, durability)
+    return run_id, rundir, mask_string
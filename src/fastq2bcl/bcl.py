@@ -0,0 +1,238 @@
+import gzip
+import logging
+import re
+import struct
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.layout import BCL_HEADER_SIZE
+from fastq2bcl.writer import TILE, tile_files
+
+_logger = logging.getLogger(__name__)
+
+# filter, control and locs: 8 bytes of version fields, then the cluster count
+HEADER_SIZE = 12
+# ascii base of each bcl base code (bits 0-1)
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def map_records(path, header_size, dtype):
+    """
+    Memory map the records of a file written as a header ending with the uint32
+    cluster count, followed by one record of dtype for each cluster.
+
+    Return a read-only numpy array (a copy for empty files, that can not be mapped)
+    """
+    path = Path(path)
+    dtype = np.dtype(dtype)
+    with open(path, "rb") as f_in:
+        header = f_in.read(header_size)
+    if len(header) < header_size:
+        raise ValueError(f"Truncated header in {path}")
+    (count,) = struct.unpack_from("<I", header, header_size - 4)
+    size = path.stat().st_size
+    if size != header_size + count * dtype.itemsize:
+        raise ValueError(
+            f"{path} has {size} bytes, expected {count} records of {dtype.itemsize}"
+        )
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=header_size, shape=(count,))
+
+
+def read_bcl(path):
+    """
+    Bcl bytes of the clusters of a cycle as an uint8 array: memory mapped for
+    .bcl files, decompressed for .bcl.gz files
+    """
+    path = Path(path)
+    if path.suffix != ".gz":
+        return map_records(path, BCL_HEADER_SIZE, np.uint8)
+    with gzip.open(path, "rb") as f_in:
+        data = f_in.read()
+    (count,) = struct.unpack_from("<I", data)
+    if len(data) != BCL_HEADER_SIZE + count:
+        raise ValueError(f"{path} has {len(data)} bytes, expected {count} clusters")
+    return np.frombuffer(data, dtype=np.uint8, offset=BCL_HEADER_SIZE)
+
+
+def read_filter(path):
+    """
+    Pass filter flag of each cluster (1 pass, 0 filtered)
+    """
+    return map_records(path, HEADER_SIZE, np.uint8)
+
+
+def read_control(path):
+    """
+    Control flags (2 bytes) of each cluster
+    """
+    return map_records(path, HEADER_SIZE, "<u2")
+
+
+def read_locs(path):
+    """
+    x and y of each cluster as a (clusters, 2) float32 array
+    """
+    return map_records(path, HEADER_SIZE, np.dtype(("<f4", 2)))
+
+
+def decode_bcl_bytes(data):
+    """
+    Decode bcl bytes in ascii bases (N for a no-call) and phred qualities.
+    Inverse of writer.encode_bcl_bytes for ACGT bases and qualities up to 63.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    bases = BASES[data & 3]
+    bases[data == 0] = ord("N")
+    return bases, data >> 2
+
+
+def read_run_info(rundir):
+    """
+    Reads of RunInfo.xml as a list of dicts with cycles (int), index (Y or N)
+    and id (see run.set_mask)
+    """
+    root = ET.parse(Path(rundir) / "RunInfo.xml").getroot()
+    return [
+        {
+            "cycles": int(read.get("NumCycles")),
+            "index": read.get("IsIndexedRead"),
+            "id": read.get("Number"),
+        }
+        for read in root.iter("Read")
+    ]
+
+
+def run_tiles(rundir):
+    """
+    Tiles of lane 1 of a run directory from its filter files, [TILE] if none
+    """
+    tiles = []
+    for path in (Path(rundir) / "Data/Intensities/BaseCalls/L001").glob("s_1_*.filter"):
+        m = re.fullmatch(r"s_1_([0-9]+)\.filter", path.name)
+        if m:
+            tiles.append(int(m.group(1)))
+    return sorted(tiles) or [TILE]
+
+
+def find_cycle_bcls(rundir, lane="L001", tile=TILE):
+    """
+    Bcl file (.bcl or .bcl.gz) of a tile in each cycle directory of a lane,
+    in cycle order
+    """
+    basecalls = Path(rundir) / f"Data/Intensities/BaseCalls/{lane}"
+    cycles = {}
+    for cycledir in basecalls.glob("C*.1"):
+        m = re.fullmatch(r"C([0-9]+)\.1", cycledir.name)
+        if not m:
+            continue
+        for name in [f"s_1_{tile}.bcl", f"s_1_{tile}.bcl.gz"]:
+            if (cycledir / name).is_file():
+                cycles[int(m.group(1))] = cycledir / name
+    numbers = sorted(cycles)
+    if numbers != list(range(1, len(numbers) + 1)):
+        raise ValueError(
+            f"Missing cycles of tile {tile} in {basecalls}: found {numbers}"
+        )
+    return [cycles[number] for number in numbers]
+
+
+def read_tile(rundir, tile=TILE):
+    """
+    Map the files of a tile of lane 1.
+
+    Return a dict with tile, cluster_count, bcl (list of the bcl bytes of each
+    cycle), filter, control and locs arrays
+    """
+    rundir = Path(rundir)
+    files = tile_files(tile)
+    data = {
+        "tile": tile,
+        "bcl": [read_bcl(path) for path in find_cycle_bcls(rundir, tile=tile)],
+        "filter": read_filter(rundir / files["filter"]),
+        "control": read_control(rundir / files["control"]),
+        "locs": read_locs(rundir / files["locs"]),
+    }
+    data["cluster_count"] = len(data["filter"])
+    for name in ["control", "locs"]:
+        if len(data[name]) != data["cluster_count"]:
+            raise ValueError(
+                f"{name} of tile {tile} has {len(data[name])} clusters, "
+                f"filter {data['cluster_count']}"
+            )
+    for cycle, bcl in enumerate(data["bcl"]):
+        if len(bcl) != data["cluster_count"]:
+            raise ValueError(
+                f"Cycle {cycle + 1} of tile {tile} has {len(bcl)} clusters, "
+                f"filter {data['cluster_count']}"
+            )
+    return data
+
+
+def read_run(rundir):
+    """
+    Map the files of a run directory (lane 1, all its tiles, see run_tiles).
+
+    Return a dict with reads (see read_run_info), tiles (list of tile numbers),
+    cluster_count, bcl (list of the bcl bytes of each cycle), filter, control
+    and locs arrays. Clusters of the tiles follow in tile order (the order of
+    the shards of a merged run): runs of several tiles are concatenated copies,
+    runs of a single tile are memory mapped
+    """
+    rundir = Path(rundir)
+    tiles = [read_tile(rundir, tile) for tile in run_tiles(rundir)]
+    cycles = {len(tile["bcl"]) for tile in tiles}
+    if len(cycles) > 1:
+        raise ValueError(f"Tiles of {rundir} have different cycles: {sorted(cycles)}")
+    run = {"reads": read_run_info(rundir), "tiles": [tile["tile"] for tile in tiles]}
+    if len(tiles) == 1:
+        run.update(
+            {name: tiles[0][name] for name in ["bcl", "filter", "control", "locs"]}
+        )
+    else:
+        run["bcl"] = [
+            np.concatenate([tile["bcl"][cycle] for tile in tiles])
+            for cycle in range(cycles.pop())
+        ]
+        for name in ["filter", "control", "locs"]:
+            run[name] = np.concatenate([tile[name] for tile in tiles])
+    run["cluster_count"] = len(run["filter"])
+    _logger.info(
+        f"Mapped run {rundir}: {len(run['bcl'])} cycles, "
+        f"{run['cluster_count']} clusters in {len(tiles)} tiles"
+    )
+    return run
+
+
+def cycle_block(run, start, stop):
+    """
+    Bcl bytes of clusters start:stop of all the cycles of a run as a
+    (cycles, clusters) uint8 matrix
+    """
+    block = np.zeros((len(run["bcl"]), stop - start), dtype=np.uint8)
+    for cycle, data in enumerate(run["bcl"]):
+        block[cycle] = data[start:stop]
+    return block
+
+
+def decode_cluster(run, cluster):
+    """
+    Fastq-equivalent reads of a cluster: a list with a tuple (sequence,
+    quality string) for each read of RunInfo.xml. Cycles beyond the reads of
+    RunInfo.xml are returned as a last read.
+    """
+    bases, quals = decode_bcl_bytes(cycle_block(run, cluster, cluster + 1)[:, 0])
+    bounds = np.cumsum([0] + [read["cycles"] for read in run["reads"]])
+    bounds = np.minimum(bounds, len(bases)).tolist()
+    if bounds[-1] < len(bases):
+        bounds.append(len(bases))
+    return [
+        (
+            bases[start:stop].tobytes().decode(),
+            (quals[start:stop] + 33).tobytes().decode(),
+        )
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
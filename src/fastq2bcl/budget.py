@@ -0,0 +1,207 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from fastq2bcl.layout import write_at
+from fastq2bcl.profiling import current_rss
+
+_logger = logging.getLogger(__name__)
+
+# fraction of the available budget for the records of a read chunk
+READ_MEMORY_FRACTION = 0.25
+# bounds of a read chunk in clusters
+READ_CHUNK_MAX = 1 << 20
+READ_CHUNK_MIN = 4096
+# fraction of the available budget for the blocks in flight of a process pool
+BLOCK_MEMORY_FRACTION = 0.5
+
+
+def read_at(fd, offset, size):
+    """
+    Read size bytes at offset of a file descriptor (pread, seek and read where
+    it does not exist), EOFError if the file is shorter
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    if not hasattr(os, "pread"):
+        os.lseek(fd, offset, os.SEEK_SET)
+    while view:
+        if hasattr(os, "pread"):
+            chunk = os.pread(fd, len(view), offset)
+        else:
+            chunk = os.read(fd, len(view))
+        if not chunk:
+            raise EOFError(f"{size - len(view)} bytes at {offset}, expected {size}")
+        view[: len(chunk)] = chunk
+        view = view[len(chunk) :]
+        offset += len(chunk)
+    return data
+
+
+class MemoryBudget:
+    """
+    Memory a conversion may allocate for its data, on top of the memory of the
+    process when the budget is created (interpreter and modules).
+
+    Large arrays are allocated through the budget: they are held in memory
+    while they fit, otherwise they are memory-mapped on scratch files (zeros)
+    or written to a spill file read back when needed (keep and restore), in
+    scratch_dir (default the temporary directory). Decisions are logged and
+    kept in decisions. Used as a context manager, the budget is closed on exit.
+    """
+
+    def __init__(self, max_memory, scratch_dir=None):
+        baseline = current_rss() or 0
+        if max_memory <= baseline:
+            raise ValueError(
+                f"--max-memory {max_memory} is below the memory of the process "
+                f"({baseline} bytes)"
+            )
+        self.max_memory = max_memory
+        self.limit = max_memory - baseline
+        self.scratch_dir = scratch_dir
+        self.held = {}
+        self.spilled = {}
+        self.decisions = []
+        self.scratch_files = []
+        self.spill_file = None
+        self.spill_size = 0
+        self.decide(
+            f"{self.limit} bytes for data of {max_memory} (baseline {baseline})"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def used(self):
+        return sum(self.held.values())
+
+    @property
+    def available(self):
+        return max(0, self.limit - self.used)
+
+    def decide(self, decision):
+        self.decisions.append(decision)
+        _logger.info(f"Memory budget: {decision}")
+
+    def reserve(self, name, nbytes):
+        """
+        Reserve nbytes for name, False when they do not fit
+        """
+        if nbytes > self.available:
+            return False
+        self.held[name] = self.held.get(name, 0) + nbytes
+        return True
+
+    def release(self, name):
+        self.held.pop(name, None)
+        self.spilled.pop(name, None)
+
+    def chunk_size(self, name, item_bytes, fraction, minimum=1, maximum=None):
+        """
+        Number of items of item_bytes fitting in a fraction of the available
+        budget, between minimum and maximum. Reserved under name: release it
+        when the chunks are done. ValueError if minimum items do not fit
+        """
+        items = int(self.available * fraction) // max(1, item_bytes)
+        if maximum is not None:
+            items = min(items, maximum)
+        if items < minimum or not self.reserve(name, items * item_bytes):
+            raise ValueError(
+                f"--max-memory {self.max_memory} is too small for {name}: "
+                f"{minimum} items of {item_bytes} bytes do not fit in "
+                f"{self.available} bytes"
+            )
+        self.decide(f"{name} of {items} items ({items * item_bytes} bytes)")
+        return items
+
+    def scratch(self, name, shape, dtype):
+        """
+        Zero-filled array memory-mapped on an anonymous scratch file
+        """
+        scratch_file = tempfile.TemporaryFile(
+            prefix=".fastq2bcl_", dir=self.scratch_dir
+        )
+        self.scratch_files.append(scratch_file)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.spilled[name] = self.spilled.get(name, 0) + nbytes
+        if not nbytes:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(scratch_file, dtype=dtype, mode="w+", shape=shape)
+
+    def zeros(self, name, shape, dtype=np.uint8):
+        """
+        Zero-filled array of name: in memory if it fits, otherwise spilled
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.reserve(name, nbytes):
+            return np.zeros(shape, dtype=dtype)
+        self.decide(f"{name} spilled to scratch ({nbytes} bytes)")
+        return self.scratch(name, shape, dtype)
+
+    def keep(self, name, arrays):
+        """
+        Hold a dict of arrays under name: kept if they fit, otherwise appended
+        to the spill file (the caller drops its references to free the memory).
+        Return the dict to give to restore
+        """
+        nbytes = sum(array.nbytes for array in arrays.values())
+        if self.reserve(name, nbytes):
+            return arrays
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(
+                prefix=".fastq2bcl_", dir=self.scratch_dir
+            )
+        self.decide(f"{name} spilled to scratch ({nbytes} bytes)")
+        self.spilled[name] = nbytes
+        spilled = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            write_at(self.spill_file.fileno(), self.spill_size, array)
+            spilled[key] = (self.spill_size, array.shape, array.dtype)
+            self.spill_size += array.nbytes
+        return spilled
+
+    def restore(self, arrays):
+        """
+        Arrays of a dict returned by keep, spilled arrays are read back
+        """
+        restored = {}
+        for key, array in arrays.items():
+            if isinstance(array, tuple):
+                offset, shape, dtype = array
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                data = read_at(self.spill_file.fileno(), offset, nbytes)
+                array = np.frombuffer(data, dtype=dtype).reshape(shape)
+            restored[key] = array
+        return restored
+
+    def report(self):
+        return {
+            "max_memory": self.max_memory,
+            "limit": self.limit,
+            "held": dict(self.held),
+            "spilled": dict(self.spilled),
+            "decisions": list(self.decisions),
+        }
+
+    def close(self):
+        """
+        Release everything. Arrays still mapped keep their scratch file until
+        they are freed
+        """
+        self.held.clear()
+        self.spilled.clear()
+        for scratch_file in self.scratch_files:
+            scratch_file.close()
+        self.scratch_files = []
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_size = 0
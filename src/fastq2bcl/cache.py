@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+ENTRY_FILENAME = "entry.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, hasher):
+    """
+    Feed the content of a file to a hashlib object in chunks
+    """
+    with open(path, "rb") as f_in:
+        while chunk := f_in.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher
+
+
+def cache_key(inputs, options):
+    """
+    Build a content-addressed key from the input files and the conversion options.
+
+    inputs: dict with the input files, e.g. {"r1": "R1.fastq.gz", "r2": None}
+    options: dict with every option that changes the output (mask, exclude flags, ...)
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    for name in sorted(inputs):
+        if inputs[name] is None:
+            continue
+        hasher.update(name.encode())
+        hash_file(inputs[name], hasher)
+    hasher.update(json.dumps(options, sort_keys=True).encode())
+    return hasher.hexdigest()
+
+
+def lookup_cache(cache_dir, key):
+    """
+    Return the cache entry directory for key, None on a miss.
+    A hit refreshes the entry last use time (LRU).
+    """
+    entry = Path(cache_dir) / key
+    entry_file = entry / ENTRY_FILENAME
+    if not entry_file.is_file():
+        _logger.info(f"Cache miss for key {key}")
+        return None
+    _logger.info(f"Cache hit for key {key}")
+    os.utime(entry_file)
+    return entry
+
+
+def restore_from_cache(entry, rundir, mode="copy"):
+    """
+    Restore a cached run directory to rundir.
+
+    mode "link" hard-links files (falling back to copy across filesystems):
+    linked files share their content with the cache and must not be modified in place.
+    """
+    with open(entry / ENTRY_FILENAME, "rt") as f_in:
+        run_id = json.load(f_in)["run_id"]
+    source = entry / run_id
+    rundir = Path(rundir)
+    for path in sorted(source.rglob("*")):
+        target = rundir / path.relative_to(source)
+        if path.is_dir():
+            target.mkdir(exist_ok=True, parents=True)
+            continue
+        target.parent.mkdir(exist_ok=True, parents=True)
+        if target.exists():
+            target.unlink()
+        if mode == "link":
+            try:
+                os.link(path, target)
+                continue
+            except OSError:
+                _logger.debug(f"Hard link failed for {path}, copying")
+        shutil.copy2(path, target)
+    _logger.info(f"Restored {rundir} from cache entry {entry}")
+    return rundir
+
+
+def store_in_cache(cache_dir, key, rundir):
+    """
+    Copy a run directory in the cache under key. Return the entry directory.
+    """
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / key
+    if (entry / ENTRY_FILENAME).is_file():
+        return entry
+
+    rundir = Path(rundir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    # build the entry in a temporary dir and rename it, concurrent builds are safe
+    staging = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir))
+    try:
+        shutil.copytree(rundir, staging / rundir.name)
+        size = sum(p.stat().st_size for p in staging.rglob("*") if p.is_file())
+        with open(staging / ENTRY_FILENAME, "wt") as f_out:
+            json.dump({"run_id": rundir.name, "size": size}, f_out)
+        os.replace(staging, entry)
+    except OSError:
+        # another process stored the same key first
+        shutil.rmtree(staging, ignore_errors=True)
+        if not (entry / ENTRY_FILENAME).is_file():
+            raise
+    _logger.info(f"Stored {rundir} in cache entry {entry}")
+    return entry
+
+
+def list_cache_entries(cache_dir):
+    """
+    Return a list of tuple (last_used, size, entry) sorted from least recently used
+    """
+    entries = []
+    for entry_file in Path(cache_dir).glob(f"*/{ENTRY_FILENAME}"):
+        with open(entry_file, "rt") as f_in:
+            size = json.load(f_in)["size"]
+        entries.append((entry_file.stat().st_mtime, size, entry_file.parent))
+    return sorted(entries)
+
+
+def evict_cache(cache_dir, max_size):
+    """
+    Remove least recently used entries until the cache size is at most max_size bytes.
+    Return the list of evicted entries.
+    """
+    entries = list_cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    evicted = []
+    for last_used, size, entry in entries:
+        if total <= max_size:
+            break
+        _logger.info(
+            f"Evicting cache entry {entry} ({size} bytes, "
+            f"last used {time.ctime(last_used)})"
+        )
+        shutil.rmtree(entry)
+        total -= size
+        evicted.append(entry)
+    return evicted
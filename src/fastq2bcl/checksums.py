@@ -0,0 +1,116 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from fastq2bcl.runfiles import open_new
+
+_logger = logging.getLogger(__name__)
+
+# md5sum and b2sum (BLAKE2b-512) compatible checksums
+ALGORITHMS = {"md5": hashlib.md5, "blake2": hashlib.blake2b}
+CHECKSUM_FILES = {"md5": "fastq2bcl_checksums.md5", "blake2": "fastq2bcl_checksums.b2"}
+CHUNK_SIZE = 1024 * 1024
+
+
+def checksum_chunks(algorithm, chunks):
+    """
+    Hex digest of the concatenation of chunks (bytes-like objects). hashlib
+    releases the GIL on large chunks: threads hash in parallel.
+    """
+    digest = ALGORITHMS[algorithm]()
+    for chunk in chunks:
+        digest.update(memoryview(chunk).cast("B"))
+    return digest.hexdigest()
+
+
+def checksum_file(algorithm, path):
+    """
+    Hex digest of the content of a file
+    """
+    digest = ALGORITHMS[algorithm]()
+    with open(path, "rb") as f_in:
+        while chunk := f_in.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_checksums(rundir, algorithm, checksums):
+    """
+    Write the checksums (dict of relative path: hex digest) of a run in
+    CHECKSUM_FILES[algorithm], in the format of md5sum and b2sum
+    (``md5sum -c`` or ``b2sum -c`` from rundir check them)
+    """
+    path = Path(rundir) / CHECKSUM_FILES[algorithm]
+    with open_new(path, "wt") as f_out:
+        for relpath in sorted(checksums):
+            f_out.write(f"{checksums[relpath]}  {relpath}\n")
+    _logger.info(f"Written {len(checksums)} {algorithm} checksums to {path}")
+    return path
+
+
+def read_checksums(path):
+    """
+    Read a checksum file written by write_checksums: dict of relative path: digest
+    """
+    checksums = {}
+    with open(path, "rt") as f_in:
+        for line in f_in:
+            digest, relpath = line.rstrip("\n").split("  ", 1)
+            checksums[relpath] = digest
+    return checksums
+
+
+def checksum_run(rundir, algorithm, workers=1):
+    """
+    Checksum the files of an existing run by reading them with a thread pool
+    (conversions hash the files while writing them, see run.write_run) and
+    write its checksum file. The manifest and checksum files are not included.
+    """
+    from fastq2bcl.manifest import MANIFEST_FILENAME
+
+    rundir = Path(rundir)
+    skip = {MANIFEST_FILENAME, *CHECKSUM_FILES.values()}
+    relpaths = sorted(
+        path.relative_to(rundir).as_posix()
+        for path in rundir.rglob("*")
+        if path.is_file() and path.name not in skip
+    )
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(lambda p: checksum_file(algorithm, rundir / p), relpaths)
+        return write_checksums(rundir, algorithm, dict(zip(relpaths, digests)))
+
+
+def find_checksums(rundir):
+    """
+    Algorithm and path of the checksum file of a run, (None, None) if missing
+    """
+    for algorithm, name in CHECKSUM_FILES.items():
+        if (Path(rundir) / name).is_file():
+            return algorithm, Path(rundir) / name
+    return None, None
+
+
+def verify_checksums(rundir, workers=1):
+    """
+    Check the files of a run against its checksum file with a thread pool.
+
+    Return the list of the relative paths that differ or are missing,
+    None if the run has no checksum file
+    """
+    algorithm, path = find_checksums(rundir)
+    if path is None:
+        return None
+    checksums = read_checksums(path)
+
+    def differs(relpath):
+        try:
+            return (
+                checksum_file(algorithm, Path(rundir) / relpath) != checksums[relpath]
+            )
+        except OSError:
+            return True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        flags = list(pool.map(differs, sorted(checksums)))
+    return [relpath for relpath, flag in zip(sorted(checksums), flags) if flag]
@@ -13,45 +13,51 @@ References:
     - https://setuptools.pypa.io/en/latest/userguide/entry_point.html
     - https://pip.pypa.io/en/stable/reference/pip_install
 """
-import signal
 import argparse
+import contextlib
+import json
 import logging
 import sys
 import os
 import re
 import textwrap
-import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
 
 from pathlib import Path
-from rich import print, pretty
-from rich.progress import (
-    Progress,
-    TextColumn,
-    BarColumn,
-    TaskProgressColumn,
-    TimeRemainingColumn,
-    TimeElapsedColumn,
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.cache import (
+    cache_key,
+    lookup_cache,
+    restore_from_cache,
+    store_in_cache,
+    evict_cache,
 )
-from rich.progress import track
-from fastq2bcl import __version__
-from fastq2bcl.parser import parse_seqdesc_fields
-from fastq2bcl.reader import read_first_record, read_fastq_files, get_mask_from_files
-from fastq2bcl.writer import (
-    write_run_info_xml,
-    write_filter,
-    write_control,
-    write_locs,
-    write_bcl_and_stats,
-    write_cycle,
+from fastq2bcl.manifest import new_manifest, resume_manifest
+from fastq2bcl.run import (
+    EXECUTORS,
+    check_output,
+    memory_budget,
+    mock_run_id,
+    set_mask,
+    workers_count,
+    write_run,
 )
 
+# rich, numpy, Bio and the conversion modules are imported by the functions using
+# them: --help, --version and --plan start without loading them
+
 __author__ = "Davide Rambaldi"
 __copyright__ = "Davide Rambaldi"
 __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+# --profile suffixes written as cProfile dumps instead of the stage report
+PSTATS_SUFFIXES = [".prof", ".pstats"]
+# default build cache directory of conversions writing a new run from files
+CACHE_DIR_ENV = "FASTQ2BCL_CACHE_DIR"
+# same as reader.VALIDATE_LEVELS: the reader (and numpy) is imported only to convert
+VALIDATE_LEVELS = ["none", "sampled", "batched", "full"]
+
 # ---- Python API ----
 # The functions defined in this section can be imported by users in their
 # Python scripts/interactive interpreter, e.g. via
@@ -69,36 +75,151 @@ def fastq2bcl(
     exclude_umi=False,
     exclude_index=False,
     threads=1,
+    resume=False,
+    cache_dir=None,
+    cache_max_size=None,
+    cache_mode="copy",
+    intermediate=None,
+    max_reads=None,
+    sample_fraction=None,
+    sample_n=None,
+    seed=0,
+    timer=None,
+    executor="auto",
+    interleaved=False,
+    validate="batched",
+    checksum=None,
+    check=False,
+    tar=None,
+    tar_compression=None,
+    append=None,
+    pools=None,
+    durability="batch",
+    max_memory=None,
 ):
     """fastq2bcl function call
 
     :param outdir: output directory to create run flowcell fake dir
-    :param r1: R1 fastq.gz
+    :param r1: R1 fastq.gz, or a parquet or arrow table of reads (see tables)
     :param r2: R2 fastq.gz
     :param i1: I1 fastq.gz
     :param i2: I2 fastq.gz
+    :param threads: number of workers writing the bcls, "auto" to choose workers,
+        executor and block size from the cpus, the cgroup limits and a write probe
+    :param resume: skip outputs recorded as complete in the run manifest
+    :param cache_dir: build cache directory, restore identical conversions from it
+    :param cache_max_size: evict least recently used cache entries above this size (bytes)
+    :param cache_mode: "copy" or "link" (hard-link) files restored from the cache
+    :param intermediate: directory with the parsed reads, reused when it matches
+        the inputs (saved otherwise)
+    :param max_reads: stop reading the input files after max_reads clusters
+    :param sample_fraction: keep each cluster with this probability
+    :param sample_n: keep sample_n clusters (reservoir sampling)
+    :param seed: seed of the random sampling
+    :param timer: StageTimer collecting the time of each stage (see profiling)
+    :param executor: auto, threads or processes (see run.choose_executor)
+    :param interleaved: r1 holds R1 and R2 records alternating, paired while reading
+    :param validate: record id checks between the files: none, sampled, batched
+        or full (see reader.check_record_ids)
+    :param checksum: md5 or blake2 to write a checksum file of the run
+    :param check: check the structure of the written run (see verify.check_run),
+        raise ValueError if it is not valid
+    :param tar: stream the run directory into this tar archive (a path, "-" for
+        stdout or a binary file object) instead of writing it in outdir
+    :param tar_compression: none, gzip or zstd, default from the archive name
+        (see archive.tar_compression)
+    :param append: existing run directory written by fastq2bcl: append the
+        clusters of the inputs to its files instead of writing a new run
+        (see append.append_run)
+    :param pools: dict of warm executors by kind (threads, processes) reused
+        to write the bcls instead of starting a pool (see serve)
+    :param durability: none, batch or strict: sync of the run written in a
+        staging directory before it is renamed to rundir (see staging)
+    :param max_memory: memory budget in bytes of the conversion: read chunk
+        size, size of the blocks sent to worker processes and spilling of the
+        clusters matrix to memory-mapped scratch files (see budget)
 
     Content of returned tuple:
 
     rundir: final absolute path od created rundir
     run_id: generated mock run_id
-    seq_fields: fields parsed and validated from first R1 record
+    seq_fields: fields parsed and validated from first R1 record (None for
+    read tables)
     mask_string: mask used to generate RunInfo.xml
 
     :rtype: tuple
     """
+    from rich import print
+    from fastq2bcl.parser import parse_seqdesc_fields
+    from fastq2bcl.parser import get_mask_from_files
+    from fastq2bcl.reader import read_first_record
+    from fastq2bcl.intermediate import read_clusters
+    from fastq2bcl.inputs import is_readable_input, is_stream
+    from fastq2bcl.writer import FORMAT_VERSION
+    from fastq2bcl.staging import prepare_staging, publish
+
+    if timer is None:
+        timer = StageTimer()
 
     # First validate outdir
     outdir = Path(outdir).absolute()
-    assert outdir.is_dir()
-    assert os.access(outdir, os.W_OK)
-
-    _logger.info(f"Output directory: {outdir}")
+    if tar is not None and (cache_dir or resume or checksum or check or append):
+        raise ValueError(
+            "--cache-dir, --resume, --checksums, --check and --append need a run "
+            "directory, not --tar"
+        )
+    if append is not None and (cache_dir or resume):
+        raise ValueError("--cache-dir and --resume write new runs, not --append")
+    if tar is None and append is None:
+        assert outdir.is_dir()
+        assert os.access(outdir, os.W_OK)
+        _logger.info(f"Output directory: {outdir}")
+
+    # READ TABLES: parquet or arrow tables of reads are converted without fastq
+    if not is_stream(r1):
+        from fastq2bcl.tables import table_format
+
+        if table_format(r1):
+            return convert_table_input(
+                outdir,
+                r1,
+                mask_string,
+                threads,
+                executor,
+                timer,
+                durability,
+                {
+                    "r2": r2,
+                    "i1": i1,
+                    "i2": i2,
+                    "exclude_umi": exclude_umi,
+                    "exclude_index": exclude_index,
+                    "resume": resume,
+                    "cache_dir": cache_dir,
+                    "intermediate": intermediate,
+                    "sampling": get_sampling_options(
+                        max_reads, sample_fraction, sample_n, seed
+                    ),
+                    "interleaved": interleaved,
+                    "checksum": checksum,
+                    "check": check,
+                    "tar": tar,
+                    "append": append,
+                    "max_memory": max_memory,
+                },
+            )
 
     # Validate R1 and extract first read
     r1 = Path(r1)
-    assert r1.is_file()
-    first_record = read_first_record(r1)
+    assert is_readable_input(r1)
+    # stdin and named pipes are read once: they can not be hashed or fingerprinted
+    streams = [str(f) for f in [r1, r2, i1, i2] if f is not None and is_stream(f)]
+    if streams and (cache_dir or intermediate or resume):
+        raise ValueError(
+            f"--cache-dir, --intermediate and --resume need regular files, not {streams}"
+        )
+    with timer.stage("inspect"):
+        first_record = read_first_record(r1)
     seqdesc_fields = parse_seqdesc_fields(first_record.description)
     _logger.info(f"first record seq length: {len(first_record.seq)}")
     _logger.info(f"first record sequence: {str(first_record.seq)}")
@@ -143,174 +264,275 @@ def fastq2bcl(
 
     if not mask_string:
         # get cycles string from files
-        mask_string = get_mask_from_files(r1, r2, i1, i2, exclude_umi, exclude_index)
+        with timer.stage("inspect"):
+            mask_string = get_mask_from_files(
+                r1, r2, i1, i2, exclude_umi, exclude_index, interleaved
+            )
         _logger.info(f"mask string from files: {mask_string}")
 
     print(f"[green]MASK[/green]: {mask_string}")
 
-    # READ SEQUENCES
-    sequences, positions = read_fastq_files(r1, r2, i1, i2, exclude_umi, exclude_index)
-
-    # SET MASK FROM STRING
-    mask = set_mask(mask_string)
-
-    # WRITE RUN INFO
-    _logger.info(f"Writing RunInfo.mxl to dir: {rundir}")
-    run_info = write_run_info_xml(
-        rundir,
-        run_id,
-        seqdesc_fields["run_number"],
-        seqdesc_fields["flowcell_id"],
-        seqdesc_fields["instrument"],
-        mask,
-    )
-
-    print(f"[green]RunInfo.xml:[/green]:\n", run_info)
-
-    # WRITE FILTER
-    print(f"[bold magenta]Writing filter file [/bold magenta]")
-    _logger.info(
-        f"Writing filter file to dir: {rundir} with cluster count: {len(sequences)}"
-    )
-    write_filter(rundir, len(sequences))
-
-    # WRITE CONTROL
-    print(f"[bold magenta]Writing control file [/bold magenta]")
-    _logger.info(
-        f"Writing control file to dir: {rundir} with cluster count: {len(sequences)}"
+    sampling = get_sampling_options(max_reads, sample_fraction, sample_n, seed)
+    if sampling:
+        print(f"[green]Sampling[/green]: {sampling}")
+    # options changing the clusters read from the same files
+    reading = dict(sampling, interleaved=True) if interleaved else sampling
+
+    # MEMORY BUDGET: read in chunks, spill what does not fit to scratch files
+    budget = chunk_size = None
+    if max_memory is not None:
+        budget, chunk_size = memory_budget(
+            max_memory,
+            mask_string,
+            len([f for f in [r1, r2, i1, i2] if f is not None]) + int(interleaved),
+            outdir if outdir.is_dir() else None,
+        )
+        print(f"[green]Memory budget[/green]: read chunks of {chunk_size} clusters")
+
+    # scratch and spill files of the budget are removed when the conversion ends
+    with budget or contextlib.nullcontext():
+        # BUILD CACHE: restore a previous identical conversion
+        if cache_dir:
+            with timer.stage("cache_lookup"):
+                key = cache_key(
+                    {"r1": r1, "r2": r2, "i1": i1, "i2": i2},
+                    {
+                        "mask": mask_string,
+                        "exclude_umi": exclude_umi,
+                        "exclude_index": exclude_index,
+                        "sampling": reading,
+                        "writer": FORMAT_VERSION,
+                    },
+                )
+                entry = lookup_cache(cache_dir, key)
+            if entry:
+                print(f"[green]Restoring run from cache[/green]: {entry}")
+                staging = prepare_staging(rundir)
+                with timer.stage("cache_restore"):
+                    restore_from_cache(entry, staging, cache_mode)
+                if checksum:
+                    from fastq2bcl.checksums import checksum_run, find_checksums
+
+                    if find_checksums(staging)[0] != checksum:
+                        with timer.stage("checksums"):
+                            checksum_run(staging, checksum, workers_count(threads))
+                if check:
+                    check_output(staging, threads, timer)
+                with timer.stage("publish"):
+                    publish(staging, rundir, durability)
+                return run_id, rundir, seqdesc_fields, mask_string
+
+        if tar is not None:
+            from fastq2bcl.archive import write_run_tar
+
+            clusters, positions = read_clusters(
+                r1,
+                r2,
+                i1,
+                i2,
+                exclude_umi,
+                exclude_index,
+                intermediate,
+                sampling,
+                timer,
+                interleaved,
+                validate,
+                budget,
+                chunk_size,
+            )
+            write_run_tar(
+                tar,
+                run_id,
+                seqdesc_fields,
+                set_mask(mask_string),
+                clusters,
+                positions,
+                compression=tar_compression,
+                timer=timer,
+                durability=durability,
+            )
+            archive = tar if hasattr(tar, "write") or str(tar) == "-" else Path(tar)
+            return run_id, archive, seqdesc_fields, mask_string
+
+        if append is not None:
+            from fastq2bcl.append import append_run
+
+            rundir = Path(append).absolute()
+            clusters, positions = read_clusters(
+                r1,
+                r2,
+                i1,
+                i2,
+                exclude_umi,
+                exclude_index,
+                intermediate,
+                sampling,
+                timer,
+                interleaved,
+                validate,
+                budget,
+                chunk_size,
+            )
+            cluster_count = append_run(
+                rundir,
+                set_mask(mask_string),
+                clusters,
+                positions,
+                threads=workers_count(threads),
+                timer=timer,
+            )
+            print(f"[green]Appended[/green]: {clusters.shape[1]} clusters to {rundir}")
+            print(f"[green]Clusters[/green]: {cluster_count}")
+            if checksum:
+                from fastq2bcl.checksums import checksum_run
+
+                with timer.stage("checksums"):
+                    checksum_run(rundir, checksum, workers_count(threads))
+            if check:
+                check_output(rundir, threads, timer)
+            return rundir.name, rundir, seqdesc_fields, mask_string
+
+        # MANIFEST: track completed outputs to allow --resume
+        manifest = new_manifest(
+            {"r1": r1, "r2": r2, "i1": i1, "i2": i2},
+            mask_string,
+            exclude_umi,
+            exclude_index,
+            reading,
+        )
+        # STAGING: the run is written in a staging directory renamed to rundir when
+        # complete, killed conversions never leave partial files in rundir
+        staging = prepare_staging(rundir, resume)
+        if resume:
+            manifest = resume_manifest(staging, manifest)
+
+        # READ SEQUENCES: encoded clusters matrix with a row for each cycle
+        clusters, positions = read_clusters(
+            r1,
+            r2,
+            i1,
+            i2,
+            exclude_umi,
+            exclude_index,
+            intermediate,
+            sampling,
+            timer,
+            interleaved,
+            validate,
+            budget,
+            chunk_size,
+        )
+
+        write_run(
+            staging,
+            run_id,
+            seqdesc_fields,
+            mask_string,
+            clusters,
+            positions,
+            manifest,
+            threads,
+            executor,
+            timer=timer,
+            checksum=checksum,
+            pools=pools,
+            budget=budget,
+        )
+        if check:
+            check_output(staging, threads, timer)
+        with timer.stage("publish"):
+            publish(staging, rundir, durability)
+
+        if cache_dir:
+            with timer.stage("cache_store"):
+                store_in_cache(cache_dir, key, rundir)
+                if cache_max_size is not None:
+                    evict_cache(cache_dir, cache_max_size)
+
+        return run_id, rundir, seqdesc_fields, mask_string
+
+
+def convert_table_input(
+    outdir, table, mask_string, threads, executor, timer, durability, options
+):
+    """
+    Convert a parquet or arrow read table (see tables.convert_table), ValueError
+    for the fastq2bcl options given in options that tables do not support
+    """
+    from rich import print
+    from fastq2bcl.tables import convert_table
+
+    unsupported = sorted(name for name, value in options.items() if value)
+    if unsupported:
+        raise ValueError(f"Read tables do not support {unsupported}")
+    print(f"[green]Read table[/green]: {table}")
+    run_id, rundir, mask_string = convert_table(
+        outdir,
+        table,
+        mask_string=mask_string,
+        threads=threads,
+        executor=executor,
+        timer=timer,
+        durability=durability,
     )
-    write_control(rundir, len(sequences))
-
-    # WRITE LOCATIONS
-    print(f"[bold magenta]Writing location file [/bold magenta]")
-    _logger.info(f"Writing {len(positions)} locations to dir: {rundir}")
-    write_locs(rundir, positions)
-
-    # WRITE BCL AND STATS with threadss
-    print(f"[bold magenta]Writing cycles files with {threads} threads[/bold magenta]")
-    _logger.info(f"Writing {len(sequences)} sequences bcl and stats to dir: {rundir}")
+    return run_id, rundir, None, mask_string
 
-    # count cycles and clusters
-    cycles = len(sequences[0][0])
-    cluster_count = len(sequences)
 
-    # PARALLEL WRITE OF BCL FILES
-    # Using workers to write files.
-    # Each worker should write a cycle file with clusters init
-    # 1. init bcl file with cluster_count
-    # 2. write the cycle: all clusters data for the position (cycle)
-    # 3. write stat file
-    #
-    # For each cycle pass to the read the data in a tuple (cycle, clusters_base, clusters_quality)
-    if threads > 1:
-        with Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TaskProgressColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            TimeRemainingColumn(),
-            TimeElapsedColumn(),
-            refresh_per_second=1,  # bit slower updates
-        ) as progress:
-            futures = []  # keep track of the jobs
-            with multiprocessing.Manager() as manager:
-                # this is the key - we share some state between our
-                # main process and our worker functions
-                _progress = manager.dict()
-                overall_progress_task = progress.add_task(
-                    "[green]All jobs progress:[/green]"
-                )
-
-                with ProcessPoolExecutor(max_workers=threads) as executor:
-                    # iterate over the jobs we need to run
-                    for cycle in range(cycles):
-                        # set visible false so we don't have a lot of bars all at once:
-                        task_id = progress.add_task(f"cycle {cycle+1}", visible=False)
-                        # build the data required by write_cycle
-                        # TODO optimize
-                        cycle_data = []
-                        for basecalls, qualscores in sequences:
-                            if cycle >= len(basecalls):
-                                cycle_data.append(("N", 0))
-                            else:
-                                cycle_data.append((basecalls[cycle], qualscores[cycle]))
-                        context = (cycle, cluster_count, rundir, cycle_data)
-                        futures.append(
-                            executor.submit(write_cycle, context, _progress, task_id)
-                        )
-                    # monitor the progress:
-                    while (
-                        n_finished := sum([future.done() for future in futures])
-                    ) < len(futures):
-                        progress.update(
-                            overall_progress_task,
-                            completed=n_finished,
-                            total=len(futures),
-                        )
-
-                        for task_id, update_data in _progress.items():
-                            latest = update_data["progress"]
-                            total = update_data["total"]
-                            # update the progress bar for this task:
-                            progress.update(
-                                task_id,
-                                completed=latest,
-                                total=total,
-                                visible=latest < total,
-                            )
-
-                    # wait for all tasks to complete by getting all results
-                    for future in futures:
-                        future.result()
-
-    else:
-        # single thread mode
-        for cycle in track(
-            range(cycles),
-            description="[bold magenta]Initialize bcl files with cluster counts ...[/bold magenta]",
-        ):
-            _logger.info(
-                f"Creating bcl file for cycle #{cycle+1} with {cluster_count} clusters"
-            )
-            write_bcl_and_stats(cycle, cluster_count, rundir, sequences)
+def default_cache_dir(args):
+    """
+    Build cache directory of a conversion without --cache-dir: $FASTQ2BCL_CACHE_DIR
+    when a new run directory is written from regular fastq files, None otherwise
+    (only an explicit --cache-dir is rejected with --tar, --append and streams)
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir or args.tar is not None or args.append is not None:
+        return None
+    from fastq2bcl.inputs import is_stream
+    from fastq2bcl.tables import table_format
 
-    return run_id, rundir, seqdesc_fields, mask_string
+    inputs = [f for f in [args.r1, args.r2, args.i1, args.i2] if f is not None]
+    if any(is_stream(f) for f in inputs) or table_format(args.r1):
+        return None
+    return cache_dir
 
 
-def mock_run_id(fields):
+def get_sampling_options(max_reads, sample_fraction, sample_n, seed):
     """
-    Mock the run directory id and Path
+    Return a dict with the sampling options in use (empty without sampling)
     """
-    run_id = (
-        "YYMMDD_"
-        + fields["instrument"]
-        + "_"
-        + fields["run_number"].zfill(4)
-        + "_"
-        + fields["flowcell_id"]
-    )
-    return run_id
+    sampling = {}
+    if max_reads is not None:
+        sampling["max_reads"] = max_reads
+    if sample_fraction is not None:
+        sampling["sample_fraction"] = sample_fraction
+    if sample_n is not None:
+        sampling["sample_n"] = sample_n
+    if sample_fraction is not None or sample_n is not None:
+        sampling["seed"] = seed
+    return sampling
+
+
+def parse_size(size_string):
+    """
+    Parse a size in bytes with an optional K, M, G or T suffix (powers of 1024)
+    """
+    m = re.fullmatch(r"([0-9]+)([KMGT]?)B?", str(size_string).strip().upper())
+    if not m:
+        raise ValueError(f"Incorrect size string: {size_string}")
+    exponent = " KMGT".index(m.group(2) or " ")
+    return int(m.group(1)) * 1024**exponent
 
 
-def set_mask(mask_string):
-    if mask_string:
-        mask = []
-        regexp_mask = r"([0-9]+[NY])([0-9]+[NY])?([0-9]+[NY])?([0-9]+[NY])?"
-        m = re.match(regexp_mask, mask_string)
-        if not m:
-            raise ValueError(f"Incorrect mask parse: {mask_string}")
-        reads = [g for g in m.groups() if g != None]
-        for g_idx in range(len(reads)):
-            read = re.match(r"([0-9]+)([YN])", reads[g_idx])
-            mask.append(
-                {
-                    "cycles": read.groups()[0],
-                    "index": read.groups()[1],
-                    "id": str(g_idx + 1),
-                }
-            )
-        return mask
-    else:
-        raise ValueError(f"Incorrect mask string: {mask_string}")
+def parse_threads(threads_string):
+    """
+    Parse --threads: a positive number of workers or auto
+    """
+    if threads_string == "auto":
+        return threads_string
+    threads = int(threads_string)
+    if threads < 1:
+        raise ValueError(f"Incorrect number of threads: {threads_string}")
+    return threads
 
 
 # ---- CLI ----
@@ -319,24 +541,21 @@ def set_mask(mask_string):
 # executable/script.
 
 
-def parse_args(args):
-    """Parse command line parameters
+class VersionAction(argparse.Action):
+    """
+    --version reading the package version (importlib.metadata) only when requested
+    """
 
-    Args:
-      args (List[str]): command line parameters as list of strings
-          (for example  ``["--help"]``).
+    def __call__(self, parser, namespace, values, option_string=None):
+        from fastq2bcl import __version__
 
-    Returns:
-      :obj:`argparse.Namespace`: command line parameters namespace
+        parser.exit(message=f"fastq2bcl {__version__}\n")
+
+
+def add_logging_arguments(parser):
+    """
+    Add the -v and -vv options to a parser
     """
-    parser = argparse.ArgumentParser(
-        description="Convert fastq.gz reads and metadata in a bcl2fastq-able run directory"
-    )
-    parser.add_argument(
-        "--version",
-        action="version",
-        version=f"fastq2bcl {__version__}",
-    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -353,15 +572,19 @@ def parse_args(args):
         action="store_const",
         const=logging.DEBUG,
     )
-    parser.add_argument(
-        "-m", "--mask", dest="mask", help="define mask in format 110N10Y10Y110N"
-    )
 
+
+def add_input_arguments(parser):
+    """
+    Add the options selecting the fastq inputs and how they are read to a parser
+    (shared by the conversion and the verify command)
+    """
     parser.add_argument(
         "-r1",
         "--read-1",
         dest="r1",
-        help="fastq.gz with R1 reads",
+        help="fastq with R1 reads (gzip, bgzip, bz2, xz, zstd or plain; - for stdin), "
+        "or a parquet or arrow table of reads (see tables)",
         metavar="R1",
         required=True,
     )
@@ -390,6 +613,100 @@ def parse_args(args):
         metavar="I2",
     )
 
+    parser.add_argument(
+        "--exclude-umi",
+        dest="exclude_umi",
+        help="Do not write UMI from the R1 and R2 fastq reads to the cycles",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--exclude-index",
+        dest="exclude_index",
+        help="Do not write Index from the R1 and R2 fastq reads to the cycles",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--interleaved",
+        dest="interleaved",
+        help="R1 holds R1 and R2 records alternating (interleaved pairs), without -r2",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--validate",
+        dest="validate",
+        help="Record id checks between R1, R2, I1 and I2: none (trusted inputs), "
+        "sampled (one cluster every 1000), batched (all the ids of a batch of "
+        "clusters at once) or full (record by record). Files ending before the "
+        "others are errors at every level. Default batched",
+        choices=VALIDATE_LEVELS,
+        default="batched",
+    )
+
+    parser.add_argument(
+        "--intermediate",
+        dest="intermediate",
+        help="Directory to save the parsed reads (.npy files). "
+        "If it matches the inputs, it is reused without reading the fastq files",
+    )
+
+    parser.add_argument(
+        "--max-reads",
+        dest="max_reads",
+        help="Stop reading the input files after MAX_READS clusters",
+        type=int,
+    )
+
+    sampling = parser.add_mutually_exclusive_group()
+    sampling.add_argument(
+        "--sample-fraction",
+        dest="sample_fraction",
+        help="Keep each cluster with probability SAMPLE_FRACTION (0-1)",
+        type=float,
+    )
+    sampling.add_argument(
+        "--sample-n",
+        dest="sample_n",
+        help="Keep SAMPLE_N clusters with reservoir sampling",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        help="Seed for --sample-fraction and --sample-n. Default 0",
+        type=int,
+        default=0,
+    )
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["--help"]``).
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert fastq.gz reads and metadata in a bcl2fastq-able run directory"
+    )
+    parser.add_argument(
+        "--version",
+        action=VersionAction,
+        nargs=0,
+        help="show program's version number and exit",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument(
+        "-m", "--mask", dest="mask", help="define mask in format 110N10Y10Y110N"
+    )
+    add_input_arguments(parser)
+
     parser.add_argument(
         "-o",
         "--outdir",
@@ -399,40 +716,541 @@ def parse_args(args):
     )
 
     parser.add_argument(
-        "--exclude-umi",
-        dest="exclude_umi",
-        help="Do not write UMI from the R1 and R2 fastq reads to the cycles",
+        "-T",
+        "--threads",
+        help="Number of threads to use to write bcls, or auto to pick them from "
+        "the available cores, cgroup limits and a write probe of the output "
+        "directory. Default 1",
+        type=parse_threads,
+        default=1,
+        dest="threads",
+    )
+
+    parser.add_argument(
+        "--executor",
+        dest="executor",
+        help="Workers writing the bcls with -T: threads share the clusters matrix, "
+        "processes receive a copy of each cycle. auto writes small runs without "
+        "workers and larger runs with threads. Default auto",
+        choices=EXECUTORS,
+        default="auto",
+    )
+
+    parser.add_argument(
+        "--checksums",
+        dest="checksum",
+        help="Write md5 (fastq2bcl_checksums.md5) or blake2 (fastq2bcl_checksums.b2) "
+        "checksums of the run files, computed while they are written. "
+        "Check them with md5sum -c or b2sum -c in the run directory",
+        choices=["md5", "blake2"],
+    )
+
+    parser.add_argument(
+        "--check",
+        dest="check",
+        help="After writing, check sizes and header counts of the run files and "
+        "RunInfo.xml cycles (see fastq2bcl check)",
         action="store_true",
     )
 
     parser.add_argument(
-        "--exclude-index",
-        dest="exclude_index",
-        help="Do not write Index from the R1 and R2 fastq reads to the cycles",
+        "--tar",
+        dest="tar",
+        help="Stream the run directory into the tar archive TAR (- for stdout) "
+        "without writing its files on disk. Compressed with gzip for .tar.gz and "
+        ".tgz names, zstd for .tar.zst and .tzst",
+    )
+
+    parser.add_argument(
+        "--tar-compression",
+        dest="tar_compression",
+        help="Compression of the --tar archive. default: from the archive name, "
+        "none for stdout",
+        choices=["none", "gzip", "zstd"],
+    )
+
+    parser.add_argument(
+        "--durability",
+        dest="durability",
+        help="The run is written in a staging directory renamed to the run "
+        "directory when complete. Sync before the rename: none, batch (one "
+        "syncfs of the output filesystem) or strict (fsync of every file). "
+        "Default batch",
+        choices=["none", "batch", "strict"],
+        default="batch",
+    )
+
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        help="Memory budget of the conversion (e.g. 2G): inputs are read in "
+        "chunks, blocks sent to worker processes are bounded and the clusters "
+        "that do not fit are spilled to memory-mapped scratch files in OUTDIR",
+        type=parse_size,
+    )
+
+    parser.add_argument(
+        "--append",
+        dest="append",
+        help="Append the clusters of the inputs to the existing run directory APPEND "
+        "written by fastq2bcl (same mask) instead of writing a new run: cluster "
+        "counts are patched in place, only the new clusters are written",
+        metavar="RUNDIR",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        help="Skip outputs recorded as complete in the run manifest of a previous run",
         action="store_true",
     )
 
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Build cache directory: identical conversions are restored from the cache. "
+        f"default: ${CACHE_DIR_ENV} (disabled if unset, and for --tar, --append, "
+        "stdin, named pipes and read tables)",
+    )
+
+    parser.add_argument(
+        "--cache-max-size",
+        dest="cache_max_size",
+        help="Evict least recently used cache entries above this size (e.g. 500M, 10G)",
+        type=parse_size,
+    )
+
+    parser.add_argument(
+        "--cache-mode",
+        dest="cache_mode",
+        help="Copy or hard-link files restored from the cache. default: copy",
+        choices=["copy", "link"],
+        default="copy",
+    )
+
+    parser.add_argument(
+        "--plan",
+        dest="plan",
+        help="Do not convert: print a JSON plan with clusters, cycles, output size, "
+        "memory estimate and recommended chunk size, tiles and workers",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="Write a JSON report with wall time, CPU time and throughput of each "
+        "stage to PROFILE. With a .prof or .pstats suffix write a cProfile dump",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--profile-memory",
+        dest="profile_memory",
+        help="Add the tracemalloc delta and peak of each stage to the --profile "
+        "report (slower)",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        help="Write the stages of the parent and worker processes to TRACE "
+        "in Chrome trace event format (chrome://tracing, Perfetto)",
+        type=Path,
+    )
+
+    return parser.parse_args(args)
+
+
+def parse_verify_args(args):
+    """Parse the parameters of the verify command
+
+    Args:
+      args (List[str]): command line parameters after ``verify``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl verify",
+        description="Decode a run directory and compare it with its fastq inputs "
+        "(the options of the conversion select the same clusters)",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument("rundir", help="run directory written by fastq2bcl", type=Path)
+    add_input_arguments(parser)
+    parser.add_argument(
+        "--report",
+        dest="report",
+        help="Write the JSON report of the differences to REPORT",
+        type=Path,
+    )
+    return parser.parse_args(args)
+
+
+def verify(args):
+    """Verify command: exit with status 1 if the run differs from its inputs
+
+    Args:
+      args (List[str]): command line parameters after ``verify``
+    """
+    from rich import print
+    from fastq2bcl.verify import verify_run
+
+    args = parse_verify_args(args)
+    setup_logging(args.loglevel)
+    report = verify_run(
+        args.rundir,
+        args.r1,
+        args.r2,
+        args.i1,
+        args.i2,
+        args.exclude_umi,
+        args.exclude_index,
+        args.intermediate,
+        get_sampling_options(
+            args.max_reads, args.sample_fraction, args.sample_n, args.seed
+        ),
+        args.interleaved,
+        args.validate,
+    )
+    if args.report:
+        args.report.write_text(json.dumps(report, indent=2) + "\n")
+    print(
+        f"[green]Verified[/green] {report['clusters']} clusters, "
+        f"{report['cycles']} cycles of {args.rundir}"
+    )
+    if report["ok"]:
+        print("[bold green]No differences[/bold green]")
+        return
+    for name, count in report["differences"].items():
+        print(f"[red]{name}[/red]: {count} differences")
+    for example in report["examples"]:
+        print(example)
+    sys.exit(1)
+
+
+def parse_check_args(args):
+    """Parse the parameters of the check command
+
+    Args:
+      args (List[str]): command line parameters after ``check``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl check",
+        description="Check the structure of a run directory without reading the "
+        "bcl payloads: file sizes, header counts and RunInfo.xml cycles",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument("rundir", help="run directory", type=Path)
+    parser.add_argument(
+        "-T",
+        "--threads",
+        help="Number of threads checking the files. Default 4",
+        type=int,
+        default=4,
+        dest="threads",
+    )
+    parser.add_argument(
+        "--verify-checksums",
+        dest="verify_checksums",
+        help="Also check the files against the checksum file of the run "
+        "(reads all the files)",
+        action="store_true",
+    )
+    return parser.parse_args(args)
+
+
+def check(args):
+    """Check command: exit with status 1 if the run directory is not valid
+
+    Args:
+      args (List[str]): command line parameters after ``check``
+    """
+    from rich import print
+    from fastq2bcl.verify import check_run
+
+    args = parse_check_args(args)
+    setup_logging(args.loglevel)
+    problems = check_run(args.rundir, args.threads, args.verify_checksums)
+    if not problems:
+        print(f"[bold green]Valid run directory[/bold green]: {args.rundir}")
+        return
+    for problem in problems:
+        print(f"[red]{problem}[/red]")
+    sys.exit(1)
+
+
+def parse_split_args(args):
+    """Parse the parameters of the split command
+
+    Args:
+      args (List[str]): command line parameters after ``split``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl split",
+        description="Plan a conversion in shards converted independently "
+        "(fastq2bcl convert-shard) and merged in a run (fastq2bcl merge)",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument(
+        "-m", "--mask", dest="mask", help="define mask in format 110N10Y10Y110N"
+    )
+    add_input_arguments(parser)
+    parser.add_argument(
+        "-n",
+        "--shards",
+        dest="shards",
+        help="Number of shards, each shard writes a tile. Default 2",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        help="Shard plan (JSON) to write. default: fastq2bcl_plan.json",
+        type=Path,
+        default=Path("fastq2bcl_plan.json"),
+    )
+    args = parser.parse_args(args)
+    if args.intermediate or args.sample_fraction or args.sample_n:
+        parser.error("--intermediate and sampling are not supported with shards")
+    return args
+
+
+def split(args):
+    """Split command: write the shard plan of a conversion
+
+    Args:
+      args (List[str]): command line parameters after ``split``
+    """
+    from rich import print
+    from fastq2bcl.shards import plan_shards, save_plan
+
+    args = parse_split_args(args)
+    setup_logging(args.loglevel)
+    plan = plan_shards(
+        args.r1,
+        args.r2,
+        args.i1,
+        args.i2,
+        args.shards,
+        args.mask,
+        args.exclude_umi,
+        args.exclude_index,
+        args.interleaved,
+        args.validate,
+        args.max_reads,
+    )
+    save_plan(args.output, plan)
+    print(
+        f"[green]Shard plan[/green]: {args.output}, {len(plan['shards'])} shards of "
+        f"{plan['cluster_count']} clusters"
+    )
+
+
+def parse_convert_shard_args(args):
+    """Parse the parameters of the convert-shard command
+
+    Args:
+      args (List[str]): command line parameters after ``convert-shard``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl convert-shard",
+        description="Convert a shard of a plan (fastq2bcl split) in the files of its tile",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument("plan", help="shard plan", type=Path)
+    parser.add_argument(
+        "-s", "--shard", dest="shard", help="shard number", type=int, required=True
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        dest="outdir",
+        help="Shard directory to write. default: shard_SHARD in cwd",
+        type=Path,
+    )
     parser.add_argument(
         "-T",
         "--threads",
-        help="Number of threads to use to write bcls. Default 1",
+        help="Number of threads writing the files. Default 1",
         type=int,
         default=1,
         dest="threads",
     )
+    return parser.parse_args(args)
+
+
+def convert_shard(args):
+    """Convert-shard command: write the tile of a shard
+
+    Args:
+      args (List[str]): command line parameters after ``convert-shard``
+    """
+    from rich import print
+    from fastq2bcl import shards
+
+    args = parse_convert_shard_args(args)
+    setup_logging(args.loglevel)
+    outdir = args.outdir or Path(f"shard_{args.shard}")
+    shards.convert_shard(shards.load_plan(args.plan), args.shard, outdir, args.threads)
+    print(f"[green]Shard {args.shard}[/green]: {outdir}")
+
+
+def parse_merge_args(args):
+    """Parse the parameters of the merge command
+
+    Args:
+      args (List[str]): command line parameters after ``merge``
 
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl merge",
+        description="Assemble the shards of a plan in a run directory, hard-linking "
+        "their files",
+    )
+    add_logging_arguments(parser)
+    parser.add_argument("plan", help="shard plan", type=Path)
+    parser.add_argument("shards", help="shard directories", type=Path, nargs="+")
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        dest="outdir",
+        help="Set the output directory for mocked run. default: cwd",
+        type=Path,
+        default=Path(os.getcwd()),
+    )
+    parser.add_argument(
+        "--sample-sheet",
+        dest="sample_sheet",
+        help="SampleSheet.csv copied in the run directory",
+        type=Path,
+    )
+    parser.add_argument(
+        "--check",
+        dest="check",
+        help="After merging, check sizes and header counts of the run files",
+        action="store_true",
+    )
     return parser.parse_args(args)
 
 
-def setup_logging(loglevel):
+def merge(args):
+    """Merge command: assemble the run directory of converted shards
+
+    Args:
+      args (List[str]): command line parameters after ``merge``
+    """
+    from rich import print
+    from fastq2bcl.shards import load_plan, merge_shards
+
+    args = parse_merge_args(args)
+    setup_logging(args.loglevel)
+    rundir = merge_shards(
+        load_plan(args.plan), args.shards, args.outdir, args.sample_sheet
+    )
+    print(f"[green]RUNDIR[/green]: {rundir}")
+    if args.check:
+        check_output(rundir)
+
+
+def parse_serve_args(args):
+    """Parse the parameters of the serve command
+
+    Args:
+      args (List[str]): command line parameters after ``serve``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="fastq2bcl serve",
+        description="Run conversion jobs submitted as JSON over HTTP, on a unix "
+        "socket or a localhost port, with a warm pool of workers",
+    )
+    add_logging_arguments(parser)
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--socket", dest="socket", help="unix socket path")
+    address.add_argument("--port", dest="port", help="TCP port on --host", type=int)
+    parser.add_argument(
+        "--host",
+        dest="host",
+        help="Loopback address listening with --port (the API has no "
+        "authentication). default: 127.0.0.1",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "-T",
+        "--threads",
+        help="Workers of the warm pool writing the bcls. Default 4",
+        type=int,
+        default=4,
+        dest="threads",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        help="Conversions running at the same time. Default 1",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--executor",
+        dest="executor",
+        help="Warm pool of threads (auto, threads) or processes. Default auto",
+        choices=EXECUTORS,
+        default="auto",
+    )
+    args = parser.parse_args(args)
+    if args.port is not None:
+        from fastq2bcl.serve import is_loopback
+
+        if not is_loopback(args.host):
+            parser.error(f"--host {args.host} is not a loopback address")
+    return args
+
+
+def serve(args):
+    """Serve command: run the conversion service until interrupted
+
+    Args:
+      args (List[str]): command line parameters after ``serve``
+    """
+    from fastq2bcl import serve
+
+    args = parse_serve_args(args)
+    setup_logging(args.loglevel)
+    address = f"unix:{args.socket}" if args.socket else f"{args.host}:{args.port}"
+    serve.serve(address, args.threads, args.jobs, args.executor)
+
+
+def setup_logging(loglevel, stream=None):
     """Setup basic logging
 
     Args:
       loglevel (int): minimum loglevel for emitting messages
+      stream: logging stream, default stdout
     """
     logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
     logging.basicConfig(
-        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+        level=loglevel,
+        stream=stream or sys.stdout,
+        format=logformat,
+        datefmt="%Y-%m-%d %H:%M:%S",
     )
 
 
@@ -446,17 +1264,72 @@ def main(args):
       args (List[str]): command line parameters as list of strings
           (for example  ``["--verbose", "42"]``).
     """
-    pretty.install()
-
+    if args and args[0] == "verify":
+        return verify(args[1:])
+    if args and args[0] == "check":
+        return check(args[1:])
+    if args and args[0] == "split":
+        return split(args[1:])
+    if args and args[0] == "convert-shard":
+        return convert_shard(args[1:])
+    if args and args[0] == "merge":
+        return merge(args[1:])
+    if args and args[0] == "serve":
+        return serve(args[1:])
     args = parse_args(args)
+    if args.tar == "-":
+        # stdout carries the archive: messages go to stderr
+        out = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            setup_logging(args.loglevel, sys.stderr)
+            return convert(args, tar=out)
     setup_logging(args.loglevel)
+    return convert(args, tar=args.tar)
+
+
+def convert(args, tar=None):
+    """Run a conversion (or its --plan) from the parsed command line arguments"""
     _logger.info("Starting application...")
     _logger.info(f"User defined mask: {args.mask}")
     _logger.info(f"Input files: R1={args.r1} R2={args.r2} I1={args.i1} I2={args.i2}")
 
+    if args.plan:
+        from fastq2bcl.planner import plan_conversion
+
+        plan = plan_conversion(
+            args.r1,
+            args.r2,
+            args.i1,
+            args.i2,
+            args.mask,
+            args.exclude_umi,
+            args.exclude_index,
+            args.max_reads,
+            args.sample_fraction,
+            args.sample_n,
+            args.interleaved,
+        )
+        sys.stdout.write(json.dumps(plan, indent=2) + "\n")
+        return
+
+    from rich import print, pretty
+
+    pretty.install()
     print("[bold green]fastq2bcl[/bold green]")
     print("Args:", args)
 
+    # per-stage peaks reset the process peak: only when profiling
+    timer = StageTimer(
+        memory=args.profile_memory,
+        peaks=bool(args.profile or args.trace or args.profile_memory),
+    )
+    profiler = None
+    if args.profile and args.profile.suffix in PSTATS_SUFFIXES:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     # call fastq2bcl
     run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
         args.outdir,
@@ -468,8 +1341,37 @@ def main(args):
         args.exclude_umi,
         args.exclude_index,
         args.threads,
+        resume=args.resume,
+        cache_dir=args.cache_dir or default_cache_dir(args),
+        cache_max_size=args.cache_max_size,
+        cache_mode=args.cache_mode,
+        intermediate=args.intermediate,
+        max_reads=args.max_reads,
+        sample_fraction=args.sample_fraction,
+        sample_n=args.sample_n,
+        seed=args.seed,
+        timer=timer,
+        executor=args.executor,
+        interleaved=args.interleaved,
+        validate=args.validate,
+        checksum=args.checksum,
+        check=args.check,
+        tar=tar,
+        tar_compression=args.tar_compression,
+        append=args.append,
+        durability=args.durability,
+        max_memory=args.max_memory,
     )
 
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        _logger.info(f"cProfile stats written to {args.profile}")
+    elif args.profile:
+        timer.write_report(args.profile)
+    if args.trace:
+        timer.write_trace(args.trace)
+
     _logger.info("Script ends here")
 
 
@@ -0,0 +1,245 @@
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import os
+import stat
+import sys
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+# input name for the standard input
+STDIN = "-"
+# magic bytes of the compressed formats (bgzip files are gzip files)
+MAGIC = [
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\xfd7zXZ\x00", "xz"),
+]
+SNIFF_SIZE = max(len(magic) for magic, _ in MAGIC)
+# decompressed bytes scanned at once when skipping lines
+SKIP_BUFFER_SIZE = 1024 * 1024
+
+# inputs that can not be reopened (stdin, named pipes): their bytes read while
+# inspecting the first records are kept to be replayed to the next reader
+_streams = {}
+
+
+def detect_format(head):
+    """
+    Format of a fastq file from its first bytes: gzip, bz2, zstd, xz or plain
+    """
+    for magic, name in MAGIC:
+        if head.startswith(magic):
+            return name
+    return "plain"
+
+
+def is_stream(path):
+    """
+    True for inputs that can be read only once: stdin and named pipes
+    """
+    if str(path) == STDIN:
+        return True
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+    return not stat.S_ISREG(mode)
+
+
+def is_readable_input(path):
+    """
+    True for stdin, regular files and named pipes
+    """
+    return str(path) == STDIN or Path(path).is_file() or is_stream(path)
+
+
+class StreamSource:
+    """
+    A stream read only once, with the bytes already read by inspecting readers
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.prefix = bytearray()
+
+
+class ReplayReader(io.RawIOBase):
+    """
+    Read a StreamSource replaying its prefix first. A recording reader appends
+    the bytes read from the stream to the prefix for the next readers.
+    """
+
+    def __init__(self, source, record):
+        self.source = source
+        self.record = record
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        prefix = self.source.prefix
+        if self.position < len(prefix):
+            data = prefix[self.position : self.position + len(buffer)]
+        else:
+            data = self.source.raw.read(len(buffer))
+            if self.record:
+                prefix += data
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        # the last reader closes a named pipe
+        if not self.record and self.source.raw is not sys.stdin.buffer:
+            self.source.raw.close()
+        super().close()
+
+
+def open_stream(path, record):
+    """
+    Binary reader of stdin or a named pipe, opened once. Inspecting readers
+    (record=True) keep what they read, the last reader (record=False) consumes
+    the stream.
+    """
+    name = str(path)
+    source = _streams.get(name)
+    if source is None:
+        raw = sys.stdin.buffer if name == STDIN else open(path, "rb", buffering=0)
+        source = _streams[name] = StreamSource(raw)
+    if not record:
+        del _streams[name]
+    return io.BufferedReader(ReplayReader(source, record))
+
+
+def open_plain(source):
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, "rb")
+    return source
+
+
+def open_zstd(source):
+    try:
+        # python >= 3.14
+        from compression import zstd
+
+        return zstd.open(source, "rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(
+            "zstd input needs the zstandard package: pip install fastq2bcl[zstd]"
+        )
+    # the decompressor closes the file it reads
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        open_plain(source), read_across_frames=True
+    )
+    return io.BufferedReader(reader)
+
+
+# decompressed binary reader of a path or a binary file object
+DECOMPRESSORS = {
+    "gzip": lambda source: gzip.open(source, "rb"),
+    "bz2": lambda source: bz2.open(source, "rb"),
+    "xz": lambda source: lzma.open(source, "rb"),
+    "zstd": open_zstd,
+    "plain": open_plain,
+}
+
+
+def open_fastq(path, mode="rt", inspect=False):
+    """
+    Open a fastq input detecting the compression from its magic bytes:
+    gzip (and bgzip), bz2, zstd, xz or plain text.
+
+    path: file, named pipe or "-" for stdin
+    mode: "rt" (text) or "rb" (binary)
+    inspect: read only the first records, stdin and named pipes replay them to
+    the next reader instead of losing them
+    """
+    if is_stream(path):
+        source = open_stream(path, record=inspect)
+        head = source.peek(SNIFF_SIZE)[:SNIFF_SIZE]
+    else:
+        source = path
+        with open(path, "rb") as f_in:
+            head = f_in.read(SNIFF_SIZE)
+    codec = detect_format(head)
+    _logger.debug(f"Opening {path} as {codec}")
+    decompressed = DECOMPRESSORS[codec](source)
+    if mode == "rb":
+        return decompressed
+    return io.TextIOWrapper(decompressed)
+
+
+def skip_lines(fastq_fh, lines):
+    """
+    Skip the first lines of a buffered binary reader (with peek) counting
+    newline bytes, without parsing records.
+    Return the lines skipped (fewer at the end of the file)
+    """
+    skipped = 0
+    while skipped < lines:
+        chunk = fastq_fh.peek(SKIP_BUFFER_SIZE)
+        if not chunk:
+            break
+        found = chunk.count(b"\n")
+        if skipped + found < lines:
+            fastq_fh.read(len(chunk))
+            skipped += found
+            continue
+        end = -1
+        for _ in range(lines - skipped):
+            end = chunk.index(b"\n", end + 1)
+        fastq_fh.read(end + 1)
+        skipped = lines
+    return skipped
+
+
+def open_fastq_from(path, lines=0, offset=None):
+    """
+    Open a fastq input in text mode from one of its lines: seek to the byte
+    offset of the line in a plain file (see planner.scan_line_offsets), else
+    skip the first lines of the decompressed stream (see skip_lines)
+    """
+    if offset is not None:
+        fastq_fh = open(path, "rb")
+        fastq_fh.seek(offset)
+    else:
+        fastq_fh = io.BufferedReader(open_fastq(path, "rb"), SKIP_BUFFER_SIZE)
+        skip_lines(fastq_fh, lines)
+    return io.TextIOWrapper(fastq_fh)
+
+
+def read_first_fastq_records(fastq_file, count=1):
+    """
+    First records of a fastq as a list of tuples (title, sequence, quality).
+    Reads only 4 * count lines, without loading Bio.
+    """
+    records = []
+    with open_fastq(fastq_file, inspect=True) as fastq_fh:
+        for _ in range(count):
+            lines = [fastq_fh.readline().rstrip("\r\n") for _ in range(4)]
+            if not lines[0].startswith("@") or not lines[2].startswith("+"):
+                raise ValueError(f"Invalid fastq record at the start of {fastq_file}")
+            if len(lines[1]) != len(lines[3]):
+                raise ValueError(
+                    f"Lengths of sequence and quality differ in {fastq_file}"
+                )
+            records.append((lines[0][1:], lines[1], lines[3]))
+    return records
+
+
+def read_first_fastq_record(fastq_file):
+    """
+    First record of a fastq as a tuple (title, sequence, quality).
+    Reads only the first four lines, without loading Bio.
+    """
+    return read_first_fastq_records(fastq_file)[0]
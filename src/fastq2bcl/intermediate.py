@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.manifest import fingerprint_file
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.reader import SEGMENTS, iter_fastq_segments, read_fastq_segments
+
+_logger = logging.getLogger(__name__)
+
+META_FILENAME = "meta.json"
+INTERMEDIATE_VERSION = 1
+
+
+def save_intermediate(path, columns, inputs, options=None):
+    """
+    Save the columns returned by read_fastq_segments as a set of .npy files.
+
+    inputs: dict with the input files, their fingerprints validate later loads
+    options: dict with the reading options (e.g. sampling), validate later loads
+    """
+    path = Path(path)
+    path.mkdir(exist_ok=True, parents=True)
+    # the meta.json of a previous save is removed first: columns overwritten by
+    # a save interrupted midway never load as the previous inputs
+    (path / META_FILENAME).unlink(missing_ok=True)
+    for name, values in columns.items():
+        np.save(path / f"{name}.npy", values)
+    meta = {
+        "version": INTERMEDIATE_VERSION,
+        "inputs": {
+            name: fingerprint_file(value)
+            for name, value in inputs.items()
+            if value is not None
+        },
+        "columns": sorted(columns),
+        "options": options or {},
+    }
+    # meta.json is written last: an intermediate without it is incomplete
+    tmp_path = path / f"{META_FILENAME}.tmp"
+    with open(tmp_path, "wt") as f_out:
+        json.dump(meta, f_out, indent=2, sort_keys=True)
+    os.replace(tmp_path, path / META_FILENAME)
+    _logger.info(f"Saved intermediate with columns {meta['columns']} to {path}")
+
+
+def load_intermediate(path, inputs, options=None):
+    """
+    Memory-map the columns of an intermediate saved by save_intermediate.
+
+    Return None if the intermediate is missing or was built from other inputs
+    or options.
+    """
+    path = Path(path)
+    meta_path = path / META_FILENAME
+    if not meta_path.is_file():
+        return None
+    with open(meta_path, "rt") as f_in:
+        meta = json.load(f_in)
+
+    fingerprints = {
+        name: fingerprint_file(value)
+        for name, value in inputs.items()
+        if value is not None
+    }
+    if (
+        meta.get("version") != INTERMEDIATE_VERSION
+        or meta["inputs"] != fingerprints
+        or meta["options"] != (options or {})
+    ):
+        _logger.warning(f"Intermediate in {path} does not match the inputs, ignoring")
+        return None
+
+    _logger.info(f"Loading intermediate with columns {meta['columns']} from {path}")
+    return {
+        name: np.load(path / f"{name}.npy", mmap_mode="r") for name in meta["columns"]
+    }
+
+
+def selected_segments(columns, exclude_umi, exclude_index):
+    return [
+        name
+        for name in SEGMENTS
+        if f"{name}_lengths" in columns
+        and not (exclude_umi and name == "UMI")
+        and not (exclude_index and name == "index")
+    ]
+
+
+def count_cycles(columns, exclude_umi, exclude_index):
+    """
+    Cycles of the assembled clusters of columns: the longest cluster
+    """
+    cycles = np.zeros(len(columns["positions"]), dtype=np.int64)
+    for name in selected_segments(columns, exclude_umi, exclude_index):
+        cycles += columns[f"{name}_lengths"]
+    return int(cycles.max()) if len(cycles) else 0
+
+
+def assemble_clusters(columns, exclude_umi, exclude_index, out=None):
+    """
+    Concatenate the segments of each cluster as read_fastq_files does.
+
+    out: zero-filled uint8 matrix with a row for each cycle (at least) and a
+    column for each cluster, filled instead of a new matrix
+
+    Return a tuple with:
+    clusters: uint8 matrix of bcl bytes with one row per cycle (cycle-major)
+    positions: int matrix with x and y of each cluster
+    """
+    selected = selected_segments(columns, exclude_umi, exclude_index)
+    cluster_count = len(columns["positions"])
+    offsets = np.zeros(cluster_count, dtype=np.int64)
+    cycles = count_cycles(columns, exclude_umi, exclude_index)
+
+    if out is None:
+        out = np.zeros((cycles, cluster_count), dtype=np.uint8)
+    clusters = out
+    if not cluster_count:
+        return clusters, np.asarray(columns["positions"])
+    for name in selected:
+        segment = columns[name]
+        lengths = columns[f"{name}_lengths"]
+        width = segment.shape[1]
+        if (offsets == offsets[0]).all() and (lengths == width).all():
+            # same offset and length for all clusters: copy the block
+            start = int(offsets[0])
+            clusters[start : start + width] = segment.T
+        else:
+            # different lengths: shorter sequences shift the next segments
+            rows, cols = np.nonzero(np.arange(width) < lengths[:, None])
+            clusters[offsets[rows] + cols, rows] = segment[rows, cols]
+        offsets += lengths
+
+    return clusters, np.asarray(columns["positions"])
+
+
+def read_clusters(
+    r1,
+    r2,
+    i1,
+    i2,
+    exclude_umi,
+    exclude_index,
+    intermediate=None,
+    sampling=None,
+    timer=None,
+    interleaved=False,
+    validate="batched",
+    budget=None,
+    chunk_size=None,
+):
+    """
+    Read the encoded clusters and positions of the input files.
+
+    With an intermediate directory, reuse it when it matches the inputs,
+    otherwise read the fastq files and save it for later conversions.
+    sampling: dict with max_reads, sample_fraction, sample_n and seed, or
+    skip_reads and offsets (see read_fastq_segments)
+    timer: StageTimer collecting the time of the reading stages
+    interleaved: r1 holds R1 and R2 records alternating
+    validate: record id checks between the files (see check_record_ids)
+    budget: MemoryBudget holding the encoded chunks and the clusters matrix
+    (see budget), the inputs are read in chunks of chunk_size clusters
+    (at once with an intermediate, saved whole). A read_chunk reservation of
+    the budget is released once the inputs are read
+    """
+    if timer is None:
+        timer = StageTimer()
+    inputs = {"r1": r1, "r2": r2, "i1": i1, "i2": i2}
+    sampling = sampling or {}
+    options = dict(sampling, interleaved=True) if interleaved else sampling
+    columns = None
+    if intermediate:
+        with timer.stage("intermediate_load"):
+            columns = load_intermediate(intermediate, inputs, options)
+    if columns is None and budget is not None and not intermediate:
+        chunks = []
+        for columns in iter_fastq_segments(
+            r1,
+            r2,
+            i1,
+            i2,
+            **sampling,
+            timer=timer,
+            interleaved=interleaved,
+            validate=validate,
+            chunk_size=chunk_size,
+        ):
+            chunks.append(budget.keep(f"chunk_{len(chunks)}", columns))
+            del columns
+        budget.release("read_chunk")
+        with timer.stage("assemble"):
+            return assemble_chunks(chunks, exclude_umi, exclude_index, budget)
+    if columns is None:
+        columns = read_fastq_segments(
+            r1,
+            r2,
+            i1,
+            i2,
+            **sampling,
+            timer=timer,
+            interleaved=interleaved,
+            validate=validate,
+        )
+        if intermediate:
+            with timer.stage("intermediate_save"):
+                save_intermediate(intermediate, columns, inputs, options)
+    if budget is not None:
+        budget.release("read_chunk")
+    with timer.stage("assemble"):
+        if budget is not None:
+            cycles = count_cycles(columns, exclude_umi, exclude_index)
+            out = budget.zeros("clusters", (cycles, len(columns["positions"])))
+            return assemble_clusters(columns, exclude_umi, exclude_index, out)
+        return assemble_clusters(columns, exclude_umi, exclude_index)
+
+
+def restored_size(budget, chunk, exclude_umi, exclude_index):
+    """
+    Cycles and clusters of a chunk kept by budget, reading back only the
+    positions and the lengths of a spilled chunk
+    """
+    columns = budget.restore(
+        {
+            key: value
+            for key, value in chunk.items()
+            if key == "positions" or key.endswith("_lengths")
+        }
+    )
+    return count_cycles(columns, exclude_umi, exclude_index), len(columns["positions"])
+
+
+def assemble_chunks(chunks, exclude_umi, exclude_index, budget):
+    """
+    Assemble the columns of chunks (see iter_fastq_segments) in one clusters
+    matrix allocated by budget, releasing each chunk once it is assembled.
+    Return clusters and positions (see assemble_clusters)
+    """
+    sizes = [restored_size(budget, c, exclude_umi, exclude_index) for c in chunks]
+    cycles = max(cycles for cycles, _ in sizes)
+    cluster_count = sum(count for _, count in sizes)
+    clusters = budget.zeros("clusters", (cycles, cluster_count))
+    positions = budget.zeros("positions", (cluster_count, 2), np.int32)
+    start = 0
+    for number in range(len(chunks)):
+        columns = budget.restore(chunks[number])
+        stop = start + len(columns["positions"])
+        assemble_clusters(columns, exclude_umi, exclude_index, clusters[:, start:stop])
+        positions[start:stop] = columns["positions"]
+        chunks[number] = None
+        budget.release(f"chunk_{number}")
+        start = stop
+    return clusters, positions
@@ -0,0 +1,147 @@
+import logging
+import math
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.runfiles import open_new, remove_file
+from fastq2bcl.writer import (
+    CONTROL_FILE,
+    FILTER_FILE,
+    LOCS_FILE,
+    STATS_SIZE,
+    get_output_sizes,
+)
+
+_logger = logging.getLogger(__name__)
+
+BCL_HEADER_SIZE = 4
+# smallest cluster range written by a task when cycles are split in blocks
+BLOCK_MIN_CLUSTERS = 1 << 20
+# target number of tasks for each worker
+TASKS_PER_WORKER = 4
+# windows opens files in text mode (newline translation) without O_BINARY
+O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def cycle_dir(rundir, cycle, lane="L001"):
+    """
+    Directory of a cycle (see writer.get_cycle_dir), without creating it
+    """
+    return Path(rundir) / f"Data/Intensities/BaseCalls/{lane}/C{cycle+1}.1"
+
+
+def bcl_path(rundir, cycle, lane="L001"):
+    return cycle_dir(rundir, cycle, lane) / "s_1_1101.bcl"
+
+
+def preallocate(path, size):
+    """
+    Create path as a new file of size bytes (see runfiles.remove_file),
+    reserving the disk blocks when the platform supports it (posix_fallocate)
+    """
+    remove_file(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | O_BINARY, 0o666)
+    try:
+        os.ftruncate(fd, size)
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # e.g. not supported by the filesystem: the file is sparse
+                _logger.debug(f"posix_fallocate failed for {path}")
+    finally:
+        os.close(fd)
+
+
+def create_layout(rundir, cycles, cluster_count, lane="L001"):
+    """
+    Create the directory tree of a run once and preallocate the files written
+    by blocks: the bcl file of each cycle (with its cluster count header) and
+    its stats file. Directories of filter, control and locs files are created too.
+
+    cycles: list of the cycle numbers (0-based) to lay out
+    Return the list of the bcl paths
+    """
+    rundir = Path(rundir)
+    for relpath in [FILTER_FILE, CONTROL_FILE, LOCS_FILE]:
+        (rundir / relpath).parent.mkdir(exist_ok=True, parents=True)
+
+    bcl_size = get_output_sizes(cluster_count)["bcl"]
+    header = struct.pack("<I", cluster_count)
+    paths = []
+    for cycle in cycles:
+        path = bcl_path(rundir, cycle, lane)
+        path.parent.mkdir(exist_ok=True)
+        preallocate(path, bcl_size)
+        write_block(path, 0, header)
+        with open_new(path.parent / "s_1_1101.stats") as f_out:
+            f_out.write(bytes(STATS_SIZE))
+        paths.append(path)
+    _logger.info(f"Created layout of {len(paths)} cycles in {rundir}")
+    return paths
+
+
+def plan_blocks(cycles, cluster_count, workers, min_clusters=None, max_clusters=None):
+    """
+    Split the writes of cycles in (cycle, start, stop) blocks of clusters.
+
+    A cycle is a single block when there are enough cycles to keep workers busy,
+    otherwise its clusters are split in ranges of at least min_clusters
+    (default BLOCK_MIN_CLUSTERS, e.g. a 26 cycles run with 1B clusters on
+    64 workers). max_clusters bounds the ranges (e.g. the copies of the blocks
+    sent to worker processes, see budget) and wins over min_clusters.
+    """
+    cycles = list(cycles)
+    if not cycles:
+        return []
+    min_clusters = min_clusters or BLOCK_MIN_CLUSTERS
+    ranges = math.ceil(TASKS_PER_WORKER * workers / len(cycles))
+    ranges = max(1, min(ranges, cluster_count // min_clusters))
+    if max_clusters:
+        ranges = max(ranges, math.ceil(cluster_count / max_clusters))
+    bounds = [
+        (cluster_count * i // ranges, cluster_count * (i + 1) // ranges)
+        for i in range(ranges)
+    ]
+    return [(cycle, start, stop) for cycle in cycles for start, stop in bounds]
+
+
+def write_at(fd, offset, data):
+    """
+    Write all of data at offset of a file descriptor (pwrite: no shared file
+    position, blocks of the same file can be written concurrently)
+    """
+    data = memoryview(data).cast("B")
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:  # pragma: no cover
+        # windows: no pwrite, the file position of fd is moved
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data) :]
+
+
+def write_block(path, offset, data):
+    """
+    Write data at offset of an existing file (see write_at)
+    """
+    fd = os.open(path, os.O_WRONLY | O_BINARY)
+    try:
+        write_at(fd, offset, data)
+    finally:
+        os.close(fd)
+
+
+def write_cycle_block(path, start, block):
+    """
+    Write the encoded bcl bytes of clusters start:start+len(block) of a cycle
+    in its preallocated bcl file
+    """
+    block = np.ascontiguousarray(block, dtype=np.uint8)
+    write_block(path, BCL_HEADER_SIZE + start, block)
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "fastq2bcl_manifest.json"
+MANIFEST_VERSION = 1
+# minimum seconds between two manifest checkpoints
+CHECKPOINT_INTERVAL = 1.0
+
+
+def fingerprint_file(path):
+    """
+    Cheap fingerprint of an input file: resolved path, size and modification time.
+    Stdin ("-") has no size nor modification time.
+    """
+    if str(path) == "-":
+        return {"path": "-", "size": None, "mtime_ns": None}
+    path = Path(path)
+    stat = path.stat()
+    return {
+        "path": str(path.absolute()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def new_manifest(inputs, mask_string, exclude_umi, exclude_index, options=None):
+    """
+    Create an empty manifest for a conversion.
+
+    inputs: dict with the input files, e.g. {"r1": "R1.fastq.gz", "r2": None}
+    options: dict with other options changing the output (e.g. sampling)
+    """
+    return {
+        "version": MANIFEST_VERSION,
+        "inputs": {
+            name: fingerprint_file(path)
+            for name, path in inputs.items()
+            if path is not None
+        },
+        "mask": mask_string,
+        "exclude_umi": exclude_umi,
+        "exclude_index": exclude_index,
+        "options": options or {},
+        "cluster_count": None,
+        "completed": {},
+    }
+
+
+def load_manifest(rundir):
+    """
+    Load the manifest from a run directory, None if missing or unreadable
+    """
+    path = Path(rundir) / MANIFEST_FILENAME
+    if not path.is_file():
+        return None
+    try:
+        with open(path, "rt") as f_in:
+            return json.load(f_in)
+    except ValueError:
+        _logger.warning(f"Ignoring corrupted manifest {path}")
+        return None
+
+
+def save_manifest(rundir, manifest):
+    """
+    Write the manifest atomically (temporary file and rename).
+    Keys starting with "_" are private to the process and not saved.
+    """
+    path = Path(rundir) / MANIFEST_FILENAME
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "wt") as f_out:
+        json.dump(
+            {k: v for k, v in manifest.items() if not k.startswith("_")},
+            f_out,
+            indent=2,
+            sort_keys=True,
+        )
+    os.replace(tmp_path, path)
+
+
+def checkpoint_manifest(rundir, manifest, interval=CHECKPOINT_INTERVAL):
+    """
+    Save the manifest if the last save is older than interval seconds.
+
+    Saving after every output costs O(outputs^2): on a crash at most the outputs
+    completed in the last interval are rebuilt.
+    """
+    now = time.monotonic()
+    if now - manifest.get("_saved_at", float("-inf")) >= interval:
+        save_manifest(rundir, manifest)
+        manifest["_saved_at"] = now
+
+
+def is_compatible(previous, current):
+    """
+    True if a previous manifest was produced from the same inputs and options
+    """
+    if previous is None or previous.get("version") != MANIFEST_VERSION:
+        return False
+    keys = ["inputs", "mask", "exclude_umi", "exclude_index", "options"]
+    return all(previous.get(key) == current.get(key) for key in keys)
+
+
+def resume_manifest(rundir, current):
+    """
+    Merge completed outputs from the manifest found in rundir into current.
+
+    Completed outputs are kept only if the previous manifest is compatible,
+    otherwise everything is rebuilt.
+    """
+    previous = load_manifest(rundir)
+    if previous is None:
+        _logger.info(f"No manifest found in {rundir}, nothing to resume")
+    elif not is_compatible(previous, current):
+        _logger.warning(
+            f"Manifest in {rundir} does not match inputs and options, rebuilding all"
+        )
+    else:
+        current["cluster_count"] = previous["cluster_count"]
+        current["completed"] = dict(previous["completed"])
+        _logger.info(f"Resuming with {len(current['completed'])} completed outputs")
+    return current
+
+
+def mark_complete(rundir, manifest, path):
+    """
+    Record path (inside rundir) as complete with its current size
+    """
+    path = Path(path)
+    relpath = path.relative_to(rundir).as_posix()
+    manifest["completed"][relpath] = path.stat().st_size
+
+
+def is_complete(rundir, manifest, relpath, expected_size=None):
+    """
+    True if relpath was recorded as complete and its size on disk is verified
+    """
+    recorded = manifest["completed"].get(relpath)
+    if recorded is None:
+        return False
+    if expected_size is not None and recorded != expected_size:
+        return False
+    path = Path(rundir) / relpath
+    return path.is_file() and path.stat().st_size == recorded
@@ -1,6 +1,8 @@
 import re
 import logging
 
+from fastq2bcl.inputs import read_first_fastq_record, read_first_fastq_records
+
 _logger = logging.getLogger(__name__)
 
 
@@ -59,3 +61,63 @@ def validate_fields(fields):
                 raise ValueError(f"Requested Key {key} not Found in fastq description")
 
     return fields
+
+
+def get_mask_from_files(r1, r2, i1, i2, exclude_umi, exclude_index, interleaved=False):
+    """
+    Build a mask string using seq length. In case of index and/or UMI in R1 sequence description, write this length to the Index mask
+
+    interleaved: r1 holds R1 and R2 records alternating (r2 must be None)
+    """
+    if interleaved:
+        if r2 is not None:
+            raise ValueError("Interleaved input has R2 records in R1, do not give R2")
+        (title_1, seq_1, _), (_, seq_2, _) = read_first_fastq_records(r1, 2)
+    else:
+        title_1, seq_1, _ = read_first_fastq_record(r1)
+    seq_fields = parse_seqdesc_fields(title_1)
+    index_1_bases = 0
+
+    # Write R1 mask
+    mask = f"{len(seq_1)}N"
+
+    # check errors on index for R1
+    if seq_fields["index"] != "1" and not exclude_index:
+        if i1 != None or i2 != None:
+            raise ValueError(
+                "Usage of index from sequence desc and I1 and I2 files at the same time is not supported"
+            )
+        # continue and write to index I1 length TODO I2 for double index
+        _logger.info(f"Length index {seq_fields['index']}")
+        index_1_bases += len(seq_fields["index"])
+
+    # check errors on UMI for R1
+    if seq_fields["UMI"] != None and not exclude_umi:
+        if i1 != None or i2 != None:
+            raise ValueError(
+                "Usage of UMI from sequence desc and I1 and I2 files at the same time is not supported"
+            )
+        # continue and write to index I1
+        index_1_bases += len(seq_fields["UMI"])
+
+    # Write index I1 based on UMI and index
+    if index_1_bases > 0:
+        mask += f"{index_1_bases}Y"
+
+    # Write indexes
+    if i1 != None:
+        _, index_1, _ = read_first_fastq_record(i1)
+        mask += f"{len(index_1)}Y"
+
+    if i2 != None:
+        _, index_2, _ = read_first_fastq_record(i2)
+        mask += f"{len(index_2)}Y"
+
+    # Write R2 record
+    if r2 != None:
+        _, seq_2, _ = read_first_fastq_record(r2)
+    if r2 != None or interleaved:
+        # finally add R2 to mask
+        mask += f"{len(seq_2)}N"
+
+    return mask
@@ -0,0 +1,163 @@
+import logging
+import math
+import os
+import re
+
+from fastq2bcl.inputs import SNIFF_SIZE, detect_format, open_fastq
+from fastq2bcl.parser import get_mask_from_files
+from fastq2bcl.runfiles import STATS_SIZE, get_output_sizes
+
+_logger = logging.getLogger(__name__)
+
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+# memory target for a chunk of clusters held by the pipeline
+CHUNK_MEMORY = 256 * 1024 * 1024
+# clusters per tile above which the run should be split in more tiles
+CLUSTERS_PER_TILE = 4_000_000
+
+
+def count_fastq_records(path, max_reads=None):
+    """
+    Count the records of a fastq file counting newline bytes (4 lines per record)
+    without parsing. With max_reads, stop scanning after max_reads records.
+    """
+    lines = 0
+    last_byte = b"\n"
+    with open_fastq(path, "rb") as fastq_fh:
+        while chunk := fastq_fh.read(SCAN_CHUNK_SIZE):
+            lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+            if max_reads is not None and lines >= 4 * max_reads:
+                return max_reads
+    if last_byte != b"\n":
+        # last line without newline
+        lines += 1
+    return lines // 4
+
+
+def scan_line_offsets(path, lines):
+    """
+    Byte offsets of the starts of some lines (sorted line numbers) of a plain
+    fastq file, counting newline bytes up to the last of them.
+    Return a dict of line number to offset, without the lines past the end.
+    None for compressed files, that can not seek in their decompressed bytes
+    """
+    with open(path, "rb") as fastq_fh:
+        if detect_format(fastq_fh.read(SNIFF_SIZE)) != "plain":
+            return None
+        fastq_fh.seek(0)
+        offsets = {}
+        pending = list(lines)
+        line = 0
+        position = 0
+        while pending and (chunk := fastq_fh.read(SCAN_CHUNK_SIZE)):
+            start = 0
+            found = chunk.count(b"\n")
+            while pending and pending[0] <= line + found:
+                for _ in range(pending[0] - line):
+                    start = chunk.index(b"\n", start) + 1
+                found -= pending[0] - line
+                line = pending.pop(0)
+                offsets[line] = position + start
+            line += found
+            position += len(chunk)
+    return offsets
+
+
+def mask_cycles(mask_string):
+    """
+    Total number of cycles of a mask string, e.g. 110N8Y -> 118
+    """
+    return sum(int(cycles) for cycles in re.findall(r"([0-9]+)[NY]", mask_string))
+
+
+def estimate_output_bytes(cluster_count, cycles):
+    """
+    Size in bytes of the run directory (RunInfo.xml excluded)
+    """
+    sizes = get_output_sizes(cluster_count)
+    per_cycle = sizes["bcl"] + STATS_SIZE
+    return cycles * per_cycle + sizes["filter"] + sizes["control"] + sizes["locs"]
+
+
+def reading_bytes_per_cluster(cycles, files):
+    """
+    Memory of a cluster while it is read: a bytes object for the sequence and
+    for the quality of each file and of the index and UMI (about 33 bytes of
+    overhead each)
+    """
+    return 2 * cycles + 2 * 33 * (files + 2) + 16
+
+
+def estimate_memory_bytes(cluster_count, cycles, files):
+    """
+    Peak memory estimate of a conversion.
+
+    While reading, every cluster is held as python objects (see
+    reading_bytes_per_cluster), then the encoded segments and the assembled
+    matrix hold one byte per cycle each.
+    """
+    reading = cluster_count * reading_bytes_per_cluster(cycles, files)
+    encoded = 2 * cluster_count * cycles
+    return reading + encoded
+
+
+def plan_conversion(
+    r1,
+    r2=None,
+    i1=None,
+    i2=None,
+    mask_string=None,
+    exclude_umi=False,
+    exclude_index=False,
+    max_reads=None,
+    sample_fraction=None,
+    sample_n=None,
+    interleaved=False,
+):
+    """
+    Estimate clusters, cycles, output size and memory of a conversion
+    without converting. Only R1 is scanned: all the files have the same records.
+    With interleaved, R1 holds two records (R1 and R2) for each cluster.
+
+    :rtype: dict
+    """
+    inferred_mask = get_mask_from_files(
+        r1, r2, i1, i2, exclude_umi, exclude_index, interleaved
+    )
+    cycles = mask_cycles(inferred_mask)
+    files = len([f for f in [r1, r2, i1, i2] if f is not None]) + int(interleaved)
+
+    if interleaved:
+        max_records = None if max_reads is None else 2 * max_reads
+        input_clusters = count_fastq_records(r1, max_records) // 2
+    else:
+        input_clusters = count_fastq_records(r1, max_reads)
+    cluster_count = input_clusters
+    if sample_fraction is not None:
+        cluster_count = round(input_clusters * sample_fraction)
+    if sample_n is not None:
+        cluster_count = min(input_clusters, sample_n)
+    _logger.info(f"Planned {cluster_count} clusters of {input_clusters}")
+
+    chunk_size = max(1, min(cluster_count, CHUNK_MEMORY // max(1, 3 * cycles)))
+    workers = max(1, min(os.cpu_count() or 1, cycles))
+
+    return {
+        "inputs": {
+            name: str(path)
+            for name, path in {"r1": r1, "r2": r2, "i1": i1, "i2": i2}.items()
+            if path is not None
+        },
+        "mask": mask_string or inferred_mask,
+        "input_clusters": input_clusters,
+        "clusters": cluster_count,
+        "cycles": cycles,
+        "output_bytes": estimate_output_bytes(cluster_count, cycles),
+        "memory_bytes": estimate_memory_bytes(cluster_count, cycles, files),
+        "recommended": {
+            "chunk_size": chunk_size,
+            "tiles": max(1, math.ceil(cluster_count / CLUSTERS_PER_TILE)),
+            "workers": workers,
+        },
+    }
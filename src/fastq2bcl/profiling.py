@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    resource = None
+
+_logger = logging.getLogger(__name__)
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes since the last
+    reset_peak_rss (None if not available)
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process to its current RSS (Linux, writing 5 to
+    /proc/self/clear_refs). False where the peak can not be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "wt") as f_out:
+            f_out.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def current_rss():
+    """
+    Resident set size of the process in bytes (/proc/self/statm), the peak RSS
+    where it is not available
+    """
+    try:
+        with open("/proc/self/statm", "rt") as f_in:
+            return int(f_in.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def trace_event(name, start, wall, args=None):
+    """
+    Chrome trace complete event ("ph": "X") for the current process and thread.
+    start is a time.time() timestamp: comparable between processes.
+    """
+    return {
+        "name": name,
+        "ph": "X",
+        "ts": int(start * 1e6),
+        "dur": int(wall * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args or {},
+    }
+
+
+def timed_call(name, func, *args, **kwargs):
+    """
+    Call func and return a tuple (result, trace event).
+    Used to trace functions running in worker processes.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, trace_event(name, start, time.time() - start)
+
+
+def reset_peak():
+    """
+    Reset the tracemalloc peak to the current traced memory and return it
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:  # pragma: no cover
+        # python 3.8: the peak can only be reset clearing the traces
+        tracemalloc.clear_traces()
+    return tracemalloc.get_traced_memory()[0]
+
+
+class StageTimer:
+    """
+    Collect wall time, CPU time and bytes processed of the conversion stages,
+    and the trace events of the parent and of the worker processes.
+
+    Every stage records the RSS of the process at its start and end, and its
+    peak RSS when the peak of the process rose during the stage. With
+    peaks=True (profiling runs) the peak is reset at the start of every stage
+    (see reset_peak_rss) and every stage records its own peak: the reset
+    hides the real peak of the process from getrusage, time and schedulers,
+    and is process-wide (stages of concurrent timers lower each other's
+    peaks). With memory=True stages also record the tracemalloc delta and peak
+    of python allocations (tracing slows down the conversion). Memory stages
+    must not be nested: a stage resets the tracemalloc peak.
+    """
+
+    def __init__(self, memory=False, peaks=False):
+        self.stages = {}
+        self.events = []
+        self.memory = memory
+        self.peaks = peaks
+        # peaks of the stages in progress, raised by the stages nested in them
+        self.open_peaks = []
+        self.peak = 0
+
+    def add(
+        self,
+        name,
+        wall,
+        cpu=0.0,
+        nbytes=0,
+        rss=None,
+        delta=None,
+        peak=None,
+        rss_start=None,
+        rss_end=None,
+    ):
+        """
+        Accumulate time and bytes to a stage, keep the highest memory peaks.
+        rss_start and rss_end are kept from the first and the last call
+        """
+        stage = self.stages.setdefault(
+            name, {"wall": 0.0, "cpu": 0.0, "bytes": 0, "calls": 0}
+        )
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        stage["bytes"] += nbytes
+        stage["calls"] += 1
+        if rss is not None:
+            stage["peak_rss"] = max(stage.get("peak_rss", 0), rss)
+        if rss_start is not None:
+            stage.setdefault("rss_start", rss_start)
+        if rss_end is not None:
+            stage["rss_end"] = rss_end
+        if delta is not None:
+            stage["tracemalloc_delta"] = stage.get("tracemalloc_delta", 0) + delta
+            stage["tracemalloc_peak"] = max(stage.get("tracemalloc_peak", 0), peak)
+
+    def add_event(self, event):
+        self.events.append(event)
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        """
+        Context manager timing a stage, e.g.:
+
+        with timer.stage("read", nbytes=size):
+            ...
+        """
+        delta = peak = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            memory_start = reset_peak()
+        rss_start = current_rss()
+        process_peak = peak_rss()
+        # the peak before the reset belongs to the stages in progress
+        self.raise_open_peaks(process_peak)
+        resettable = self.peaks and reset_peak_rss()
+        self.open_peaks.append(rss_start or 0)
+        start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                delta = current - memory_start
+                # peak of the stage above the memory allocated before it
+                peak -= memory_start
+            rss_end = current_rss()
+            end_peak = peak_rss()
+            self.raise_open_peaks(end_peak)
+            rss = self.open_peaks.pop()
+            self.raise_open_peaks(rss)
+            if not resettable:
+                # without reset, the peak is known only if the stage raised it
+                rose = end_peak is not None and end_peak > (process_peak or 0)
+                rss = end_peak if rose else None
+            self.add(
+                name,
+                wall,
+                cpu,
+                nbytes,
+                rss,
+                delta,
+                peak,
+                rss_start,
+                rss_end,
+            )
+            self.add_event(trace_event(name, start, wall, {"bytes": nbytes}))
+            _logger.debug(
+                f"Stage {name}: wall {wall:.3f}s cpu {cpu:.3f}s rss {rss_start} "
+                f"-> {rss_end} peak {rss}"
+            )
+
+    def raise_open_peaks(self, rss):
+        """
+        Raise the peaks of the stages in progress (and of the timer) to rss
+        """
+        if rss is None:
+            return
+        self.open_peaks = [max(peak, rss) for peak in self.open_peaks]
+        self.peak = max(self.peak, rss)
+
+    def report(self):
+        """
+        Per-stage report with wall and CPU seconds, bytes and throughput
+        """
+        stages = []
+        for name, stage in self.stages.items():
+            stage = dict(stage, name=name)
+            if stage["bytes"] and stage["wall"] > 0:
+                stage["megabytes_per_second"] = stage["bytes"] / stage["wall"] / 1e6
+            stages.append(stage)
+        return {"stages": stages, "peak_rss": max(self.peak, peak_rss() or 0)}
+
+    def trace(self):
+        """
+        Trace in Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        return {"traceEvents": sorted(self.events, key=lambda e: e["ts"])}
+
+    def write_report(self, path):
+        with open(path, "wt") as f_out:
+            json.dump(self.report(), f_out, indent=2)
+        _logger.info(f"Profile report written to {path}")
+
+    def write_trace(self, path):
+        with open(path, "wt") as f_out:
+            json.dump(self.trace(), f_out)
+        _logger.info(f"Trace written to {path}")
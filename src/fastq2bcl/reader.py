@@ -1,90 +1,257 @@
 import logging
-import gzip
-from fastq2bcl.parser import parse_seqdesc_fields
-from Bio import SeqIO
-from rich import print
-import sys
+import os
+import random
+import time
+from itertools import islice
+import numpy as np
+from fastq2bcl.inputs import (  # noqa: F401
+    is_stream,
+    open_fastq,
+    open_fastq_from,
+    read_first_fastq_record,
+    read_first_fastq_records,
+)
+from fastq2bcl.parser import get_mask_from_files, parse_seqdesc_fields  # noqa: F401
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.writer import encode_bcl_bytes
 
 _logger = logging.getLogger(__name__)
 
+# quality of bases taken from the sequence description (index and UMI)
+HEADER_QUALITY = 40
+HEADER_QUALITY_CHAR = chr(HEADER_QUALITY + 33).encode()
+
+# order of the segments in a cluster
+SEGMENTS = ["R1", "index", "UMI", "I1", "I2", "R2"]
+
+# record id checks between synchronized files (see check_record_ids)
+VALIDATE_LEVELS = ["none", "sampled", "batched", "full"]
+# clusters read from every file at once
+VALIDATE_BATCH = 4096
+# clusters between two checks with validate sampled
+VALIDATE_INTERVAL = 1000
+
 
 def read_first_record(fastq_file):
     """
     Validate fastq.gz r1 file and extract first read
     """
-    _logger.info(f"Opening gz file {fastq_file}")
-    with gzip.open(fastq_file, "rt") as fastq_fh:
+    from Bio import SeqIO
+
+    _logger.info(f"Opening fastq file {fastq_file}")
+    with open_fastq(fastq_file, inspect=True) as fastq_fh:
         return next(SeqIO.parse(fastq_fh, "fastq"))
 
 
+def record_id(title):
+    """
+    Sequence id of a record title, without the /1 and /2 suffixes of the
+    mates of a pair
+    """
+    seq_id = title.split(None, 1)[0]
+    if seq_id.endswith(("/1", "/2")):
+        return seq_id[:-2]
+    return seq_id
+
+
 def get_file_handlers(r1, r2, i1, i2):
     """
     Return list of FH
     """
-    files_fh = [gzip.open(r1, "rt")]
+    files_fh = [open_fastq(r1)]
     if not i1 == None:
-        files_fh.append(gzip.open(i1, "rt"))
+        files_fh.append(open_fastq(i1))
     if not i2 == None:
-        files_fh.append(gzip.open(i2, "rt"))
+        files_fh.append(open_fastq(i2))
     if not r2 == None:
-        files_fh.append(gzip.open(r2, "rt"))
+        files_fh.append(open_fastq(r2))
 
     return files_fh
 
 
-def get_mask_from_files(r1, r2, i1, i2, exclude_umi, exclude_index):
+def iter_fastq_records(
+    r1,
+    r2,
+    i1,
+    i2,
+    max_reads=None,
+    interleaved=False,
+    validate="batched",
+    skip_reads=0,
+    offsets=None,
+):
     """
-    Build a mask string using seq length. In case of index and/or UMI in R1 sequence description, write this length to the Index mask
+    Iterate synchronized records of R1 with I1, I2 and R2.
+
+    Yield for each cluster a tuple of (title, seq, qual) string tuples in the
+    order R1, I1, I2, R2 (only for the given files).
+    With max_reads, stop and close all files after max_reads clusters.
+    With interleaved, r1 holds R1 and R2 records alternating: they are paired
+    on the fly (r2 must be None).
+    validate: record id checks between the files (see check_record_ids).
+    Files are read in batches of VALIDATE_BATCH clusters: a file ending before
+    the others raises ValueError at every level.
+    With skip_reads, the first skip_reads clusters are dropped without parsing
+    them, counting the newlines of each file (e.g. the record range of a shard,
+    see shards.plan_shards). offsets: byte offsets of the first kept record in
+    plain files (dict with r1, r2, i1 and i2 keys, see planner.scan_line_offsets)
+    to seek to instead.
     """
-    record_1 = read_first_record(r1)
-    seq_fields = parse_seqdesc_fields(record_1.description)
-    index_1_bases = 0
+    from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
-    # Write R1 mask
-    mask = f"{len(record_1.seq)}N"
+    if interleaved and r2 is not None:
+        raise ValueError("Interleaved input has R2 records in R1, do not give R2")
+    if validate not in VALIDATE_LEVELS:
+        raise ValueError(f"Unknown validate level {validate}, use {VALIDATE_LEVELS}")
+    files = [r1, i1, i2, r2]
+    names = [n for n, f in zip(["R1", "I1", "I2", "R2"], files) if f is not None]
+    if skip_reads:
+        offsets = offsets or {}
+        lines = 8 * skip_reads if interleaved else 4 * skip_reads
+        file_handlers = [
+            open_fastq_from(f, lines, offsets.get(name.lower()))
+            for name, f in zip(names, [f for f in files if f is not None])
+        ]
+    else:
+        file_handlers = get_file_handlers(r1, r2, i1, i2)
+    iterators = [FastqGeneralIterator(fh) for fh in file_handlers]
 
-    # check errors on index for R1
-    if seq_fields["index"] != "1" and not exclude_index:
-        if i1 != None or i2 != None:
-            raise ValueError(
-                "Usage of index from sequence desc and I1 and I2 files at the same time is not supported"
-            )
-        # continue and write to index I1 length TODO I2 for double index
-        print(f"LENGTH INDEX {seq_fields['index']}")
-        index_1_bases += len(seq_fields["index"])
+    try:
+        count = 0
+        while max_reads is None or count < max_reads:
+            size = VALIDATE_BATCH
+            if max_reads is not None:
+                size = min(size, max_reads - count)
+            batch = read_record_batch(iterators, size, interleaved, names)
+            check_record_ids(batch, validate, count)
+            yield from zip(*batch)
+            count += len(batch[0])
+            if len(batch[0]) < size:
+                # R1 ended: the other files must end too
+                for name, iterator in zip(names[1:], iterators[1:]):
+                    if next(iterator, None) is not None:
+                        raise ValueError(f"R1 ended after {count} records, {name} not")
+                return
+        _logger.info(f"Stop reading after {max_reads} clusters")
+    finally:
+        # close all files
+        for file_fh in file_handlers:
+            file_fh.close()
+
+
+def read_record_batch(iterators, size, interleaved=False, names=None):
+    """
+    Read the next size clusters (less at the end of R1) of synchronized iterators.
+    names: names of the files of the iterators, for the error messages
 
-    # check errors on UMI for R1
-    if seq_fields["UMI"] != None and not exclude_umi:
-        if i1 != None or i2 != None:
+    Return a list with the list of records of each file, in the order R1, I1,
+    I2, R2 (R2 last with interleaved)
+    """
+    if interleaved:
+        pairs = list(islice(iterators[0], 2 * size))
+        if len(pairs) % 2:
+            raise ValueError(f"Interleaved record {pairs[-1][0]} without R2")
+        batch = [pairs[0::2]]
+    else:
+        batch = [list(islice(iterators[0], size))]
+    count = len(batch[0])
+    names = names or [f"file {n + 1}" for n in range(len(iterators))]
+    for name, iterator in zip(names[1:], iterators[1:]):
+        records = list(islice(iterator, count))
+        if len(records) < count:
             raise ValueError(
-                "Usage of UMI from sequence desc and I1 and I2 files at the same time is not supported"
+                f"{name} truncated: ended before R1 record {batch[0][len(records)][0]}"
             )
-        # continue and write to index I1
-        index_1_bases += len(seq_fields["UMI"])
+        batch.append(records)
+    if interleaved:
+        batch.append(pairs[1::2])
+    return batch
+
+
+def check_record_ids(batch, validate="batched", first=0):
+    """
+    Check that the records of a batch (see read_record_batch) have the same
+    ids in every file, raise ValueError on the first mismatch.
 
-    # Write index I1 based on UMI and index
-    if index_1_bases > 0:
-        mask += f"{index_1_bases}Y"
+    validate:
+    none: no check (trusted inputs)
+    sampled: one cluster every VALIDATE_INTERVAL (first is the number of the
+    first cluster of the batch)
+    batched: the ids of the whole batch compared at once, records are compared
+    one by one only when the batch differs (e.g. /1 and /2 suffixes)
+    full: every record compared one by one
+    """
+    if validate == "none" or len(batch) < 2:
+        return
+    if validate == "sampled":
+        rows = range(-first % VALIDATE_INTERVAL, len(batch[0]), VALIDATE_INTERVAL)
+        batch = [[records[row] for row in rows] for records in batch]
+    elif validate == "batched":
+        r1_ids = [title.split(None, 1)[0] for title, _, _ in batch[0]]
+        if all(
+            r1_ids == [title.split(None, 1)[0] for title, _, _ in records]
+            for records in batch[1:]
+        ):
+            return
+    for records in zip(*batch):
+        r1_id = record_id(records[0][0])
+        for opt_record in records[1:]:
+            opt_id = record_id(opt_record[0])
+            if opt_id != r1_id:
+                raise ValueError(f"Seq ID mismatch for record {opt_id} R1 is {r1_id}")
+
+
+def sample_records(records, sample_fraction=None, sample_n=None, seed=0):
+    """
+    Deterministic sampling of clusters, the same for all the synchronized files.
 
-    # Write indexes
-    if i1 != None:
-        index_1 = read_first_record(i1)
-        mask += f"{len(index_1.seq)}Y"
+    sample_fraction: keep each cluster with this probability (Bernoulli)
+    sample_n: keep exactly sample_n clusters (reservoir), in input order
+    """
+    if sample_fraction is not None and sample_n is not None:
+        raise ValueError("Use sample fraction or sample n, not both")
+    rng = random.Random(seed)
 
-    if i2 != None:
-        index_2 = read_first_record(i2)
-        mask += f"{len(index_2.seq)}Y"
+    if sample_fraction is not None:
+        if not 0 < sample_fraction <= 1:
+            raise ValueError(f"Sample fraction must be in (0, 1]: {sample_fraction}")
+        for record in records:
+            if rng.random() < sample_fraction:
+                yield record
 
-    # Write R2 record
-    if r2 != None:
-        record_2 = read_first_record(r2)
-        # finally add R2 to mask
-        mask += f"{len(record_2.seq)}N"
+    elif sample_n is not None:
+        if sample_n < 0:
+            raise ValueError(f"Sample n must be positive: {sample_n}")
+        # reservoir (algorithm R) keeping the input index to restore order
+        reservoir = []
+        for idx, record in enumerate(records):
+            if idx < sample_n:
+                reservoir.append((idx, record))
+            else:
+                slot = rng.randrange(idx + 1)
+                if slot < sample_n:
+                    reservoir[slot] = (idx, record)
+        reservoir.sort(key=lambda item: item[0])
+        for _, record in reservoir:
+            yield record
 
-    return mask
+    else:
+        yield from records
 
 
-def read_fastq_files(r1, r2, i1, i2, exclude_umi, exclude_index):
+def read_fastq_files(
+    r1,
+    r2,
+    i1,
+    i2,
+    exclude_umi,
+    exclude_index,
+    max_reads=None,
+    sample_fraction=None,
+    sample_n=None,
+    seed=0,
+    validate="batched",
+):
     """
     Read fastq files R1-R2 with I1 and I2 and return only the data we need
     """
@@ -98,60 +265,230 @@ def read_fastq_files(r1, r2, i1, i2, exclude_umi, exclude_index):
     # PAIR R1-R2
     # sequences = [('AAAABBBB',11111111)]
     # positions = [(1,1)]
-    #
-    # I need way to handle multiple files and merge them in a single with exitstack
-    # Ref https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
-
-    # build a list of iterators
-    file_handlers = get_file_handlers(r1, r2, i1, i2)
-    seq_iterators = [SeqIO.parse(fh, "fastq") for fh in file_handlers]
 
     # output Lists
     sequences = []
     positions = []
 
-    try:
-        # iterate over the R1 iterator
-        for r1_record in seq_iterators[0]:
-            # call next in additional iterators
-            opt_data = [next(iterator) for iterator in seq_iterators[1:]]
-
-            # store R1 data
-            record_fields = parse_seqdesc_fields(r1_record.description)
-            record_id = r1_record.id
-            record_seq = str(r1_record.seq)
-            record_qual = r1_record.letter_annotations["phred_quality"]
-
-            if not exclude_index and record_fields["index"] != "1":
-                _logger.info(f"Reading index field: {record_fields['index']}")
-                record_seq += record_fields["index"]
-                _logger.info(f"New seq len: {len(record_seq)} seq: {record_seq}")
-                record_qual += [40] * len(record_fields["index"])
-                _logger.info(f"New qual: {record_qual}")
-
-            # the UMI is quality MAX (40)
-            if not exclude_umi and record_fields["UMI"] != None:
-                _logger.info(f"Reading umi field: {record_fields['UMI']}")
-                record_seq += record_fields["UMI"]
-                _logger.info(f"New seq len: {len(record_seq)} seq: {record_seq}")
-                record_qual += [40] * len(record_fields["UMI"])
-                _logger.info(f"New qual: {record_qual}")
-
-            for opt_record in opt_data:
-                if opt_record.id != record_id:
-                    raise ValueError(
-                        f"Seq ID mismatch for record {opt_record.id} R1 is {record_id}"
-                    )
-                record_seq += str(opt_record.seq)
-                record_qual += opt_record.letter_annotations["phred_quality"]
-
-            # append cluster position
-            positions.append((record_fields["x_pos"], record_fields["y_pos"]))
-            # append sequence and qual
-            sequences.append((record_seq, record_qual))
-    finally:
-        # close all files
-        for file_fh in file_handlers:
-            file_fh.close()
+    records_iterator = sample_records(
+        iter_fastq_records(r1, r2, i1, i2, max_reads, validate=validate),
+        sample_fraction,
+        sample_n,
+        seed,
+    )
+    for records in records_iterator:
+        # store R1 data
+        title, record_seq, qual = records[0]
+        record_fields = parse_seqdesc_fields(title)
+        record_qual = decode_qualities(qual)
+
+        if not exclude_index and record_fields["index"] != "1":
+            _logger.info(f"Reading index field: {record_fields['index']}")
+            record_seq += record_fields["index"]
+            _logger.info(f"New seq len: {len(record_seq)} seq: {record_seq}")
+            record_qual += [HEADER_QUALITY] * len(record_fields["index"])
+            _logger.info(f"New qual: {record_qual}")
+
+        # the UMI is quality MAX (40)
+        if not exclude_umi and record_fields["UMI"] != None:
+            _logger.info(f"Reading umi field: {record_fields['UMI']}")
+            record_seq += record_fields["UMI"]
+            _logger.info(f"New seq len: {len(record_seq)} seq: {record_seq}")
+            record_qual += [HEADER_QUALITY] * len(record_fields["UMI"])
+            _logger.info(f"New qual: {record_qual}")
+
+        for _, opt_seq, opt_qual in records[1:]:
+            record_seq += opt_seq
+            record_qual += decode_qualities(opt_qual)
+
+        # append cluster position
+        positions.append((record_fields["x_pos"], record_fields["y_pos"]))
+        # append sequence and qual
+        sequences.append((record_seq, record_qual))
 
     return (sequences, positions)
+
+
+def decode_qualities(qual):
+    """
+    Decode a phred+33 quality string in a list of int
+    """
+    return [ord(q) - 33 for q in qual]
+
+
+def read_fastq_segments(
+    r1,
+    r2,
+    i1,
+    i2,
+    max_reads=None,
+    sample_fraction=None,
+    sample_n=None,
+    seed=0,
+    timer=None,
+    interleaved=False,
+    validate="batched",
+    skip_reads=0,
+    offsets=None,
+):
+    """
+    Read fastq files R1-R2 with I1 and I2 in encoded columns.
+
+    Every segment (R1 sequence, index and UMI from the R1 description, I1, I2, R2)
+    is kept in its own padded matrix of bcl bytes (one row per cluster) with the
+    length of each row, so that UMI and index can be excluded later.
+
+    Return a dict of numpy arrays:
+    positions (x, y), filter (1 pass filter, 0 filtered),
+    for each segment found: SEGMENT and SEGMENT_lengths
+
+    max_reads, sample_fraction, sample_n and seed: see iter_fastq_records and
+    sample_records
+    timer: StageTimer for the stages read (decompression and parsing, with the
+    header parsing time in read.header_parse) and encode
+    interleaved: r1 holds R1 and R2 records alternating (see iter_fastq_records)
+    validate: record id checks between the files (see check_record_ids)
+    skip_reads, offsets: drop the first skip_reads clusters (see
+    iter_fastq_records)
+    """
+    chunks = iter_fastq_segments(
+        r1,
+        r2,
+        i1,
+        i2,
+        max_reads,
+        sample_fraction,
+        sample_n,
+        seed,
+        timer,
+        interleaved,
+        validate,
+        skip_reads,
+        offsets,
+    )
+    return next(chunks)
+
+
+def iter_fastq_segments(
+    r1,
+    r2,
+    i1,
+    i2,
+    max_reads=None,
+    sample_fraction=None,
+    sample_n=None,
+    seed=0,
+    timer=None,
+    interleaved=False,
+    validate="batched",
+    skip_reads=0,
+    offsets=None,
+    chunk_size=None,
+):
+    """
+    Read fastq files in chunks of encoded columns (see read_fastq_segments).
+
+    With chunk_size, the records are encoded every chunk_size clusters: only
+    the records of a chunk are held as python objects. Without, a single chunk
+    holds all the clusters. At least one chunk is yielded (empty inputs).
+    """
+    if timer is None:
+        timer = StageTimer()
+    files = [r1, i1, i2, r2]
+    names = [n for n, f in zip(["R1", "I1", "I2", "R2"], files) if f is not None]
+    if interleaved:
+        names.append("R2")
+
+    input_bytes = sum(
+        os.path.getsize(f) for f in files if f is not None and not is_stream(f)
+    )
+    records_iterator = sample_records(
+        iter_fastq_records(
+            r1, r2, i1, i2, max_reads, interleaved, validate, skip_reads, offsets
+        ),
+        sample_fraction,
+        sample_n,
+        seed,
+    )
+    chunks = 0
+    while True:
+        records = islice(records_iterator, chunk_size)
+        columns = encode_records(records, names, timer, 0 if chunks else input_bytes)
+        count = len(columns["positions"])
+        if chunks and not count:
+            return
+        yield columns
+        chunks += 1
+        if chunk_size is None or count < chunk_size:
+            return
+
+
+def encode_records(records, names, timer, input_bytes=0):
+    """
+    Encoded columns (see read_fastq_segments) of the records of the files
+    names (see iter_fastq_records), read in the read stage
+    """
+    seqs = {name: [] for name in SEGMENTS}
+    quals = {name: [] for name in SEGMENTS}
+    positions = []
+    filters = []
+    header_time = 0.0
+    with timer.stage("read", input_bytes):
+        for cluster in records:
+            start = time.perf_counter()
+            fields = parse_seqdesc_fields(cluster[0][0])
+            header_time += time.perf_counter() - start
+            for name, (_, seq, qual) in zip(names, cluster):
+                seqs[name].append(seq.encode())
+                quals[name].append(qual.encode())
+
+            index = fields["index"] if fields["index"] != "1" else ""
+            seqs["index"].append(index.encode())
+            quals["index"].append(HEADER_QUALITY_CHAR * len(index))
+
+            umi = fields["UMI"] or ""
+            seqs["UMI"].append(umi.encode())
+            quals["UMI"].append(HEADER_QUALITY_CHAR * len(umi))
+
+            positions.append((int(fields["x_pos"]), int(fields["y_pos"])))
+            filters.append(fields["is_filtered"] != "Y")
+    timer.add("read.header_parse", header_time)
+
+    columns = {
+        "positions": np.array(positions, dtype=np.int32).reshape(-1, 2),
+        "filter": np.array(filters, dtype=np.uint8),
+    }
+    encoded_bytes = sum(map(len, seqs["R1"]))
+    with timer.stage("encode"):
+        for name in SEGMENTS:
+            lengths = np.fromiter(
+                map(len, seqs[name]), dtype=np.int32, count=len(seqs[name])
+            )
+            # release the python objects as soon as the segment is encoded
+            bases = np.frombuffer(b"".join(seqs.pop(name)), dtype=np.uint8)
+            phred = np.frombuffer(b"".join(quals.pop(name)), dtype=np.uint8) - 33
+            if not lengths.any():
+                continue
+            columns[name] = pad_rows(encode_bcl_bytes(bases, phred), lengths)
+            columns[f"{name}_lengths"] = lengths
+            encoded_bytes += len(bases)
+    timer.stages["encode"]["bytes"] += encoded_bytes
+
+    return columns
+
+
+def pad_rows(values, lengths):
+    """
+    Split a flat array in rows of the given lengths, padded with 0 (no-call)
+    """
+    width = int(lengths.max()) if len(lengths) else 0
+    padded = np.zeros((len(lengths), width), dtype=values.dtype)
+    if len(values) == len(lengths) * width:
+        # all rows have the same length
+        padded[:] = values.reshape(len(lengths), width)
+    else:
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        cols = np.arange(len(values)) - np.repeat(starts, lengths)
+        padded[rows, cols] = values
+    return padded
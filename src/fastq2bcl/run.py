@@ -0,0 +1,459 @@
+# writing of a run directory from the encoded clusters, shared by the command
+# line, batches and shards. Imported by cli at startup: rich, numpy and the
+# writers are imported by the functions using them
+import contextlib
+import logging
+import os
+import re
+from pathlib import Path
+
+from fastq2bcl.manifest import (
+    checkpoint_manifest,
+    is_complete,
+    mark_complete,
+    save_manifest,
+)
+from fastq2bcl.profiling import StageTimer, timed_call
+
+_logger = logging.getLogger(__name__)
+
+EXECUTORS = ["auto", "threads", "processes"]
+# with --executor auto, runs with less bytes of cycles are written without a pool
+AUTO_SERIAL_BYTES = 1024 * 1024
+
+
+def write_run(
+    rundir,
+    run_id,
+    seqdesc_fields,
+    mask_string,
+    clusters,
+    positions,
+    manifest,
+    threads=1,
+    executor="auto",
+    filter_flags=None,
+    timer=None,
+    checksum=None,
+    pools=None,
+    budget=None,
+):
+    """Write RunInfo.xml, filter, control, locs and the bcl and stats files of a run
+
+    :param rundir: run directory
+    :param run_id: run id written in RunInfo.xml
+    :param seqdesc_fields: dict with run_number, flowcell_id and instrument
+    :param mask_string: mask of the reads, e.g. 110N8Y
+    :param clusters: uint8 matrix of bcl bytes with one row per cycle
+    :param positions: int matrix with x and y of each cluster
+    :param manifest: run manifest, complete outputs are skipped
+    :param threads: number of workers or "auto" (see fastq2bcl)
+    :param executor: auto, threads or processes (see choose_executor)
+    :param filter_flags: pass filter flag of each cluster, None for all passing
+    :param timer: StageTimer collecting the time of each stage
+    :param checksum: md5 or blake2 to write a checksum file of the run, computed
+        while the files are written (see checksums)
+    :param pools: dict of running executors by kind (threads, processes), used
+        instead of starting a pool of the chosen executor
+    :param budget: MemoryBudget bounding the blocks copied to worker processes
+    """
+    from rich import print
+    from fastq2bcl.layout import create_layout, plan_blocks, write_cycle_block
+    from fastq2bcl.writer import (
+        FILTER_FILE,
+        CONTROL_FILE,
+        LOCS_FILE,
+        STATS_SIZE,
+        get_output_sizes,
+        write_run_info_xml,
+        write_filter,
+        write_control,
+        write_locs,
+    )
+
+    if timer is None:
+        timer = StageTimer()
+
+    # SET MASK FROM STRING
+    mask = set_mask(mask_string)
+
+    # count cycles and clusters
+    cycles, cluster_count = clusters.shape
+    sizes = get_output_sizes(cluster_count)
+
+    if manifest["cluster_count"] != cluster_count:
+        manifest["completed"] = {}
+    manifest["cluster_count"] = cluster_count
+    save_manifest(rundir, manifest)
+
+    # WRITE RUN INFO
+    _logger.info(f"Writing RunInfo.mxl to dir: {rundir}")
+    with timer.stage("write_runinfo"):
+        run_info = write_run_info_xml(
+            rundir,
+            run_id,
+            seqdesc_fields["run_number"],
+            seqdesc_fields["flowcell_id"],
+            seqdesc_fields["instrument"],
+            mask,
+        )
+
+    print(f"[green]RunInfo.xml:[/green]:\n", run_info)
+
+    # WRITE FILTER
+    if is_complete(rundir, manifest, FILTER_FILE, sizes["filter"]):
+        _logger.info(f"Filter file already complete, skipping")
+    else:
+        print(f"[bold magenta]Writing filter file [/bold magenta]")
+        _logger.info(
+            f"Writing filter file to dir: {rundir} with cluster count: {cluster_count}"
+        )
+        with timer.stage("write_filter", sizes["filter"]):
+            write_filter(rundir, cluster_count, filter_flags)
+        mark_complete(rundir, manifest, rundir / FILTER_FILE)
+        save_manifest(rundir, manifest)
+
+    # WRITE CONTROL
+    if is_complete(rundir, manifest, CONTROL_FILE, sizes["control"]):
+        _logger.info(f"Control file already complete, skipping")
+    else:
+        print(f"[bold magenta]Writing control file [/bold magenta]")
+        _logger.info(
+            f"Writing control file to dir: {rundir} with cluster count: {cluster_count}"
+        )
+        with timer.stage("write_control", sizes["control"]):
+            write_control(rundir, cluster_count)
+        mark_complete(rundir, manifest, rundir / CONTROL_FILE)
+        save_manifest(rundir, manifest)
+
+    # WRITE LOCATIONS
+    if is_complete(rundir, manifest, LOCS_FILE, sizes["locs"]):
+        _logger.info(f"Location file already complete, skipping")
+    else:
+        print(f"[bold magenta]Writing location file [/bold magenta]")
+        _logger.info(f"Writing {len(positions)} locations to dir: {rundir}")
+        with timer.stage("write_locs", sizes["locs"]):
+            write_locs(rundir, positions)
+        mark_complete(rundir, manifest, rundir / LOCS_FILE)
+        save_manifest(rundir, manifest)
+
+    # CHECKSUMS: hashed by a thread pool while the cycles are written. bcl files
+    # are hashed from the clusters matrix in memory, the small files (and cycles
+    # complete from a resumed run) are read back
+    checksums = {}
+    checksum_futures = {}
+    if checksum:
+        from concurrent.futures import ThreadPoolExecutor
+        from fastq2bcl.checksums import checksum_chunks, checksum_file
+
+        hash_pool = ThreadPoolExecutor(max_workers=workers_count(threads))
+        for relpath in ["RunInfo.xml", FILTER_FILE, CONTROL_FILE, LOCS_FILE]:
+            checksum_futures[relpath] = hash_pool.submit(
+                checksum_file, checksum, rundir / relpath
+            )
+        header = cluster_count.to_bytes(4, "little")
+        stats_checksum = checksum_chunks(checksum, [bytes(STATS_SIZE)])
+        for cycle in range(cycles):
+            cycledir = f"Data/Intensities/BaseCalls/L001/C{cycle+1}.1"
+            if is_cycle_complete(rundir, manifest, cycle, sizes):
+                future = hash_pool.submit(
+                    checksum_file, checksum, rundir / cycledir / "s_1_1101.bcl"
+                )
+            else:
+                future = hash_pool.submit(
+                    checksum_chunks, checksum, [header, clusters[cycle]]
+                )
+            checksum_futures[f"{cycledir}/s_1_1101.bcl"] = future
+            checksums[f"{cycledir}/s_1_1101.stats"] = stats_checksum
+
+    # WRITE BCL AND STATS with threadss
+    print(f"[bold magenta]Writing cycles files with {threads} threads[/bold magenta]")
+    _logger.info(f"Writing {cluster_count} sequences bcl and stats to dir: {rundir}")
+
+    # skip cycles with bcl and stats already complete
+    todo_cycles = [
+        cycle
+        for cycle in range(cycles)
+        if not is_cycle_complete(rundir, manifest, cycle, sizes)
+    ]
+    if len(todo_cycles) < cycles:
+        print(f"[green]Resuming[/green]: {cycles - len(todo_cycles)} cycles complete")
+
+    # LAYOUT: create the cycle directories once and preallocate bcl and stats files
+    with timer.stage("layout"):
+        bcl_paths = dict(
+            zip(todo_cycles, create_layout(rundir, todo_cycles, cluster_count))
+        )
+
+    # PARALLEL WRITE OF BCL FILES
+    # Using workers to write files.
+    # Each worker fills a block of a preallocated bcl file: the clusters start:stop
+    # of a cycle. Cycles are split in cluster ranges when there are less cycles
+    # than workers (see layout.plan_blocks).
+    # Threads share the clusters matrix, processes receive a pickled copy of the block
+    block_clusters = None
+    limiter = None
+    if threads == "auto":
+        # pick workers, executor and block size, lower the writers in flight
+        # if the write latency climbs (see autotune)
+        from fastq2bcl.autotune import AdaptiveLimit, autotune
+
+        with timer.stage("autotune"):
+            tuned = autotune(rundir, cluster_count, len(todo_cycles), executor)
+        print(
+            f"[green]Autotune[/green]: {tuned['threads']} {tuned['executor']}, "
+            f"blocks of {tuned['block_clusters']} clusters"
+        )
+        threads, executor = tuned["threads"], tuned["executor"]
+        block_clusters = tuned["block_clusters"]
+        limiter = AdaptiveLimit(threads)
+    executor = choose_executor(executor, threads, cluster_count, len(todo_cycles))
+    max_clusters = None
+    if budget is not None and executor == "processes":
+        from fastq2bcl.budget import BLOCK_MEMORY_FRACTION
+
+        # each block in flight is pickled by the parent and unpickled by a worker
+        max_clusters = budget.chunk_size(
+            "write_blocks", 2 * threads, BLOCK_MEMORY_FRACTION
+        )
+    blocks = plan_blocks(
+        todo_cycles,
+        cluster_count,
+        threads if executor != "serial" else 1,
+        block_clusters,
+        max_clusters,
+    )
+    _logger.info(
+        f"Writing {len(blocks)} blocks of {len(todo_cycles)} cycles with executor {executor}"
+    )
+    # blocks left to write for each cycle: a cycle is complete when all are written
+    pending = {cycle: 0 for cycle in todo_cycles}
+    for cycle, _, _ in blocks:
+        pending[cycle] += 1
+
+    def block_written(cycle):
+        pending[cycle] -= 1
+        if not pending[cycle]:
+            mark_cycle_complete(rundir, manifest, cycle)
+            checkpoint_manifest(rundir, manifest)
+
+    if executor != "serial":
+        from concurrent.futures import (
+            FIRST_COMPLETED,
+            ProcessPoolExecutor,
+            ThreadPoolExecutor,
+            wait,
+        )
+        from rich.progress import (
+            Progress,
+            TextColumn,
+            BarColumn,
+            TaskProgressColumn,
+            TimeRemainingColumn,
+            TimeElapsedColumn,
+        )
+
+        if pools and executor in pools:
+            # warm pool of a long-running process: not shut down after the run
+            pool_context = contextlib.nullcontext(pools[executor])
+        else:
+            executor_class = {
+                "threads": ThreadPoolExecutor,
+                "processes": ProcessPoolExecutor,
+            }[executor]
+            pool_context = executor_class(max_workers=threads)
+        with Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            TimeRemainingColumn(),
+            TimeElapsedColumn(),
+            refresh_per_second=1,  # bit slower updates
+        ) as progress:
+            overall_progress_task = progress.add_task(
+                "[green]All jobs progress:[/green]", total=len(blocks)
+            )
+            with pool_context as pool:
+                # keep at most limit blocks in flight and track their block
+                limit = threads
+                todo_blocks = iter(blocks)
+                futures = {}
+                while True:
+                    while len(futures) < limit:
+                        block = next(todo_blocks, None)
+                        if block is None:
+                            break
+                        cycle, start, stop = block
+                        future = pool.submit(
+                            timed_call,
+                            "write_block",
+                            write_cycle_block,
+                            bcl_paths[cycle],
+                            start,
+                            clusters[cycle, start:stop],
+                        )
+                        futures[future] = block
+                    if not futures:
+                        break
+                    # monitor the progress:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _, event = future.result()
+                        cycle, start, stop = futures.pop(future)
+                        wall = event["dur"] / 1e6
+                        timer.add_event(event)
+                        timer.add("write_block", wall, nbytes=stop - start)
+                        if limiter:
+                            limit = limiter.update(wall / max(1, stop - start))
+                        block_written(cycle)
+                        progress.advance(overall_progress_task)
+
+    else:
+        from rich.progress import track
+
+        # single thread mode
+        for cycle, start, stop in track(
+            blocks,
+            description="[bold magenta]Writing bcl files ...[/bold magenta]",
+        ):
+            _logger.info(
+                f"Writing bcl file for cycle #{cycle+1} with clusters {start}:{stop}"
+            )
+            with timer.stage("write_block", stop - start):
+                write_cycle_block(bcl_paths[cycle], start, clusters[cycle, start:stop])
+            block_written(cycle)
+
+    checkpoint_manifest(rundir, manifest, interval=0)
+    if budget is not None:
+        budget.release("write_blocks")
+
+    if checksum:
+        from fastq2bcl.checksums import write_checksums
+
+        with timer.stage("checksums"):
+            for relpath, future in checksum_futures.items():
+                checksums[relpath] = future.result()
+            hash_pool.shutdown()
+        write_checksums(rundir, checksum, checksums)
+
+
+def workers_count(threads):
+    """
+    Number of threads of the pools reading files: threads, or the cpus for auto
+    """
+    return threads if isinstance(threads, int) else os.cpu_count() or 1
+
+
+def memory_budget(max_memory, mask_string, files, scratch_dir=None):
+    """
+    MemoryBudget of a conversion (see budget) and the read chunk size in
+    clusters, reserved in the budget until the inputs are read
+    """
+    from fastq2bcl.budget import (
+        READ_CHUNK_MAX,
+        READ_CHUNK_MIN,
+        READ_MEMORY_FRACTION,
+        MemoryBudget,
+    )
+    from fastq2bcl.planner import mask_cycles, reading_bytes_per_cluster
+
+    budget = MemoryBudget(max_memory, scratch_dir)
+    chunk_size = budget.chunk_size(
+        "read_chunk",
+        reading_bytes_per_cluster(mask_cycles(mask_string), files),
+        READ_MEMORY_FRACTION,
+        READ_CHUNK_MIN,
+        READ_CHUNK_MAX,
+    )
+    return budget, chunk_size
+
+
+def check_output(rundir, threads=1, timer=None):
+    """
+    Check the structure of a written run (see verify.check_run), raise
+    ValueError with the problems found
+    """
+    from fastq2bcl.verify import check_run
+
+    if timer is None:
+        timer = StageTimer()
+    with timer.stage("check"):
+        problems = check_run(rundir, workers_count(threads))
+    if problems:
+        raise ValueError(f"Invalid run directory {rundir}: {'; '.join(problems)}")
+
+
+def choose_executor(executor, threads, cluster_count, cycles):
+    """
+    Select how to write the cycles: serial, threads or processes.
+
+    Cycle writes are bulk writes of contiguous rows that release the GIL, so threads
+    avoid the process spawn and the pickling of the rows. With executor auto, runs
+    smaller than AUTO_SERIAL_BYTES are written without a pool and larger runs
+    with threads. processes is used only when requested.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor {executor}, use one of {EXECUTORS}")
+    if threads <= 1:
+        return "serial"
+    if executor == "auto":
+        if cluster_count * cycles < AUTO_SERIAL_BYTES:
+            return "serial"
+        return "threads"
+    return executor
+
+
+def is_cycle_complete(rundir, manifest, cycle, sizes):
+    """
+    True if bcl and stats files of a cycle are recorded complete in the manifest
+    """
+    cycledir = f"Data/Intensities/BaseCalls/L001/C{cycle+1}.1"
+    return is_complete(
+        rundir, manifest, f"{cycledir}/s_1_1101.bcl", sizes["bcl"]
+    ) and is_complete(rundir, manifest, f"{cycledir}/s_1_1101.stats", sizes["stats"])
+
+
+def mark_cycle_complete(rundir, manifest, cycle):
+    """
+    Record bcl and stats files of a cycle as complete in the manifest
+    """
+    cycledir = Path(rundir) / f"Data/Intensities/BaseCalls/L001/C{cycle+1}.1"
+    mark_complete(rundir, manifest, cycledir / "s_1_1101.bcl")
+    mark_complete(rundir, manifest, cycledir / "s_1_1101.stats")
+
+
+def mock_run_id(fields):
+    """
+    Mock the run directory id and Path
+    """
+    run_id = (
+        "YYMMDD_"
+        + fields["instrument"]
+        + "_"
+        + fields["run_number"].zfill(4)
+        + "_"
+        + fields["flowcell_id"]
+    )
+    return run_id
+
+
+def set_mask(mask_string):
+    if mask_string:
+        mask = []
+        regexp_mask = r"([0-9]+[NY])([0-9]+[NY])?([0-9]+[NY])?([0-9]+[NY])?"
+        m = re.match(regexp_mask, mask_string)
+        if not m:
+            raise ValueError(f"Incorrect mask parse: {mask_string}")
+        reads = [g for g in m.groups() if g != None]
+        for g_idx in range(len(reads)):
+            read = re.match(r"([0-9]+)([YN])", reads[g_idx])
+            mask.append(
+                {
+                    "cycles": read.groups()[0],
+                    "index": read.groups()[1],
+                    "id": str(g_idx + 1),
+                }
+            )
+        return mask
+    else:
+        raise ValueError(f"Incorrect mask string: {mask_string}")
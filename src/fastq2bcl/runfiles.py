@@ -0,0 +1,59 @@
+# names and sizes of the files of a run directory, without numpy: imported by
+# --plan (see planner) as well as by the writers
+import os
+from pathlib import Path
+
+# bump when the content of the written files changes (invalidates build caches)
+FORMAT_VERSION = 1
+
+# tile of the runs written by fastq2bcl (lane 1), sharded runs have one tile per shard
+TILE = 1101
+FILTER_FILE = "Data/Intensities/BaseCalls/L001/s_1_1101.filter"
+CONTROL_FILE = "Data/Intensities/BaseCalls/L001/s_1_1101.control"
+LOCS_FILE = "Data/Intensities/L001/s_1_1101.locs"
+STATS_SIZE = 108
+
+
+def tile_files(tile=TILE):
+    """
+    Paths of the filter, control and locs files of a tile of lane 1, relative
+    to the run directory
+    """
+    return {
+        "filter": f"Data/Intensities/BaseCalls/L001/s_1_{tile}.filter",
+        "control": f"Data/Intensities/BaseCalls/L001/s_1_{tile}.control",
+        "locs": f"Data/Intensities/L001/s_1_{tile}.locs",
+    }
+
+
+def get_output_sizes(cluster_count):
+    """
+    Expected size in bytes of the files written for a cluster count
+    """
+    return {
+        "filter": 12 + cluster_count,
+        "control": 12 + 2 * cluster_count,
+        "locs": 12 + 8 * cluster_count,
+        "bcl": 4 + cluster_count,
+        "stats": STATS_SIZE,
+    }
+
+
+def remove_file(path):
+    """
+    Unlink path if it exists, before writing it again as a new file: files of a
+    run can be hard links (a build cache entry restored with --cache-mode link,
+    a published run reused by --resume) and are never modified in place
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def open_new(path, mode="wb"):
+    """
+    Open path for writing as a new file (see remove_file)
+    """
+    remove_file(path)
+    return open(Path(path), mode)
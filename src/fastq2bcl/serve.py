@@ -0,0 +1,413 @@
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from fastq2bcl.profiling import StageTimer
+
+_logger = logging.getLogger(__name__)
+
+JOB_STATES = ["queued", "running", "done", "failed", "cancelled"]
+# fastq2bcl options accepted in a job, with outdir and r1 required
+JOB_OPTIONS = {
+    "outdir",
+    "r1",
+    "r2",
+    "i1",
+    "i2",
+    "mask_string",
+    "exclude_umi",
+    "exclude_index",
+    "threads",
+    "resume",
+    "cache_dir",
+    "cache_max_size",
+    "cache_mode",
+    "intermediate",
+    "max_reads",
+    "sample_fraction",
+    "sample_n",
+    "seed",
+    "interleaved",
+    "validate",
+    "checksum",
+    "check",
+    "tar",
+    "tar_compression",
+    "append",
+    "durability",
+    "max_memory",
+}
+# finished jobs kept for status requests, the oldest are forgotten
+MAX_FINISHED_JOBS = 1000
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancellableTimer(StageTimer):
+    """
+    StageTimer raising JobCancelled when a stage starts after the job was
+    cancelled: running conversions stop at the next stage (or bcl block)
+    """
+
+    def __init__(self, cancelled, memory=False):
+        super().__init__(memory)
+        self.cancelled = cancelled
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Cancelled before {name}")
+        with super().stage(name, nbytes):
+            yield self
+
+
+class ConversionService:
+    """
+    Run conversion jobs (keyword arguments of cli.fastq2bcl) in a long-running
+    process: modules are imported once and the pool writing the bcls is started
+    once and shared by the jobs.
+
+    workers: workers of the warm pool (the threads of each job)
+    jobs: conversions running at the same time
+    executor: auto or threads (warm thread pool), processes (warm process pool)
+    """
+
+    def __init__(self, workers=4, jobs=1, executor="auto"):
+        # imports paid once, before the first job
+        import fastq2bcl.cli  # noqa: F401
+        import fastq2bcl.intermediate  # noqa: F401
+        import fastq2bcl.layout  # noqa: F401
+
+        self.workers = workers
+        self.executor = executor
+        kind = "processes" if executor == "processes" else "threads"
+        pool_class = ProcessPoolExecutor if kind == "processes" else ThreadPoolExecutor
+        self.pools = {kind: pool_class(max_workers=workers)}
+        # start the workers now
+        wait([self.pools[kind].submit(os.getpid) for _ in range(workers)])
+        self.runner = ThreadPoolExecutor(max_workers=jobs)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, options):
+        """
+        Queue a job, return its status. ValueError for unknown or missing options
+        """
+        if not isinstance(options, dict):
+            raise ValueError("A job is a JSON object of fastq2bcl options")
+        unknown = sorted(set(options) - JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown job options {unknown}")
+        missing = [name for name in ["outdir", "r1"] if not options.get(name)]
+        if missing:
+            raise ValueError(f"Missing job options {missing}")
+        if options.get("tar") == "-":
+            raise ValueError("Jobs can not write archives to the service stdout")
+        stdin = [name for name in ["r1", "r2", "i1", "i2"] if options.get(name) == "-"]
+        if stdin:
+            raise ValueError(f"Jobs can not read {stdin} from the service stdin")
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "status": "queued",
+            "options": options,
+            "submitted": time.time(),
+            "_cancelled": threading.Event(),
+        }
+        with self.lock:
+            self.forget_finished()
+            self.jobs[job["id"]] = job
+            job["_future"] = self.runner.submit(self.run_job, job)
+        _logger.info(f"Queued job {job['id']}")
+        return self.status(job["id"])
+
+    def run_job(self, job):
+        from fastq2bcl.cli import fastq2bcl
+
+        if job["_cancelled"].is_set():
+            return
+        job["status"] = "running"
+        job["started"] = time.time()
+        timer = CancellableTimer(job["_cancelled"])
+        options = dict(job["options"])
+        # the jobs share the warm pool: at most its workers each
+        threads = options.get("threads", self.workers)
+        if threads == "auto" or threads > self.workers:
+            options["threads"] = self.workers
+        try:
+            run_id, rundir, _, mask_string = fastq2bcl(
+                **options, executor=self.executor, timer=timer, pools=self.pools
+            )
+            job["result"] = {
+                "run_id": run_id,
+                "rundir": str(rundir),
+                "mask": mask_string,
+            }
+            job["status"] = "done"
+        except JobCancelled:
+            job["status"] = "cancelled"
+        except Exception as error:
+            _logger.exception(f"Job {job['id']} failed")
+            job["error"] = f"{type(error).__name__}: {error}"
+            job["status"] = "failed"
+        finally:
+            job["finished"] = time.time()
+            job["stages"] = timer.report()["stages"]
+        _logger.info(f"Job {job['id']} {job['status']}")
+
+    def cancel(self, job_id):
+        """
+        Cancel a job: queued jobs do not start, running jobs stop at their next
+        stage. Return its status, None for unknown jobs
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job["_cancelled"].set()
+        if job["status"] == "queued" and job["_future"].cancel():
+            job["status"] = "cancelled"
+            job["finished"] = time.time()
+        return self.status(job_id)
+
+    def status(self, job_id):
+        """
+        Public fields of a job, None for unknown jobs
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {k: v for k, v in job.items() if not k.startswith("_")}
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait for the end of a job, return its status
+        """
+        wait([self.jobs[job_id]["_future"]], timeout)
+        return self.status(job_id)
+
+    def forget_finished(self):
+        finished = [job for job in self.jobs.values() if "finished" in job]
+        for job in sorted(finished, key=lambda job: job["finished"])[
+            : max(0, len(finished) - MAX_FINISHED_JOBS)
+        ]:
+            del self.jobs[job["id"]]
+
+    def close(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        self.runner.shutdown(wait=True)
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of a ConversionService (self.server.service):
+
+    POST /jobs: submit a job, GET /jobs: all the jobs, GET /jobs/ID: status of
+    a job, DELETE /jobs/ID: cancel a job, GET /health
+
+    Web pages can send requests to a loopback port (DNS rebinding, simple
+    cross-origin requests): TCP requests with a Host or an Origin other than a
+    loopback address get 403, jobs must be posted as application/json
+    """
+
+    def check_request(self):
+        """
+        Send 403 and return False for requests of other hosts or origins
+        """
+        if self.client_address:
+            host = self.headers.get("Host", "")
+            origin = self.headers.get("Origin")
+            hosts = [urlsplit(f"//{host}").hostname]
+            if origin is not None:
+                hosts.append(urlsplit(origin).hostname)
+            if not all(is_loopback_name(name) for name in hosts):
+                self.send_json(403, {"error": "Requests from loopback hosts only"})
+                return False
+        return True
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job_id(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs":
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        if not self.check_request():
+            return
+        service = self.server.service
+        if self.path.rstrip("/") == "/health":
+            return self.send_json(200, {"status": "ok", "jobs": len(service.jobs)})
+        if self.path.rstrip("/") == "/jobs":
+            return self.send_json(
+                200, [service.status(id) for id in list(service.jobs)]
+            )
+        status = service.status(self.job_id())
+        if status is None:
+            return self.send_json(404, {"error": f"Unknown job {self.path}"})
+        self.send_json(200, status)
+
+    def do_POST(self):
+        if not self.check_request():
+            return
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        if content_type.lower() != "application/json":
+            return self.send_json(415, {"error": "Jobs must be application/json"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            options = json.loads(self.rfile.read(length) or b"null")
+            status = self.server.service.submit(options)
+        except ValueError as error:
+            return self.send_json(400, {"error": str(error)})
+        self.send_json(201, status)
+
+    def do_DELETE(self):
+        if not self.check_request():
+            return
+        status = self.server.service.cancel(self.job_id())
+        if status is None:
+            return self.send_json(404, {"error": f"Unknown job {self.path}"})
+        self.send_json(200, status)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        _logger.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_address(address):
+    """
+    (family, address) of a service address: unix:PATH, HOST:PORT or PORT
+    """
+    address = str(address)
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def is_loopback(host):
+    """
+    True for loopback addresses and host names resolving to one (e.g. localhost)
+    """
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def is_loopback_name(host):
+    """
+    True for localhost and loopback IP addresses, without resolving names
+    (a DNS rebinding name resolves to 127.0.0.1)
+    """
+    if host is None:
+        return False
+    if host.lower() == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_server(address, service):
+    """
+    HTTP server of a service on a unix socket or a TCP address (see parse_address).
+    Jobs write where they ask and the API has no authentication: TCP servers
+    listen only on loopback addresses, ValueError for other hosts
+    """
+    family, bind = parse_address(address)
+    if family == socket.AF_INET and not is_loopback(bind[0]):
+        raise ValueError(
+            f"The service has no authentication: listen on a loopback address "
+            f"or a unix socket, not {bind[0]}"
+        )
+    if family == socket.AF_UNIX:
+        if Path(bind).exists():
+            Path(bind).unlink()
+        server = UnixHTTPServer(bind, JobHandler)
+    else:
+        server = ThreadingHTTPServer(bind, JobHandler)
+    server.service = service
+    return server
+
+
+def serve(address, workers=4, jobs=1, executor="auto"):
+    """
+    Run a conversion service on address until interrupted
+    """
+    service = ConversionService(workers, jobs, executor)
+    server = create_server(address, service)
+    _logger.info(f"Serving conversions on {address} with {workers} warm workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        family, bind = parse_address(address)
+        if family == socket.AF_UNIX and Path(bind).exists():
+            Path(bind).unlink()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(address, method, path, data=None, timeout=60):
+    """
+    Client of a conversion service: send a JSON request, return
+    (status code, decoded JSON response)
+    """
+    family, bind = parse_address(address)
+    if family == socket.AF_UNIX:
+        connection = UnixHTTPConnection(bind, timeout)
+    else:
+        connection = http.client.HTTPConnection(*bind, timeout=timeout)
+    try:
+        body = None if data is None else json.dumps(data).encode()
+        headers = {"Content-Type": "application/json"} if body else {}
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b"null")
+    finally:
+        connection.close()
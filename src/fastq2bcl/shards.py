@@ -0,0 +1,261 @@
+import json
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.staging import link_file, prepare_staging, publish
+
+_logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+# written by convert_shard in the shard directory, read by merge_shards
+SHARD_FILE = "fastq2bcl_shard.json"
+# tiles 1101 to 1199 of lane 1: one for each shard
+FIRST_TILE = 1101
+MAX_SHARDS = 99
+
+
+def plan_shards(
+    r1,
+    r2=None,
+    i1=None,
+    i2=None,
+    shards=2,
+    mask_string=None,
+    exclude_umi=False,
+    exclude_index=False,
+    interleaved=False,
+    validate="batched",
+    max_reads=None,
+):
+    """
+    Split a conversion in shards converted independently (e.g. on other nodes):
+    each shard reads a range of records of the inputs and writes its own tile.
+
+    Inputs are counted once (see planner.count_fastq_records), the mask and the
+    run id are fixed here so that all the shards agree. Shards of plain inputs
+    seek to their first record (see planner.scan_line_offsets), shards of
+    compressed inputs skip the records before their range counting newlines.
+
+    Return a dict (JSON serializable, see save_plan) with the inputs, the
+    conversion options, run_id, seqdesc_fields and shards: a list of dicts with
+    shard, tile, start and stop (record range) and offsets (byte offset of the
+    first record in each plain input)
+    """
+    from fastq2bcl.run import mock_run_id
+    from fastq2bcl.inputs import is_stream
+    from fastq2bcl.parser import get_mask_from_files, parse_seqdesc_fields
+    from fastq2bcl.planner import count_fastq_records, scan_line_offsets
+    from fastq2bcl.reader import read_first_record
+
+    if not 1 <= shards <= MAX_SHARDS:
+        raise ValueError(f"Shards must be between 1 and {MAX_SHARDS}, not {shards}")
+    inputs = {"r1": r1, "r2": r2, "i1": i1, "i2": i2}
+    streams = [str(f) for f in inputs.values() if f is not None and is_stream(f)]
+    if streams:
+        raise ValueError(f"Shards read their inputs again, not {streams}")
+    seqdesc_fields = parse_seqdesc_fields(read_first_record(r1).description)
+    if not mask_string:
+        mask_string = get_mask_from_files(
+            r1, r2, i1, i2, exclude_umi, exclude_index, interleaved
+        )
+    if interleaved:
+        max_records = None if max_reads is None else 2 * max_reads
+        cluster_count = count_fastq_records(r1, max_records) // 2
+    else:
+        cluster_count = count_fastq_records(r1, max_reads)
+
+    if cluster_count < shards:
+        raise ValueError(
+            f"{cluster_count} clusters can not be split in {shards} shards"
+        )
+    bounds = [cluster_count * k // shards for k in range(shards + 1)]
+    lines = [(8 if interleaved else 4) * start for start in bounds[:-1]]
+    offsets = {}
+    for name, path in inputs.items():
+        if path is not None:
+            found = scan_line_offsets(path, lines)
+            if found is not None and len(found) == len(lines):
+                offsets[name] = [found[line] for line in lines]
+    plan = {
+        "version": PLAN_VERSION,
+        "inputs": {
+            name: None if path is None else str(Path(path).absolute())
+            for name, path in inputs.items()
+        },
+        "mask": mask_string,
+        "exclude_umi": exclude_umi,
+        "exclude_index": exclude_index,
+        "interleaved": interleaved,
+        "validate": validate,
+        "run_id": mock_run_id(seqdesc_fields),
+        "seqdesc_fields": seqdesc_fields,
+        "cluster_count": cluster_count,
+        "shards": [
+            {
+                "shard": k,
+                "tile": FIRST_TILE + k,
+                "start": start,
+                "stop": stop,
+                "offsets": {name: found[k] for name, found in offsets.items()},
+            }
+            for k, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ],
+    }
+    _logger.info(f"Planned {shards} shards of {cluster_count} clusters")
+    return plan
+
+
+def save_plan(path, plan):
+    with open(path, "wt") as f_out:
+        json.dump(plan, f_out, indent=2, sort_keys=True)
+    return Path(path)
+
+
+def load_plan(path):
+    """
+    Load a shard plan written by save_plan, ValueError for other versions
+    """
+    with open(path, "rt") as f_in:
+        plan = json.load(f_in)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} is not a fastq2bcl shard plan")
+    return plan
+
+
+def write_members(rundir, members, workers=1):
+    """
+    Write (relative path, list of buffers) members in rundir with a thread pool
+    """
+    rundir = Path(rundir)
+    members = list(members)
+    for parent in {(rundir / relpath).parent for relpath, _ in members}:
+        parent.mkdir(exist_ok=True, parents=True)
+
+    def write(member):
+        relpath, chunks = member
+        with open(rundir / relpath, "wb") as f_out:
+            for chunk in chunks:
+                f_out.write(chunk)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(write, members))
+    return [relpath for relpath, _ in members]
+
+
+def convert_shard(plan, shard, shard_dir, threads=1, timer=None, durability="batch"):
+    """
+    Convert the record range of a shard of plan (see plan_shards) in the files
+    of its tile, written in shard_dir with the layout of a run directory,
+    without RunInfo.xml. SHARD_FILE records the shard, its tile and files.
+    The files are written in a staging directory renamed to shard_dir when
+    complete (see staging.publish).
+
+    Return the shard directory
+    """
+    from fastq2bcl.intermediate import read_clusters
+    from fastq2bcl.writer import tile_members
+
+    if timer is None:
+        timer = StageTimer()
+    shard = plan["shards"][shard]
+    inputs = plan["inputs"]
+    shard_dir = Path(shard_dir)
+    clusters, positions = read_clusters(
+        inputs["r1"],
+        inputs["r2"],
+        inputs["i1"],
+        inputs["i2"],
+        plan["exclude_umi"],
+        plan["exclude_index"],
+        sampling={
+            "skip_reads": shard["start"],
+            "offsets": shard.get("offsets"),
+            "max_reads": shard["stop"] - shard["start"],
+        },
+        timer=timer,
+        interleaved=plan["interleaved"],
+        validate=plan["validate"],
+    )
+    cycles, cluster_count = clusters.shape
+    if cluster_count != shard["stop"] - shard["start"]:
+        raise ValueError(
+            f"Shard {shard['shard']} read {cluster_count} clusters, "
+            f"planned {shard['stop'] - shard['start']}"
+        )
+    staging = prepare_staging(shard_dir)
+    with timer.stage("write_shard", clusters.nbytes):
+        files = write_members(
+            staging, tile_members(clusters, positions, tile=shard["tile"]), threads
+        )
+    with open(staging / SHARD_FILE, "wt") as f_out:
+        json.dump(
+            dict(
+                shard,
+                run_id=plan["run_id"],
+                mask=plan["mask"],
+                cycles=cycles,
+                cluster_count=cluster_count,
+                files=files,
+            ),
+            f_out,
+            indent=2,
+        )
+    with timer.stage("publish"):
+        publish(staging, shard_dir, durability)
+    _logger.info(f"Converted shard {shard['shard']} in {shard_dir}")
+    return shard_dir
+
+
+def merge_shards(plan, shard_dirs, outdir, sample_sheet=None, durability="batch"):
+    """
+    Assemble the tiles of converted shards (see convert_shard) in a run
+    directory: RunInfo.xml with a tile for each shard and the files of the
+    tiles, hard-linked from the shard directories (copied across filesystems).
+    sample_sheet: SampleSheet.csv copied in the run directory
+    durability: see staging.publish
+
+    Return the run directory
+    """
+    from fastq2bcl.run import set_mask
+    from fastq2bcl.writer import write_run_info_xml
+
+    shards = {}
+    for shard_dir in map(Path, shard_dirs):
+        with open(shard_dir / SHARD_FILE, "rt") as f_in:
+            shard = json.load(f_in)
+        if shard["run_id"] != plan["run_id"] or shard["mask"] != plan["mask"]:
+            raise ValueError(f"{shard_dir} is a shard of another plan")
+        if shard["shard"] in shards:
+            raise ValueError(f"Shard {shard['shard']} found twice: {shard_dir}")
+        shards[shard["shard"]] = (shard_dir, shard)
+    missing = [s["shard"] for s in plan["shards"] if s["shard"] not in shards]
+    if missing:
+        raise ValueError(f"Missing shards {missing}")
+    cycles = {shard["cycles"] for _, shard in shards.values()}
+    if len(cycles) > 1:
+        raise ValueError(f"Shards have different cycles: {sorted(cycles)}")
+
+    rundir = Path(outdir) / plan["run_id"]
+    staging = prepare_staging(rundir)
+    fields = plan["seqdesc_fields"]
+    write_run_info_xml(
+        staging,
+        plan["run_id"],
+        fields["run_number"],
+        fields["flowcell_id"],
+        fields["instrument"],
+        set_mask(plan["mask"]),
+        len(plan["shards"]),
+    )
+    for shard_dir, shard in shards.values():
+        for relpath in shard["files"]:
+            (staging / relpath).parent.mkdir(exist_ok=True, parents=True)
+            link_file(shard_dir / relpath, staging / relpath)
+    if sample_sheet:
+        shutil.copy2(sample_sheet, staging / "SampleSheet.csv")
+    publish(staging, rundir, durability)
+    _logger.info(f"Merged {len(shards)} shards in {rundir}")
+    return rundir
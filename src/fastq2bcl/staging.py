@@ -0,0 +1,135 @@
+import ctypes
+import logging
+import os
+import shutil
+from pathlib import Path
+
+_logger = logging.getLogger(__name__)
+
+# none: no sync, batch: one syncfs of the output filesystem before publishing,
+# strict: fsync of every file and directory before publishing
+DURABILITY = ["none", "batch", "strict"]
+
+
+def staging_path(path):
+    """
+    Staging path of a run directory (or file), in the same directory: renamed
+    to path when complete
+    """
+    path = Path(path)
+    return path.with_name(f".{path.name}.staging")
+
+
+def link_file(source, target):
+    """
+    Hard-link source to target, copy it where links are not supported
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        _logger.debug(f"Hard link failed for {source}, copying")
+        shutil.copy2(source, target)
+
+
+def link_tree(source, target):
+    """
+    Directory tree of source in target with its files hard-linked (see link_file)
+    """
+    shutil.copytree(source, target, copy_function=link_file)
+    return target
+
+
+def prepare_staging(rundir, resume=False):
+    """
+    Create the staging directory of rundir and return it.
+
+    With resume, the staging directory of an interrupted run is kept, or the
+    files of the published rundir are hard-linked in staging, so that its
+    complete outputs are reused: rundir stays published until the resumed run
+    replaces it (the writers never modify linked files in place, see
+    runfiles.remove_file). Otherwise a stale staging directory is removed.
+    """
+    rundir = Path(rundir)
+    staging = staging_path(rundir)
+    if resume:
+        if not staging.exists() and rundir.is_dir():
+            link_tree(rundir, staging)
+    elif staging.exists():
+        _logger.info(f"Removing stale staging directory {staging}")
+        shutil.rmtree(staging)
+    staging.mkdir(exist_ok=True, parents=True)
+    return staging
+
+
+def fsync_path(path):
+    """
+    fsync a file or a directory (directories are skipped where they can not be
+    opened, e.g. windows)
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (IsADirectoryError, PermissionError):
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path):
+    """
+    Flush the filesystem of path with a single syncfs(2) call (linux),
+    os.sync elsewhere
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if libc.syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    except (OSError, AttributeError):
+        pass
+    if hasattr(os, "sync"):
+        os.sync()
+
+
+def sync_tree(path, durability="batch"):
+    """
+    Make the files of path durable with a durability policy (see DURABILITY)
+    """
+    if durability not in DURABILITY:
+        raise ValueError(f"Unknown durability {durability}, use one of {DURABILITY}")
+    path = Path(path)
+    if durability == "batch":
+        syncfs(path)
+    elif durability == "strict":
+        paths = [path, *path.rglob("*")] if path.is_dir() else [path]
+        # files before their directories
+        for item in sorted(paths, key=lambda p: p.is_dir()):
+            fsync_path(item)
+
+
+def publish(staging, target, durability="batch"):
+    """
+    Sync staging with durability and rename it to target (a run directory or a
+    file): readers of target never see partial output. An existing target
+    directory is replaced.
+    """
+    staging, target = Path(staging), Path(target)
+    sync_tree(staging, durability)
+    if target.is_dir():
+        old = target.with_name(f".{target.name}.old")
+        if old.exists():
+            shutil.rmtree(old)
+        os.replace(target, old)
+        os.replace(staging, target)
+        shutil.rmtree(old)
+    else:
+        os.replace(staging, target)
+    if durability != "none":
+        # persist the rename
+        fsync_path(target.parent)
+    _logger.info(f"Published {target}")
+    return target
@@ -0,0 +1,128 @@
+import gzip
+import logging
+from pathlib import Path
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+MODES = ["single", "pair", "dual_index", "umi"]
+CHUNK_READS = 100_000
+# lookup tables from a random byte: uniform bases and binned qualities of recent
+# instruments (2, 12, 23, 37) with frequency about 2%, 8%, 15% and 75%
+BASES = np.resize(np.frombuffer(b"ACGT", dtype=np.uint8), 256)
+QUALITIES = np.repeat(np.array([2, 12, 23, 37], dtype=np.uint8) + 33, [5, 20, 39, 192])
+
+
+def digits(values, width):
+    """
+    Ascii digits of an int array, zero padded to width: one row per value
+    """
+    powers = 10 ** np.arange(width - 1, -1, -1)
+    return ((values[:, None] // powers) % 10 + ord("0")).astype(np.uint8)
+
+
+def random_bytes(rng, count, length, table):
+    return table[rng.integers(0, 256, size=(count, length), dtype=np.uint8)]
+
+
+def fastq_chunk(rng, first, count, read, length, umi_length=0):
+    """
+    Build count fastq records with fixed width headers as bytes.
+
+    Header: @SIM:1:FC0001:1:1101:XXXXXXX:YYYYYYY[:UMI] READ:N:0:1
+    Positions are derived from the record number so all files of a run agree.
+    """
+    numbers = np.arange(first, first + count)
+    columns = [
+        np.frombuffer(b"@SIM:1:FC0001:1:1101:", dtype=np.uint8),
+        digits(numbers // 10_000 + 1_000, 7),
+        np.frombuffer(b":", dtype=np.uint8),
+        digits(numbers % 10_000 + 1_000, 7),
+    ]
+    if umi_length:
+        columns += [
+            np.frombuffer(b":", dtype=np.uint8),
+            random_bytes(rng, count, umi_length, BASES),
+        ]
+    columns += [
+        np.frombuffer(f" {read}:N:0:1\n".encode(), dtype=np.uint8),
+        random_bytes(rng, count, length, BASES),
+        np.frombuffer(b"\n+\n", dtype=np.uint8),
+        random_bytes(rng, count, length, QUALITIES),
+        np.frombuffer(b"\n", dtype=np.uint8),
+    ]
+    columns = [np.broadcast_to(c, (count, c.shape[-1])) for c in columns]
+    return np.hstack(columns).tobytes()
+
+
+def write_synthetic_fastq(
+    path, reads, read=1, length=100, umi_length=0, seed=0, compresslevel=1
+):
+    """
+    Write a deterministic synthetic fastq.gz with reads records
+    """
+    rng = np.random.default_rng(seed)
+    with gzip.open(path, "wb", compresslevel=compresslevel) as f_out:
+        for first in range(0, reads, CHUNK_READS):
+            count = min(CHUNK_READS, reads - first)
+            f_out.write(fastq_chunk(rng, first, count, read, length, umi_length))
+    return Path(path)
+
+
+def write_synthetic_run(
+    outdir, reads, mode="single", length=100, index_length=8, seed=0
+):
+    """
+    Write the fastq.gz files of a synthetic run in outdir.
+
+    mode:
+    single: R1
+    pair: R1 and R2
+    dual_index: R1, I1, I2 and R2
+    umi: R1 with UMI in the sequence description
+
+    Return a dict with the paths of r1, r2, i1 and i2 (None if not written)
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown synthetic mode {mode}, use one of {MODES}")
+    outdir = Path(outdir)
+    outdir.mkdir(exist_ok=True, parents=True)
+    _logger.info(f"Writing synthetic {mode} run with {reads} reads to {outdir}")
+
+    files = {"r1": None, "r2": None, "i1": None, "i2": None}
+    files["r1"] = write_synthetic_fastq(
+        outdir / "R1.fastq.gz",
+        reads,
+        1,
+        length,
+        umi_length=index_length if mode == "umi" else 0,
+        seed=seed,
+    )
+    if mode in ["pair", "dual_index"]:
+        files["r2"] = write_synthetic_fastq(
+            outdir / "R2.fastq.gz", reads, 2, length, seed=seed + 1
+        )
+    if mode == "dual_index":
+        files["i1"] = write_synthetic_fastq(
+            outdir / "I1.fastq.gz", reads, 1, index_length, seed=seed + 2
+        )
+        files["i2"] = write_synthetic_fastq(
+            outdir / "I2.fastq.gz", reads, 2, index_length, seed=seed + 3
+        )
+    return files
+
+
+def write_interleaved_fastq(path, r1, r2, compresslevel=1):
+    """
+    Write a fastq.gz with the records of r1 and r2 alternating (interleaved pairs)
+    """
+    with gzip.open(r1, "rb") as r1_in, gzip.open(r2, "rb") as r2_in:
+        with gzip.open(path, "wb", compresslevel=compresslevel) as f_out:
+            while True:
+                record_1 = b"".join(r1_in.readline() for _ in range(4))
+                if not record_1:
+                    break
+                f_out.write(record_1)
+                f_out.write(b"".join(r2_in.readline() for _ in range(4)))
+    return Path(path)
@@ -0,0 +1,192 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.batches import LANE, TILE, convert_batches
+
+_logger = logging.getLogger(__name__)
+
+# magic bytes of the table formats: parquet, arrow IPC file (and feather v2)
+TABLE_MAGIC = [(b"PAR1", "parquet"), (b"ARROW1", "arrow")]
+# arrow IPC streams have no magic bytes: recognized from their suffix
+STREAM_SUFFIXES = {".arrows"}
+# clusters of a record batch read from a table
+BATCH_SIZE = 65536
+# table columns of the segments: (sequence, quality), the quality is optional
+SEGMENT_COLUMNS = {
+    "R1": ("sequence", "quality"),
+    "I1": ("index1", "index1_quality"),
+    "I2": ("index2", "index2_quality"),
+    "R2": ("sequence2", "quality2"),
+}
+# table columns of the clusters metadata (all optional), filter is a pass filter flag
+METADATA_COLUMNS = ["lane", "tile", "x", "y", "filter"]
+
+
+def table_format(path):
+    """
+    Format of a read table from its first bytes (parquet or arrow) or its
+    suffix (arrow stream), None for other files (e.g. fastq)
+    """
+    path = Path(path)
+    if path.suffix in STREAM_SUFFIXES:
+        return "arrow_stream"
+    try:
+        with open(path, "rb") as f_in:
+            head = f_in.read(max(len(magic) for magic, _ in TABLE_MAGIC))
+    except OSError:
+        return None
+    for magic, name in TABLE_MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError(
+            "Arrow and Parquet inputs need the pyarrow package: "
+            "pip install fastq2bcl[arrow]"
+        )
+    return pyarrow
+
+
+def iter_record_batches(path, columns=None, batch_size=BATCH_SIZE):
+    """
+    Iterate the pyarrow record batches of a parquet file, an arrow IPC file
+    (feather v2) or an arrow IPC stream, reading only columns (None for all)
+    """
+    pa = import_pyarrow()
+    kind = table_format(path)
+    if kind == "parquet":
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        names = parquet_file.schema_arrow.names
+        selected = None if columns is None else [c for c in columns if c in names]
+        yield from parquet_file.iter_batches(batch_size, columns=selected)
+    elif kind in ("arrow", "arrow_stream"):
+        with pa.memory_map(str(path), "r") as source:
+            if kind == "arrow":
+                reader = pa.ipc.open_file(source)
+                batches = (
+                    reader.get_batch(n) for n in range(reader.num_record_batches)
+                )
+            else:
+                batches = pa.ipc.open_stream(source)
+            for batch in batches:
+                if columns is not None:
+                    batch = batch.select(
+                        [c for c in columns if c in batch.schema.names]
+                    )
+                yield batch
+    else:
+        raise ValueError(f"{path} is not a parquet or arrow file")
+
+
+def binary_buffers(array, name):
+    """
+    Flat uint8 array of the concatenated values of an arrow string or binary
+    array and the length of each value, without copies
+    """
+    pa = import_pyarrow()
+    if array.null_count:
+        raise ValueError(f"Column {name} has {array.null_count} null values")
+    if pa.types.is_fixed_size_binary(array.type):
+        width = array.type.byte_width
+        data = np.frombuffer(array.buffers()[1], dtype=np.uint8)
+        start = array.offset * width
+        lengths = np.full(len(array), width, dtype=np.int32)
+        return data[start : start + width * len(array)], lengths
+    if pa.types.is_string(array.type) or pa.types.is_binary(array.type):
+        offset_type = np.int32
+    elif pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type):
+        offset_type = np.int64
+    else:
+        raise ValueError(f"Column {name} is {array.type}, not a string column")
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=offset_type)[
+        array.offset : array.offset + len(array) + 1
+    ]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.zeros(0)
+    return data[offsets[0] : offsets[-1]], np.diff(offsets).astype(np.int32)
+
+
+def single_value(array, name, expected):
+    """
+    The value of a lane or tile column, ValueError if it is not expected
+    """
+    values = np.unique(array.to_numpy(zero_copy_only=False))
+    if values.tolist() not in ([], [expected]):
+        raise ValueError(
+            f"Only {name} {expected} is supported, found {values.tolist()}"
+        )
+    return expected
+
+
+def table_batch(batch):
+    """
+    Batch of encode inputs (see batches.read_batches) of a pyarrow record
+    batch with the columns of SEGMENT_COLUMNS and METADATA_COLUMNS. Other
+    columns (e.g. the read name) are not read: nothing is parsed from names
+    """
+    names = batch.schema.names
+    result = {}
+    for segment, (sequence, quality) in SEGMENT_COLUMNS.items():
+        if sequence not in names:
+            continue
+        bases, lengths = binary_buffers(batch.column(sequence), sequence)
+        phred = None
+        if quality in names:
+            quals, quality_lengths = binary_buffers(batch.column(quality), quality)
+            if not np.array_equal(lengths, quality_lengths):
+                raise ValueError(f"Columns {sequence} and {quality} differ in length")
+            phred = quals - 33
+        result[segment] = (bases, phred, lengths)
+
+    metadata = {name: batch.column(name) for name in METADATA_COLUMNS if name in names}
+    if "lane" in metadata:
+        result["lane"] = single_value(metadata["lane"], "lane", LANE)
+    if "tile" in metadata:
+        result["tile"] = single_value(metadata["tile"], "tile", TILE)
+    if "x" in metadata and "y" in metadata:
+        result["positions"] = np.stack(
+            [
+                metadata["x"].to_numpy(zero_copy_only=False),
+                metadata["y"].to_numpy(zero_copy_only=False),
+            ],
+            axis=1,
+        )
+    elif "x" in metadata or "y" in metadata:
+        raise ValueError("Tables need both x and y columns, or none")
+    if "filter" in metadata:
+        result["filter"] = metadata["filter"].to_numpy(zero_copy_only=False)
+    return result
+
+
+def read_table_batches(path, batch_size=BATCH_SIZE):
+    """
+    Iterate the batches (see table_batch) of a read table
+    """
+    columns = [c for pair in SEGMENT_COLUMNS.values() for c in pair]
+    columns += METADATA_COLUMNS
+    count = 0
+    for batch in iter_record_batches(path, columns, batch_size):
+        yield table_batch(batch)
+        count += batch.num_rows
+    _logger.info(f"Read {count} clusters from {path}")
+
+
+def convert_table(outdir, path, batch_size=BATCH_SIZE, **options):
+    """
+    Write a run directory from a parquet or arrow read table, without fastq
+    files: sequence and quality columns are encoded from the arrow buffers,
+    positions and pass filter flags come from the x, y and filter columns.
+    options: see batches.convert_batches
+
+    Return a tuple (run_id, rundir, mask_string)
+    """
+    return convert_batches(outdir, read_table_batches(path, batch_size), **options)
@@ -0,0 +1,225 @@
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from fastq2bcl.bcl import (
+    HEADER_SIZE,
+    decode_cluster,
+    read_run,
+    read_run_info,
+    run_tiles,
+)
+from fastq2bcl.layout import BCL_HEADER_SIZE
+from fastq2bcl.intermediate import read_clusters
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.writer import encode_locs, get_output_sizes, tile_files
+
+_logger = logging.getLogger(__name__)
+
+# clusters decoded in the report for each kind of difference
+MAX_EXAMPLES = 10
+
+
+def compare(report, name, found, expected):
+    """
+    Compare two arrays with one record (or row) per cluster, add the number of
+    differing clusters to report["differences"][name].
+    Return the indices of the first MAX_EXAMPLES differing clusters.
+    """
+    if np.array_equal(found, expected):
+        return []
+    differ = np.asarray(found) != np.asarray(expected)
+    if differ.ndim > 1:
+        differ = differ.any(axis=tuple(range(1, differ.ndim)))
+    clusters = np.flatnonzero(differ)
+    report["differences"][name] = len(clusters)
+    return clusters[:MAX_EXAMPLES].tolist()
+
+
+def verify_run(
+    rundir,
+    r1,
+    r2=None,
+    i1=None,
+    i2=None,
+    exclude_umi=False,
+    exclude_index=False,
+    intermediate=None,
+    sampling=None,
+    interleaved=False,
+    validate="batched",
+    filter_flags=None,
+    timer=None,
+):
+    """
+    Decode a run directory written by fastq2bcl and compare it with the clusters
+    of its fastq inputs, without bcl2fastq.
+
+    Bcl, filter, control and locs files of all the tiles (e.g. of a merged run)
+    are mapped (see bcl.read_run) and
+    compared cycle by cycle with the clusters read from the inputs (the same
+    options of the conversion: exclude_umi, exclude_index, sampling, interleaved).
+    An intermediate directory (see read_clusters) skips the fastq parsing.
+    filter_flags: expected pass filter flags, None for all passing
+
+    Return a dict with clusters, cycles, differences (differing clusters of each
+    file) and examples (fastq-equivalent reads of some differing clusters)
+    """
+    if timer is None:
+        timer = StageTimer()
+    rundir = Path(rundir)
+    clusters, positions = read_clusters(
+        r1,
+        r2,
+        i1,
+        i2,
+        exclude_umi,
+        exclude_index,
+        intermediate,
+        sampling,
+        timer,
+        interleaved,
+        validate,
+    )
+    with timer.stage("verify.map"):
+        run = read_run(rundir)
+    cycles, cluster_count = clusters.shape
+    report = {
+        "rundir": str(rundir),
+        "clusters": run["cluster_count"],
+        "cycles": len(run["bcl"]),
+        "differences": {},
+        "examples": [],
+    }
+    if run["cluster_count"] != cluster_count:
+        report["differences"]["cluster_count"] = abs(
+            run["cluster_count"] - cluster_count
+        )
+        report["ok"] = False
+        return report
+    if len(run["bcl"]) != cycles:
+        report["differences"]["cycles"] = abs(len(run["bcl"]) - cycles)
+    run_info_cycles = sum(read["cycles"] for read in run["reads"])
+    if run_info_cycles > len(run["bcl"]):
+        report["differences"]["RunInfo.xml"] = run_info_cycles - len(run["bcl"])
+
+    with timer.stage("verify.compare", cycles * cluster_count):
+        examples = set()
+        for cycle, data in enumerate(run["bcl"][:cycles]):
+            examples.update(compare(report, f"C{cycle + 1}.1", data, clusters[cycle]))
+        if filter_flags is None:
+            filter_flags = np.ones(cluster_count, dtype=np.uint8)
+        compare(report, "filter", run["filter"], np.asarray(filter_flags, np.uint8))
+        compare(report, "control", run["control"], np.zeros(cluster_count, "<u2"))
+        locs = np.frombuffer(encode_locs(positions), dtype="<f4").reshape(-1, 2)
+        compare(report, "locs", run["locs"], locs)
+
+    expected = {"reads": run["reads"], "bcl": list(clusters)}
+    for cluster in sorted(examples)[:MAX_EXAMPLES]:
+        report["examples"].append(
+            {
+                "cluster": cluster,
+                "expected": decode_cluster(expected, cluster),
+                "found": decode_cluster(run, cluster),
+            }
+        )
+    report["ok"] = not report["differences"]
+    _logger.info(f"Verified {rundir}: {report['differences'] or 'no differences'}")
+    return report
+
+
+def read_header_count(path, header_size):
+    """
+    Size of a file and the cluster count at the end of its header, reading only
+    the header. count is None when the file is shorter than its header.
+    """
+    with open(path, "rb") as f_in:
+        size = os.fstat(f_in.fileno()).st_size
+        header = f_in.read(header_size)
+    if len(header) < header_size:
+        return size, None
+    return size, struct.unpack_from("<I", header, header_size - 4)[0]
+
+
+def check_run(rundir, workers=4, checksums=False):
+    """
+    Check the structure of a run directory without reading the bcl payloads:
+    RunInfo.xml cycles match the cycle directories, filter, control, locs and
+    bcl header counts of each tile agree and every file has the size of its
+    cluster count.
+    Files are checked by a pool of workers threads (stat and header reads).
+    checksums: also check the files against the checksum file of the run,
+    if any (reads all the files, see checksums.verify_checksums)
+
+    Return the list of problems (empty for a valid run)
+    """
+    from fastq2bcl.checksums import verify_checksums
+
+    rundir = Path(rundir)
+    basecalls = rundir / "Data/Intensities/BaseCalls/L001"
+    problems = []
+    try:
+        cycles = sum(read["cycles"] for read in read_run_info(rundir))
+    except (OSError, ValueError) as error:
+        return [f"RunInfo.xml: {error}"]
+    cycle_dirs = [p for p in basecalls.glob("C*.1") if p.is_dir()]
+    if len(cycle_dirs) != cycles:
+        problems.append(
+            f"RunInfo.xml has {cycles} cycles, {len(cycle_dirs)} cycle directories"
+        )
+
+    # relative path: (header size, kind, tile)
+    files = {}
+    for tile in run_tiles(rundir):
+        for kind, relpath in tile_files(tile).items():
+            files[relpath] = (HEADER_SIZE, kind, tile)
+        for cycle in range(max(cycles, len(cycle_dirs))):
+            cycledir = f"Data/Intensities/BaseCalls/L001/C{cycle + 1}.1"
+            files[f"{cycledir}/s_1_{tile}.bcl"] = (BCL_HEADER_SIZE, "bcl", tile)
+            files[f"{cycledir}/s_1_{tile}.stats"] = (None, "stats", tile)
+
+    def inspect(relpath):
+        header_size = files[relpath][0]
+        try:
+            if header_size is None:
+                return (rundir / relpath).stat().st_size, None
+            return read_header_count(rundir / relpath, header_size)
+        except OSError:
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(files, pool.map(inspect, files)))
+
+    # cluster count of each tile from its filter file
+    counts = {}
+    for relpath, (_, kind, tile) in files.items():
+        if kind == "filter":
+            counts[tile] = results[relpath][1]
+            if counts[tile] is None:
+                problems.append(f"{relpath}: missing or truncated header")
+                counts[tile] = 0
+    for relpath, (size, count) in results.items():
+        _, kind, tile = files[relpath]
+        cluster_count = counts[tile]
+        sizes = get_output_sizes(cluster_count)
+        if size is None:
+            problems.append(f"{relpath}: missing")
+            continue
+        if kind != "stats" and count != cluster_count:
+            problems.append(f"{relpath}: header count {count}, filter {cluster_count}")
+        if size != sizes[kind]:
+            problems.append(f"{relpath}: {size} bytes, expected {sizes[kind]}")
+
+    if checksums:
+        differ = verify_checksums(rundir, workers)
+        if differ is None:
+            problems.append("no checksum file")
+        else:
+            problems += [f"{relpath}: checksum differs" for relpath in differ]
+    for problem in problems:
+        _logger.warning(problem)
+    return problems
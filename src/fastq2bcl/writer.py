@@ -2,29 +2,51 @@ import logging
 import struct
 from pathlib import Path
 
+import numpy as np
+
+# names and sizes of the run files are defined in runfiles (without numpy)
+from fastq2bcl.runfiles import (  # noqa: F401
+    CONTROL_FILE,
+    FILTER_FILE,
+    FORMAT_VERSION,
+    LOCS_FILE,
+    STATS_SIZE,
+    TILE,
+    get_output_sizes,
+    open_new,
+    tile_files,
+)
+
 _logger = logging.getLogger(__name__)
 
 
-def write_run_info_xml(rundir, run_id, run_number, flowcell_id, instrument, mask):
+def write_run_info_xml(
+    rundir, run_id, run_number, flowcell_id, instrument, mask, tile_count=1
+):
     """
     Write RunInfo.xml
     """
 
-    runinfo = generate_run_info_xml(run_id, run_number, flowcell_id, instrument, mask)
+    runinfo = generate_run_info_xml(
+        run_id, run_number, flowcell_id, instrument, mask, tile_count
+    )
     _logger.info(f"RunInfo.xml:\n{runinfo}")
 
     # Create directory and write file
     xmlout = Path.joinpath(rundir, "RunInfo.xml")
     xmlout.parent.mkdir(exist_ok=True, parents=True)
-    with open(xmlout, "wt") as f_out:
+    with open_new(xmlout, "wt") as f_out:
         f_out.write(runinfo)
 
     return runinfo
 
 
-def generate_run_info_xml(run_id, run_number, flowcell_id, instrument, mask):
+def generate_run_info_xml(
+    run_id, run_number, flowcell_id, instrument, mask, tile_count=1
+):
     """
     Generate a valid Runinfo xml file.
+    tile_count: tiles of lane 1 (1101, 1102, ...)
     """
 
     # check mask and write mask
@@ -41,37 +63,57 @@ def generate_run_info_xml(run_id, run_number, flowcell_id, instrument, mask):
         <Reads>
             { xml_mask }
         </Reads>
-        <FlowcellLayout LaneCount="1" SurfaceCount="1" SwathCount="1" TileCount="1" />
+        <FlowcellLayout LaneCount="1" SurfaceCount="1" SwathCount="1" TileCount="{tile_count}" />
     </Run>
 </RunInfo>
 """
     return xml
 
 
-def write_filter(rundir, cluster_count):
+def filter_chunks(cluster_count, flags=None):
+    """
+    Content of the filter file as a list of buffers (header and flags).
+    flags: pass filter flag (1 pass, 0 filtered) of each cluster, None for all passing
+    """
+    header = bytes([0, 0, 0, 0, 3, 0, 0, 0]) + struct.pack("<I", cluster_count)
+    if flags is None:
+        return [header, b"\x01" * cluster_count]
+    return [header, memoryview(np.asarray(flags, dtype=bool).astype(np.uint8))]
+
+
+def write_filter(rundir, cluster_count, flags=None):
     """
-    Write filter
+    Write filter.
+    flags: pass filter flag (1 pass, 0 filtered) of each cluster, None for all passing
     """
-    path = rundir / "Data/Intensities/BaseCalls/L001/s_1_1101.filter"
+    path = rundir / FILTER_FILE
     path.parent.mkdir(exist_ok=True, parents=True)
-    with open(path, "wb") as f_out:
-        f_out.write(bytes([0, 0, 0, 0]))
-        f_out.write(bytes([3, 0, 0, 0]))
-        f_out.write(struct.pack("<I", cluster_count))
-        f_out.write(bytes([1] * cluster_count))
+    with open_new(path) as f_out:
+        for chunk in filter_chunks(cluster_count, flags):
+            f_out.write(chunk)
+
+
+def control_chunks(cluster_count):
+    """
+    Content of the control file as a list of buffers
+    """
+    return [
+        bytes([0, 0, 0, 0]),  # "Zero value (for backwards compatibility)"
+        bytes([2, 0, 0, 0]),  # "Format version number"
+        struct.pack("<I", cluster_count),  # "Number of clusters"
+        bytes(2 * cluster_count),  # two bytes for each cluster
+    ]
 
 
 def write_control(rundir, cluster_count):
     """
     Write control file
     """
-    path = rundir / "Data/Intensities/BaseCalls/L001/s_1_1101.control"
+    path = rundir / CONTROL_FILE
     path.parent.mkdir(exist_ok=True, parents=True)
-    with open(path, "wb") as f_out:
-        f_out.write(bytes([0, 0, 0, 0]))  # "Zero value (for backwards compatibility)"
-        f_out.write(bytes([2, 0, 0, 0]))  # "Format version number"
-        f_out.write(struct.pack("<I", cluster_count))  # "Number of clusters"
-        f_out.write(bytes([0, 0] * cluster_count))  # two bytes for each cluster
+    with open_new(path) as f_out:
+        for chunk in control_chunks(cluster_count):
+            f_out.write(chunk)
 
 
 def write_locs(outdir, positions):
@@ -99,13 +141,30 @@ def write_locs(outdir, positions):
     #     /// \brief y-coordinate.
     #     float y_;
     # }
-    path = Path(outdir) / "Data/Intensities/L001/s_1_1101.locs"
+    path = Path(outdir) / LOCS_FILE
     path.parent.mkdir(exist_ok=True, parents=True)
-    with open(path, "wb") as f_out:
-        f_out.write(bytes([1, 0, 0, 0, 0, 0, 0x80, 0x3F]))
-        f_out.write(struct.pack("<I", len(positions)))
-        for position in positions:
-            f_out.write(encode_loc_bytes(position[0], position[1]))
+    with open_new(path) as f_out:
+        for chunk in locs_chunks(positions):
+            f_out.write(chunk)
+
+
+def locs_chunks(positions):
+    """
+    Content of the locs file as a list of buffers (see write_locs)
+    """
+    return [
+        bytes([1, 0, 0, 0, 0, 0, 0x80, 0x3F]),
+        struct.pack("<I", len(positions)),
+        encode_locs(positions),
+    ]
+
+
+def encode_locs(positions):
+    """
+    Vectorized encode_loc_bytes for a list (or array) of x and y positions
+    """
+    positions = np.asarray(positions).astype(np.int64).reshape(-1, 2)
+    return ((positions - 1000) / 10).astype("<f4").tobytes()
 
 
 def encode_loc_bytes(x_pos, y_pos):
@@ -133,6 +192,27 @@ def encode_cluster_byte(base, qual):
     return bytes([qual | base])
 
 
+# bcl base code for each ascii byte, 4 for a no-call
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(b"ACGT"):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def encode_bcl_bytes(bases, quals):
+    """
+    Vectorized encode_cluster_byte.
+
+    bases: uint8 array of ascii bases
+    quals: uint8 array of phred qualities (values above 63 are clipped)
+    Return an uint8 array of bcl bytes, 0 for no-call.
+    """
+    codes = BASE_CODES[bases]
+    encoded = (np.minimum(quals, 63).astype(np.uint8) << 2) | (codes & 3)
+    encoded[codes == 4] = 0
+    return encoded
+
+
 def init_bcl_and_write_cluster_counts(cycledir, cluster_count, filename="s_1_1101.bcl"):
     """
     Create bcl file and write cluster count
@@ -168,6 +248,51 @@ def write_cycle(context, progress, task_id):
     write_stat_file(cycledir / "s_1_1101.stats")
 
 
+def bcl_chunks(cluster_count, column):
+    """
+    Content of the bcl file of a cycle as a list of buffers (cluster count
+    header and the column of encoded bcl bytes, without copies)
+    """
+    return [
+        struct.pack("<I", cluster_count),
+        memoryview(np.ascontiguousarray(column, dtype=np.uint8)),
+    ]
+
+
+def tile_members(clusters, positions, filter_flags=None, tile=TILE):
+    """
+    Files of a tile in the order they are written: filter, control, locs,
+    then bcl and stats of each cycle.
+
+    Yield tuples (path relative to the run directory, list of buffers)
+    """
+    cycles, cluster_count = clusters.shape
+    files = tile_files(tile)
+    yield files["filter"], filter_chunks(cluster_count, filter_flags)
+    yield files["control"], control_chunks(cluster_count)
+    yield files["locs"], locs_chunks(positions)
+    for cycle in range(cycles):
+        cycledir = f"Data/Intensities/BaseCalls/L001/C{cycle+1}.1"
+        yield f"{cycledir}/s_1_{tile}.bcl", bcl_chunks(cluster_count, clusters[cycle])
+        yield f"{cycledir}/s_1_{tile}.stats", [bytes(STATS_SIZE)]
+
+
+def write_cycle_column(cycle, cluster_count, outdir, column):
+    """
+    Write the bcl and stats files of a cycle from a column of encoded bcl bytes
+    """
+    cycledir = get_cycle_dir(outdir, cycle)
+    _logger.info(
+        f"Writing {cluster_count} clusters for cycle: {cycle+1} to dir {cycledir}"
+    )
+    with open(cycledir / "s_1_1101.bcl", "wb") as f_out:
+        for chunk in bcl_chunks(cluster_count, column):
+            f_out.write(chunk)
+
+    # write stats
+    write_stat_file(cycledir / "s_1_1101.stats")
+
+
 def write_bcl_and_stats(cycle, cluster_count, outdir, sequences):
     """
     Single process mode to write bcls
@@ -193,7 +318,7 @@ def write_bcl_and_stats(cycle, cluster_count, outdir, sequences):
 def write_stat_file(filename):
     with open(filename, "wb") as f_out:
         # can I get away with this?
-        f_out.write(bytes([0] * 108))
+        f_out.write(bytes([0] * STATS_SIZE))
 
 
 def append_data_to_bcl(base, quality, filename):
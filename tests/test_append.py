@@ -0,0 +1,102 @@
+import gzip
+import shutil
+
+import pytest
+
+from fastq2bcl.checksums import find_checksums
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.manifest import MANIFEST_FILENAME
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.verify import check_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def split_fastq(path, records, first, rest):
+    """Write the first records of a fastq.gz to first, the others to rest"""
+    lines = gzip.decompress(path.read_bytes()).splitlines(keepends=True)
+    first.write_bytes(gzip.compress(b"".join(lines[: 4 * records])))
+    rest.write_bytes(gzip.compress(b"".join(lines[4 * records :])))
+
+
+def split_run(files, tmp_path, records):
+    parts = ({}, {})
+    for name, path in files.items():
+        if path is None:
+            continue
+        parts[0][name] = tmp_path / f"first_{path.name}"
+        parts[1][name] = tmp_path / f"rest_{path.name}"
+        split_fastq(path, records, parts[0][name], parts[1][name])
+    return parts
+
+
+def run_files(rundir):
+    return {
+        path.relative_to(rundir).as_posix(): path.read_bytes()
+        for path in rundir.rglob("*")
+        if path.is_file() and path.name != MANIFEST_FILENAME
+    }
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_append_matches_full_run(tmp_path, threads):
+    files = write_synthetic_run(tmp_path / "input", 50, "dual_index", length=10)
+    first, rest = split_run(files, tmp_path, 30)
+    (tmp_path / "full").mkdir()
+    (tmp_path / "topup").mkdir()
+    _, full_rundir, _, _ = fastq2bcl(tmp_path / "full", **files)
+    _, rundir, _, _ = fastq2bcl(tmp_path / "topup", **first, checksum="md5")
+
+    _, appended, _, _ = fastq2bcl(
+        tmp_path / "unused", **rest, append=rundir, threads=threads, check=True
+    )
+    assert appended == rundir
+    assert find_checksums(rundir) == (None, None)
+    assert run_files(rundir) == run_files(full_rundir)
+    assert check_run(rundir) == []
+
+
+def test_append_leaves_cache_links(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 40, "pair", length=8)
+    first, rest = split_run(files, tmp_path, 25)
+    cache_dir = tmp_path / "cache"
+    _, rundir, _, _ = fastq2bcl(tmp_path, **first, cache_dir=cache_dir)
+    cached = {
+        path: path.read_bytes() for path in cache_dir.rglob("*.bcl") if path.is_file()
+    }
+    shutil.rmtree(rundir)
+    fastq2bcl(tmp_path, **first, cache_dir=cache_dir, cache_mode="link")
+    bcl = rundir / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    assert bcl.stat().st_nlink == 2
+
+    fastq2bcl(tmp_path, **rest, append=rundir)
+    assert bcl.stat().st_nlink == 1
+    assert len(bcl.read_bytes()) == 4 + 40
+    assert {path: path.read_bytes() for path in cached} == cached
+
+
+def test_append_rejects_other_mask(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=8)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **files)
+    before = run_files(rundir)
+    with pytest.raises(ValueError, match="Can not append 8N8N8N reads"):
+        fastq2bcl(tmp_path, **files, mask_string="8N8N8N", append=rundir)
+    with pytest.raises(ValueError, match="--resume"):
+        fastq2bcl(tmp_path, **files, append=rundir, resume=True)
+    (rundir / "Data/Intensities/L001/s_1_1101.locs").write_bytes(b"")
+    with pytest.raises(ValueError, match="missing or truncated|locs"):
+        fastq2bcl(tmp_path, **files, append=rundir)
+    assert run_files(rundir)["RunInfo.xml"] == before["RunInfo.xml"]
+
+
+def test_append_usage(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "single", length=8)
+    first, rest = split_run(files, tmp_path, 12)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **first)
+    main(["-r1", str(rest["r1"]), "--append", str(rundir), "--checksums", "blake2"])
+    assert find_checksums(rundir)[0] == "blake2"
+    assert len(
+        (rundir / "Data/Intensities/BaseCalls/L001/s_1_1101.filter").read_bytes()
+    ) == (12 + 20)
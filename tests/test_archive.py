@@ -0,0 +1,95 @@
+import io
+import tarfile
+
+import pytest
+
+from fastq2bcl.archive import tar_compression
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.manifest import MANIFEST_FILENAME
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def run_files(rundir):
+    return {
+        path.relative_to(rundir.parent).as_posix(): path.read_bytes()
+        for path in rundir.rglob("*")
+        if path.is_file() and path.name != MANIFEST_FILENAME
+    }
+
+
+def tar_files(archive):
+    with tarfile.open(fileobj=archive, mode="r|*") as tar:
+        return {
+            member.name: tar.extractfile(member).read()
+            for member in tar
+            if member.isfile()
+        }
+
+
+def test_tar_compression():
+    assert tar_compression("run.tar") == "none"
+    assert tar_compression("run.tar.gz") == "gzip"
+    assert tar_compression("run.tgz") == "gzip"
+    assert tar_compression("run.tar.zst") == "zstd"
+    assert tar_compression("-") == "none"
+
+
+@pytest.mark.parametrize("name", ["run.tar", "run.tar.gz", "run.tar.zst"])
+def test_tar_matches_rundir(tmp_path, name):
+    if name.endswith(".zst"):
+        zstandard = pytest.importorskip("zstandard")
+    files = write_synthetic_run(tmp_path / "input", 30, "dual_index", length=10)
+    (tmp_path / "out").mkdir()
+    _, rundir, _, _ = fastq2bcl(tmp_path / "out", **files)
+
+    _, archive, _, _ = fastq2bcl(tmp_path / "missing", **files, tar=tmp_path / name)
+    assert archive == tmp_path / name
+    assert not (tmp_path / "missing").exists()
+    data = archive.read_bytes()
+    if name.endswith(".zst"):
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    assert tar_files(io.BytesIO(data)) == run_files(rundir)
+
+
+def test_tar_stdout(tmp_path, capsysbinary):
+    files = write_synthetic_run(tmp_path / "input", 10, "pair", length=8)
+    main(
+        [
+            "--tar",
+            "-",
+            "--tar-compression",
+            "gzip",
+            "-r1",
+            str(files["r1"]),
+            "-r2",
+            str(files["r2"]),
+        ]
+    )
+    archive = capsysbinary.readouterr().out
+    names = list(tar_files(io.BytesIO(archive)))
+    assert names[0].endswith("/RunInfo.xml")
+    assert names[-1].endswith("/C16.1/s_1_1101.stats")
+
+
+def test_tar_rejects_checksums(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 10, "single", length=8)
+    with pytest.raises(ValueError, match="--tar"):
+        fastq2bcl(tmp_path, **files, tar=tmp_path / "run.tar", checksum="md5")
+
+
+def test_tar_failure_leaves_no_archive(tmp_path, monkeypatch):
+    """a failed archive is not published and its staging file is removed"""
+    files = write_synthetic_run(tmp_path / "input", 10, "single", length=8)
+
+    def failing_members(*args):
+        yield "RunInfo.xml", [b"<RunInfo/>"]
+        raise OSError("disk full")
+
+    monkeypatch.setattr("fastq2bcl.archive.run_members", failing_members)
+    with pytest.raises(OSError, match="disk full"):
+        fastq2bcl(tmp_path, **files, tar=tmp_path / "run.tar")
+    assert list(tmp_path.glob("*run.tar*")) == []
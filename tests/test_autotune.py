@@ -0,0 +1,94 @@
+import pytest
+
+from fastq2bcl import autotune as autotune_module
+from fastq2bcl.autotune import (
+    AdaptiveLimit,
+    autotune,
+    available_cpus,
+    cgroup_cpu_limit,
+    cgroup_memory_limit,
+    probe_write_throughput,
+)
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def cgroup_v2(tmp_path):
+    root = tmp_path / "v2"
+    root.mkdir()
+    (root / "cpu.max").write_text("250000 100000\n")
+    (root / "memory.max").write_text("1073741824\n")
+    return root
+
+
+@pytest.fixture
+def cgroup_v1(tmp_path):
+    root = tmp_path / "v1"
+    (root / "cpu").mkdir(parents=True)
+    (root / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+    (root / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+    (root / "memory").mkdir()
+    (root / "memory" / "memory.limit_in_bytes").write_text(f"{1 << 62}\n")
+    return root
+
+
+def test_cgroup_limits(cgroup_v2, cgroup_v1):
+    assert cgroup_cpu_limit(cgroup_v2) == 2.5
+    assert cgroup_memory_limit(cgroup_v2) == 1 << 30
+    assert cgroup_cpu_limit(cgroup_v1) is None
+    assert cgroup_memory_limit(cgroup_v1) is None
+    (cgroup_v1 / "cpu" / "cpu.cfs_quota_us").write_text("50000\n")
+    assert cgroup_cpu_limit(cgroup_v1) == 0.5
+    assert available_cpus(cgroup_v1) == 1
+
+
+def test_probe_write_throughput(tmp_path):
+    assert probe_write_throughput(tmp_path, 2, size=2 * 1024 * 1024) > 0
+    # the probe file is removed
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_probe_write_throughput_without_pwrite(tmp_path, monkeypatch):
+    """windows: the probe writes its blocks with the seek and write fallback"""
+    monkeypatch.delattr(autotune_module.os, "pwrite")
+    assert probe_write_throughput(tmp_path, 2, size=2 * 1024 * 1024) > 0
+
+
+def test_autotune(tmp_path, cgroup_v2, monkeypatch):
+    monkeypatch.setattr(autotune_module, "available_cpus", lambda root: 8)
+    # throughput scales up to 4 writers
+    rates = {1: 100e6, 2: 190e6, 4: 300e6, 8: 310e6}
+    monkeypatch.setattr(
+        autotune_module,
+        "probe_write_throughput",
+        lambda outdir, workers: rates[workers],
+    )
+    decision = autotune(tmp_path, 10**6, 100, root=cgroup_v2)
+    assert decision["threads"] == 4
+    assert decision["executor"] == "threads"
+    assert decision["block_clusters"] == int(300e6 * 0.05)
+    assert sorted(decision["probes"]) == [1, 2, 4, 8]
+
+    assert autotune(tmp_path, 10**6, 100, "processes")["executor"] == "processes"
+    # blocks in flight bounded by the memory limit
+    (cgroup_v2 / "memory.max").write_text("100000000\n")
+    assert autotune(tmp_path, 10**6, 100, root=cgroup_v2)["block_clusters"] == 2500000
+    # nothing to write: no probe
+    assert autotune(tmp_path, 0, 100, root=cgroup_v2)["threads"] == 1
+
+
+def test_adaptive_limit():
+    limiter = AdaptiveLimit(4, window=2)
+    assert limiter.update(1.0) == 4
+    assert limiter.update(1.0) == 4
+    # latency climbs
+    limiter.update(3.0)
+    assert limiter.update(3.0) == 3
+    limiter.update(3.0)
+    assert limiter.update(3.0) == 2
+    # latency recovers
+    limiter.update(1.0)
+    assert limiter.update(1.0) == 3
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from fastq2bcl.batches import (
+    convert_batches,
+    encode_segment,
+    mask_from_columns,
+    read_batches,
+)
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.parser import parse_seqdesc_fields
+from fastq2bcl.reader import iter_fastq_records
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.writer import FILTER_FILE
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_encode_segment():
+    encoded, lengths = encode_segment(["ACG", "T"], ["III", "#"])
+    assert lengths.tolist() == [3, 1]
+    assert encoded.tolist() == [[160, 161, 162], [11, 0, 0]]
+
+    bases = np.frombuffer(b"ACGN", dtype=np.uint8).reshape(1, 4)
+    encoded, lengths = encode_segment(bases, np.full((1, 4), 40, dtype=np.uint8))
+    assert encoded.tolist() == [[160, 161, 162, 0]]
+    # default quality
+    assert encode_segment(bases)[0].tolist() == encoded.tolist()
+
+    with pytest.raises(ValueError):
+        encode_segment(["ACG"], ["II"])
+
+
+def test_read_batches():
+    columns = read_batches(
+        [
+            {"R1": ["ACGT", "AC"], "I1": ["GG", "TT"]},
+            {"R1": ["ACGTAC"], "I1": ["CC"], "filter": [0], "positions": [[5, 6]]},
+        ]
+    )
+    assert columns["R1"].shape == (3, 6)
+    assert columns["R1_lengths"].tolist() == [4, 2, 6]
+    assert columns["filter"].tolist() == [1, 1, 0]
+    assert columns["positions"].tolist() == [[1000, 1000], [1000, 1001], [5, 6]]
+    assert mask_from_columns(columns) == "6N2Y"
+
+
+def test_read_batches_errors():
+    with pytest.raises(ValueError):
+        read_batches([{"R1": ["A"], "lane": 2}])
+    with pytest.raises(ValueError):
+        read_batches([{"R1": ["A"]}, {"R1": ["A"], "R2": ["A"]}])
+    with pytest.raises(ValueError):
+        read_batches([{"I1": ["A"]}])
+    with pytest.raises(ValueError):
+        read_batches([{"R1": ["A", "C"], "R2": ["A"]}])
+
+
+def fastq_batches(files, size):
+    """batches of the records of fastq files, with their positions"""
+    names = [n for n in ["R1", "I1", "I2", "R2"] if files[n.lower()] is not None]
+    records = list(iter_fastq_records(**files))
+    for first in range(0, len(records), size):
+        chunk = records[first : first + size]
+        batch = {
+            name: ([r[i][1] for r in chunk], [r[i][2] for r in chunk])
+            for i, name in enumerate(names)
+        }
+        fields = [parse_seqdesc_fields(r[0][0]) for r in chunk]
+        batch["positions"] = [(int(f["x_pos"]), int(f["y_pos"])) for f in fields]
+        yield batch
+
+
+def test_convert_batches_as_fastq2bcl(tmp_path):
+    """same run from fastq files and from batches of their records"""
+    files = write_synthetic_run(tmp_path / "input", 50, "dual_index", length=12)
+    (tmp_path / "fastq").mkdir()
+    _, fastq_rundir, _, fastq_mask = fastq2bcl(tmp_path / "fastq", **files)
+
+    run_id, rundir, mask = convert_batches(
+        tmp_path / "batches", fastq_batches(files, 16), threads=2
+    )
+    assert run_id == "YYMMDD_SIM_0001_FC0001"
+    assert mask == fastq_mask
+    outputs = sorted(
+        p.relative_to(fastq_rundir)
+        for p in fastq_rundir.rglob("*")
+        if p.is_file() and p.suffix != ".json"
+    )
+    # bcl and stats of 40 cycles, RunInfo.xml, filter, control and locs
+    assert len(outputs) == 2 * 40 + 4
+    for path in outputs:
+        assert (rundir / path).read_bytes() == (fastq_rundir / path).read_bytes()
+
+
+def test_convert_batches_filter(tmp_path):
+    bases = np.full((3, 4), ord("A"), dtype=np.uint8)
+    _, rundir, mask = convert_batches(
+        tmp_path, [{"R1": bases, "filter": np.array([True, False, True])}]
+    )
+    assert mask == "4N"
+    assert (rundir / FILTER_FILE).read_bytes()[12:] == b"\x01\x00\x01"
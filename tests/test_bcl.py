@@ -0,0 +1,77 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from fastq2bcl.bcl import (
+    decode_bcl_bytes,
+    decode_cluster,
+    find_cycle_bcls,
+    read_bcl,
+    read_run,
+    read_run_info,
+)
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.writer import encode_bcl_bytes
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def run(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 30, "dual_index", length=6)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **files)
+    return files, rundir
+
+
+def test_decode_bcl_bytes():
+    bases = np.frombuffer(b"ACGTNa", dtype=np.uint8)
+    quals = np.array([2, 12, 23, 37, 30, 63], dtype=np.uint8)
+    decoded_bases, decoded_quals = decode_bcl_bytes(encode_bcl_bytes(bases, quals))
+    assert decoded_bases.tobytes() == b"ACGTNA"
+    assert decoded_quals.tolist() == [2, 12, 23, 37, 0, 63]
+
+
+def test_read_run(run):
+    files, rundir = run
+    mapped = read_run(rundir)
+    assert mapped["cluster_count"] == 30
+    assert mapped["tiles"] == [1101]
+    assert len(mapped["bcl"]) == 6 + 8 + 8 + 6
+    assert [read["cycles"] for read in read_run_info(rundir)] == [6, 8, 8, 6]
+    assert isinstance(mapped["bcl"][0], np.memmap)
+    assert mapped["filter"].tolist() == [1] * 30
+    assert not mapped["control"].any()
+    assert mapped["locs"].shape == (30, 2)
+    assert mapped["locs"][1].tolist() == [0.0, 0.10000000149011612]
+
+    # first record of each fastq is the first cluster
+    reads = decode_cluster(mapped, 0)
+    for name, (seq, qual) in zip(["r1", "i1", "i2", "r2"], reads):
+        lines = gzip.open(files[name], "rt").read().splitlines()
+        assert (seq, qual) == (lines[1], lines[3])
+
+
+def test_read_bcl_gz(run):
+    _, rundir = run
+    path = find_cycle_bcls(rundir)[0]
+    gz_path = path.with_name(path.name + ".gz")
+    gz_path.write_bytes(gzip.compress(path.read_bytes()))
+    assert (read_bcl(gz_path) == read_bcl(path)).all()
+    path.unlink()
+    assert find_cycle_bcls(rundir)[0] == gz_path
+
+
+def test_read_run_errors(run):
+    _, rundir = run
+    paths = find_cycle_bcls(rundir)
+    with open(paths[3], "ab") as f_out:
+        f_out.write(b"\x00")
+    with pytest.raises(ValueError, match="records"):
+        read_bcl(paths[3])
+    paths[3].unlink()
+    with pytest.raises(ValueError, match="Missing cycles"):
+        read_run(rundir)
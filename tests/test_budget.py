@@ -0,0 +1,126 @@
+import logging
+
+import numpy as np
+import pytest
+
+from fastq2bcl import budget as budget_module
+from fastq2bcl.budget import MemoryBudget
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.manifest import MANIFEST_FILENAME
+from fastq2bcl.profiling import StageTimer, current_rss
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def run_files(rundir):
+    return {
+        path.relative_to(rundir).as_posix(): path.read_bytes()
+        for path in rundir.rglob("*")
+        if path.is_file() and path.name != MANIFEST_FILENAME
+    }
+
+
+def test_memory_budget(tmp_path):
+    budget = MemoryBudget(current_rss() + 1000, tmp_path)
+    assert budget.limit == 1000
+    assert budget.reserve("a", 600)
+    assert not budget.reserve("b", 600)
+    assert budget.available == 400
+    budget.release("a")
+    assert budget.chunk_size("chunk", 10, 0.5, minimum=5, maximum=20) == 20
+    with pytest.raises(ValueError, match="too small for other"):
+        budget.chunk_size("other", 100, 0.5, minimum=10)
+    assert len(budget.decisions) == 2
+    with pytest.raises(ValueError, match="below the memory of the process"):
+        MemoryBudget(1000)
+
+
+def test_memory_budget_spill(tmp_path):
+    budget = MemoryBudget(current_rss() + 1000, tmp_path)
+    small = budget.zeros("small", (10, 10))
+    assert not isinstance(small, np.memmap)
+    large = budget.zeros("large", (100, 100))
+    assert isinstance(large, np.memmap) and not large.any()
+    assert budget.report()["spilled"] == {"large": 10000}
+
+    arrays = {"a": np.arange(1000, dtype=np.int32), "b": np.ones((3, 2), np.uint8)}
+    kept = budget.keep("chunk", arrays)
+    assert isinstance(kept["a"], tuple)
+    restored = budget.restore(kept)
+    assert restored["a"].tolist() == arrays["a"].tolist()
+    assert restored["b"].tolist() == arrays["b"].tolist()
+    assert budget.restore(budget.keep("tiny", {"c": np.zeros(1)}))["c"] == 0
+    budget.close()
+    assert budget.held == {}
+
+
+def test_memory_budget_spill_short_io(tmp_path, monkeypatch):
+    """short pwrite and pread calls, and the seek fallback without them"""
+    pwrite, pread = budget_module.os.pwrite, budget_module.os.pread
+    monkeypatch.setattr(
+        budget_module.os,
+        "pwrite",
+        lambda fd, data, offset: pwrite(fd, data[:7], offset),
+    )
+    monkeypatch.setattr(
+        budget_module.os,
+        "pread",
+        lambda fd, size, offset: pread(fd, min(size, 5), offset),
+    )
+    arrays = {"a": np.arange(1000, dtype=np.int32)}
+    with MemoryBudget(current_rss() + 100, tmp_path) as budget:
+        kept = budget.keep("chunk", arrays)
+        assert budget.restore(kept)["a"].tolist() == arrays["a"].tolist()
+        monkeypatch.delattr(budget_module.os, "pwrite")
+        monkeypatch.delattr(budget_module.os, "pread")
+        kept = budget.keep("other", arrays)
+        assert budget.restore(kept)["a"].tolist() == arrays["a"].tolist()
+        spill_file = budget.spill_file
+    # the spill file is closed on exit
+    assert spill_file.closed and budget.spill_file is None
+
+
+@pytest.mark.parametrize("executor", ["threads", "processes"])
+def test_max_memory_run(tmp_path, monkeypatch, caplog, executor):
+    caplog.set_level(logging.INFO, logger="fastq2bcl.budget")
+    monkeypatch.setattr(budget_module, "READ_CHUNK_MIN", 100)
+    closed = []
+    close = MemoryBudget.close
+    monkeypatch.setattr(
+        MemoryBudget, "close", lambda budget: closed.append(True) or close(budget)
+    )
+    files = write_synthetic_run(tmp_path / "input", 20000, "dual_index", length=20)
+    (tmp_path / "full").mkdir()
+    _, full, _, _ = fastq2bcl(tmp_path / "full", **files)
+    timer = StageTimer()
+    _, rundir, _, _ = fastq2bcl(
+        tmp_path,
+        **files,
+        threads=2,
+        executor=executor,
+        timer=timer,
+        max_memory=current_rss() + 1_500_000,
+    )
+    assert run_files(rundir) == run_files(full)
+    # no scratch file left next to the run, the budget is closed
+    assert closed == [True]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        ["input", "full", rundir.name]
+    )
+    # read in chunks, the clusters matrix does not fit
+    assert timer.stages["read"]["calls"] > 1
+    assert "clusters spilled to scratch" in caplog.text
+    # blocks sent to worker processes are bounded
+    assert ("write_blocks of" in caplog.text) == (executor == "processes")
+
+
+def test_max_memory_usage(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 10, "pair", length=8)
+    args = ["-r1", str(files["r1"]), "-r2", str(files["r2"]), "-o", str(tmp_path)]
+    main(args + ["--max-memory", "4G"])
+    assert (tmp_path / "YYMMDD_SIM_0001_FC0001" / "RunInfo.xml").is_file()
+    with pytest.raises(ValueError, match="below the memory of the process"):
+        main(args + ["--max-memory", "1K"])
@@ -0,0 +1,85 @@
+import os
+
+from fastq2bcl.cache import (
+    cache_key,
+    lookup_cache,
+    restore_from_cache,
+    store_in_cache,
+    list_cache_entries,
+    evict_cache,
+)
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.verify import check_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+test_inputs = {"r1": "data/test/01_single/test_single.fastq.gz", "r2": None}
+test_options = {"mask": "110N", "exclude_umi": False, "exclude_index": False}
+
+
+def make_rundir(path, content=b"\x01\x00\x00\x00\x05"):
+    bcl = path / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    bcl.parent.mkdir(parents=True)
+    bcl.write_bytes(content)
+    return path
+
+
+def test_cache_key():
+    key = cache_key(test_inputs, test_options)
+    assert key == cache_key(test_inputs, dict(test_options))
+    assert key != cache_key(test_inputs, dict(test_options, mask="100N"))
+    assert key != cache_key(
+        {"r1": "data/test/07_pair/R1.fastq.gz", "r2": None}, test_options
+    )
+
+
+def test_store_lookup_restore(tmp_path):
+    cache_dir = tmp_path / "cache"
+    rundir = make_rundir(tmp_path / "RUN")
+    assert lookup_cache(cache_dir, "key") is None
+    entry = store_in_cache(cache_dir, "key", rundir)
+    assert store_in_cache(cache_dir, "key", rundir) == entry
+    assert lookup_cache(cache_dir, "key") == entry
+
+    restored = restore_from_cache(entry, tmp_path / "out" / "RUN")
+    bcl = restored / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    assert bcl.read_bytes() == b"\x01\x00\x00\x00\x05"
+    assert bcl.stat().st_nlink == 1
+
+    linked = restore_from_cache(entry, tmp_path / "linked" / "RUN", mode="link")
+    bcl = linked / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    assert bcl.stat().st_nlink == 2
+
+
+def test_evict_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    for idx, key in enumerate(["old", "new"]):
+        entry = store_in_cache(cache_dir, key, make_rundir(tmp_path / key, b"0" * 100))
+        os.utime(entry / "entry.json", (idx, idx))
+    assert [e.name for _, _, e in list_cache_entries(cache_dir)] == ["old", "new"]
+    assert evict_cache(cache_dir, 1000) == []
+    assert [e.name for e in evict_cache(cache_dir, 150)] == ["old"]
+    assert [e.name for _, _, e in list_cache_entries(cache_dir)] == ["new"]
+
+
+def test_linked_restore_then_resume(tmp_path):
+    """rewriting a run restored with hard links leaves the cache entry intact"""
+    files = write_synthetic_run(tmp_path / "input", 50, "pair", length=8)
+    cache_dir = tmp_path / "cache"
+    for _ in range(2):
+        _, rundir, _, _ = fastq2bcl(
+            tmp_path, **files, cache_dir=cache_dir, cache_mode="link"
+        )
+    bcl = rundir / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    assert bcl.stat().st_nlink > 1
+    cached = {
+        path: path.read_bytes() for path in cache_dir.rglob("*") if path.is_file()
+    }
+
+    fastq2bcl(tmp_path, **files, resume=True, max_reads=5)
+    assert check_run(rundir) == []
+    assert bcl.read_bytes()[:4] == (5).to_bytes(4, "little")
+    assert {path: path.read_bytes() for path in cached} == cached
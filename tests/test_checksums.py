@@ -0,0 +1,59 @@
+import hashlib
+
+import pytest
+
+from fastq2bcl.checksums import (
+    CHECKSUM_FILES,
+    checksum_chunks,
+    checksum_run,
+    find_checksums,
+    read_checksums,
+    verify_checksums,
+)
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_checksum_chunks():
+    assert checksum_chunks("md5", [b"ab", b"c"]) == hashlib.md5(b"abc").hexdigest()
+    assert checksum_chunks("blake2", [b"abc"]) == hashlib.blake2b(b"abc").hexdigest()
+
+
+@pytest.mark.parametrize("algorithm", ["md5", "blake2"])
+@pytest.mark.parametrize("threads,executor", [(1, "auto"), (3, "threads")])
+def test_checksums_while_writing(tmp_path, algorithm, threads, executor):
+    files = write_synthetic_run(tmp_path / "input", 50, "pair", length=8)
+    _, rundir, _, _ = fastq2bcl(
+        tmp_path, **files, threads=threads, executor=executor, checksum=algorithm
+    )
+    assert find_checksums(rundir) == (algorithm, rundir / CHECKSUM_FILES[algorithm])
+    checksums = read_checksums(rundir / CHECKSUM_FILES[algorithm])
+    # RunInfo.xml, filter, control, locs, bcl and stats of 16 cycles
+    assert len(checksums) == 4 + 2 * 16
+    for relpath, digest in checksums.items():
+        data = (rundir / relpath).read_bytes()
+        assert hashlib.new(algorithm.replace("2", "2b"), data).hexdigest() == digest
+    assert verify_checksums(rundir) == []
+
+    # same checksums reading the files
+    (rundir / CHECKSUM_FILES[algorithm]).unlink()
+    checksum_run(rundir, algorithm, workers=2)
+    assert read_checksums(rundir / CHECKSUM_FILES[algorithm]) == checksums
+
+
+def test_verify_checksums(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "single", length=8)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **files, checksum="md5")
+    bcl = rundir / "Data/Intensities/BaseCalls/L001/C2.1/s_1_1101.bcl"
+    bcl.write_bytes(bcl.read_bytes()[:-1] + b"\xff")
+    (rundir / "Data/Intensities/L001/s_1_1101.locs").unlink()
+    assert verify_checksums(rundir, workers=2) == [
+        "Data/Intensities/BaseCalls/L001/C2.1/s_1_1101.bcl",
+        "Data/Intensities/L001/s_1_1101.locs",
+    ]
+    (rundir / CHECKSUM_FILES["md5"]).unlink()
+    assert verify_checksums(rundir) is None
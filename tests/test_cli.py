@@ -1,35 +1,25 @@
+import json
+
 import pytest
 import unittest.mock
 
-from fastq2bcl.cli import main, mock_run_id, fastq2bcl, set_mask, run
+from fastq2bcl import layout, reader
+from fastq2bcl.synthetic import write_interleaved_fastq, write_synthetic_run
+
+from fastq2bcl.cli import (
+    main,
+    fastq2bcl,
+    parse_size,
+    get_sampling_options,
+    parse_threads,
+    run,
+    VALIDATE_LEVELS,
+)
 
 __author__ = "Davide Rambaldi"
 __copyright__ = "Davide Rambaldi"
 __license__ = "MIT"
 
-test_fields = {
-    "instrument": "M11111",
-    "run_number": "222",
-    "flowcell_id": "000000000-K9H97",
-    "lane": "1",
-    "tile": "1101",
-    "x_pos": "19304",
-    "y_pos": "1328",
-    "UMI": "AAACGGG",
-    "read": "1",
-    "is_filtered": "N",
-    "control_number": "0",
-    "index": "1",
-}
-
-expected_mask_110N = [{"cycles": "110", "index": "N", "id": "1"}]
-expected_mask_110N10Y10Y110N = [
-    {"cycles": "110", "index": "N", "id": "1"},
-    {"cycles": "10", "index": "Y", "id": "2"},
-    {"cycles": "10", "index": "Y", "id": "3"},
-    {"cycles": "110", "index": "N", "id": "4"},
-]
-
 
 def test_run():
     """run CLI test"""
@@ -82,6 +72,8 @@ def test_multithread_usage_and_different_length(capsys, tmpdir):
             "data/test/09_multi_pair_different_indexes/RIndex2.fastq.gz",
             "-T",
             "16",
+            "--executor",
+            "processes",
             "--exclude-index",
         ]
     )
@@ -89,11 +81,6 @@ def test_multithread_usage_and_different_length(capsys, tmpdir):
     assert "YYMMDD_run_0001_ABCD" in captured.out
 
 
-def test_mock_run_id():
-    """Mock run id Tests"""
-    assert mock_run_id(test_fields) == "YYMMDD_M11111_0222_000000000-K9H97"
-
-
 def test_fastq2bcl(tmpdir):
     """Fastq2bcl main function Tests"""
     run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
@@ -117,16 +104,6 @@ def test_fastq2bcl_with_mask(tmpdir):
     assert mask_string == "309N309N"
 
 
-def test_set_mask():
-    """Test mask generation"""
-    assert set_mask("110N") == expected_mask_110N
-    assert set_mask("110N10Y10Y110N") == expected_mask_110N10Y10Y110N
-    with pytest.raises(ValueError):
-        set_mask(None)
-    with pytest.raises(ValueError):
-        set_mask("100")
-
-
 def test_fastq2bcl_with_umi(tmpdir):
     """Fastq2bcl main function Tests with UMI"""
     run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
@@ -162,3 +139,278 @@ def test_fastq2bcl_with_exclude_index(tmpdir):
         exclude_index=True,
     )
     assert seqdesc_fields["index"] == "AACCACTA"
+
+
+def test_fastq2bcl_resume(tmpdir):
+    """Fastq2bcl main function Tests with resume"""
+    run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
+        str(tmpdir), "data/test/07_pair/R1.fastq.gz", "data/test/07_pair/R2.fastq.gz"
+    )
+    bcl = rundir / "Data/Intensities/BaseCalls/L001/C10.1/s_1_1101.bcl"
+    other_bcl = rundir / "Data/Intensities/BaseCalls/L001/C11.1/s_1_1101.bcl"
+    expected = bcl.read_bytes()
+    other_mtime = other_bcl.stat().st_mtime_ns
+    bcl.unlink()
+
+    fastq2bcl(
+        str(tmpdir),
+        "data/test/07_pair/R1.fastq.gz",
+        "data/test/07_pair/R2.fastq.gz",
+        resume=True,
+    )
+    assert bcl.read_bytes() == expected
+    assert other_bcl.stat().st_mtime_ns == other_mtime
+
+
+def test_resume_usage(capsys, tmpdir):
+    """CLI Tests with resume and threads"""
+    args = ["-o", str(tmpdir), "-r1", "data/test/01_single/test_single.fastq.gz"]
+    main(args + ["-T", "2"])
+    main(args + ["-T", "2", "--resume"])
+    captured = capsys.readouterr()
+    assert "110 cycles complete" in captured.out
+
+
+def test_fastq2bcl_cache(tmp_path):
+    """Fastq2bcl main function Tests with build cache"""
+    cache_dir = tmp_path / "cache"
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
+        first, "data/test/01_single/test_single.fastq.gz", cache_dir=cache_dir
+    )
+    with unittest.mock.patch("fastq2bcl.intermediate.read_clusters") as read_mock:
+        run_id, cached_rundir, seqdesc_fields, mask_string = fastq2bcl(
+            second,
+            "data/test/01_single/test_single.fastq.gz",
+            cache_dir=cache_dir,
+            cache_max_size=parse_size("10M"),
+        )
+        read_mock.assert_not_called()
+    bcl = "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    assert (cached_rundir / bcl).read_bytes() == (rundir / bcl).read_bytes()
+    assert mask_string == "110N"
+
+
+def test_cache_dir_environment(tmp_path, monkeypatch):
+    """$FASTQ2BCL_CACHE_DIR caches new runs and is ignored with --tar and --append"""
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("FASTQ2BCL_CACHE_DIR", str(cache_dir))
+    r1 = "data/test/01_single/test_single.fastq.gz"
+    main(["-r1", r1, "-o", str(tmp_path)])
+    assert len(list(cache_dir.iterdir())) == 1
+    rundir = next(tmp_path.glob("YYMMDD_*"))
+    main(["-r1", r1, "--tar", str(tmp_path / "run.tar")])
+    assert (tmp_path / "run.tar").is_file()
+    main(["-r1", r1, "--append", str(rundir)])
+    with pytest.raises(ValueError, match="--tar"):
+        main(["-r1", r1, "--tar", "run.tar", "--cache-dir", str(cache_dir)])
+
+
+def test_parse_size():
+    """Test size parsing"""
+    assert parse_size("100") == 100
+    assert parse_size("2K") == 2048
+    assert parse_size("10g") == 10 * 1024**3
+    with pytest.raises(ValueError):
+        parse_size("ten")
+
+
+def test_fastq2bcl_with_intermediate(tmp_path):
+    """Fastq2bcl main function Tests with a saved intermediate"""
+    r1 = "data/test/03_single_with_umi/single_with_umi.fastq.gz"
+    run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
+        tmp_path, r1, intermediate=tmp_path / "intermediate"
+    )
+    assert (tmp_path / "intermediate/meta.json").is_file()
+    with unittest.mock.patch("fastq2bcl.intermediate.read_fastq_segments") as mock:
+        run_id, rundir, seqdesc_fields, mask_string = fastq2bcl(
+            tmp_path, r1, exclude_umi=True, intermediate=tmp_path / "intermediate"
+        )
+        mock.assert_not_called()
+    assert mask_string == "110N"
+
+
+def test_sampling_usage(capsys, tmpdir):
+    """CLI Tests with sampling"""
+    main(
+        [
+            "-o",
+            str(tmpdir),
+            "-r1",
+            "data/test/05_multi_pair_double_index/R1.fastq.gz",
+            "-r2",
+            "data/test/05_multi_pair_double_index/R2.fastq.gz",
+            "--max-reads",
+            "2",
+            "--sample-n",
+            "1",
+            "--seed",
+            "7",
+        ]
+    )
+    captured = capsys.readouterr()
+    assert "'sample_n': 1" in captured.out
+    filter_file = (
+        tmpdir / "YYMMDD_run_0001_ABCD/Data/Intensities/BaseCalls/L001/s_1_1101.filter"
+    )
+    assert filter_file.read_binary()[8:12] == b"\x01\x00\x00\x00"
+
+
+def test_get_sampling_options():
+    """Test sampling options"""
+    assert get_sampling_options(None, None, None, 0) == {}
+    assert get_sampling_options(10, None, None, 0) == {"max_reads": 10}
+    assert get_sampling_options(None, 0.1, None, 3) == {
+        "sample_fraction": 0.1,
+        "seed": 3,
+    }
+
+
+def test_plan_usage(capsys, tmpdir):
+    """CLI Tests with plan"""
+    main(
+        ["-o", str(tmpdir), "-r1", "data/test/01_single/test_single.fastq.gz", "--plan"]
+    )
+    captured = capsys.readouterr()
+    plan = json.loads(captured.out)
+    assert plan["clusters"] == 1
+    assert plan["cycles"] == 110
+    assert tmpdir.listdir() == []
+
+
+def test_profile_and_trace_usage(tmp_path):
+    """CLI Tests with profile report and trace"""
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    profile = tmp_path / "profile.json"
+    trace = tmp_path / "trace.json"
+    main(
+        [
+            "-o",
+            str(outdir),
+            "-r1",
+            "data/test/07_pair/R1.fastq.gz",
+            "-r2",
+            "data/test/07_pair/R2.fastq.gz",
+            "-T",
+            "2",
+            "--executor",
+            "processes",
+            "--profile",
+            str(profile),
+            "--trace",
+            str(trace),
+        ]
+    )
+    stages = {s["name"]: s for s in json.loads(profile.read_text())["stages"]}
+    for name in ["read", "encode", "assemble", "write_locs", "layout", "write_block"]:
+        assert name in stages
+    assert stages["write_block"]["calls"] == len(list(outdir.rglob("*.bcl")))
+    events = json.loads(trace.read_text())["traceEvents"]
+    # cycles written by the worker processes
+    assert len({e["pid"] for e in events if e["name"] == "write_block"}) >= 1
+    assert all(e["ph"] == "X" for e in events)
+
+
+def test_profile_cprofile_usage(tmp_path):
+    """CLI Tests with a cProfile dump"""
+    import pstats
+
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    profile = tmp_path / "run.prof"
+    main(
+        [
+            "-o",
+            str(outdir),
+            "-r1",
+            "data/test/01_single/test_single.fastq.gz",
+            "--profile",
+            str(profile),
+        ]
+    )
+    assert pstats.Stats(str(profile)).total_calls > 0
+
+
+@pytest.mark.parametrize("executor", ["threads", "processes"])
+def test_fastq2bcl_executors(tmp_path, monkeypatch, executor):
+    """Same run with serial writes and with a pool of workers writing blocks"""
+    files = write_synthetic_run(tmp_path / "input", 100, "pair", length=10)
+    r1, r2 = files["r1"], files["r2"]
+    (tmp_path / "serial").mkdir()
+    (tmp_path / executor).mkdir()
+    _, serial_rundir, _, _ = fastq2bcl(tmp_path / "serial", r1, r2)
+    # split every cycle in cluster ranges
+    monkeypatch.setattr(layout, "BLOCK_MIN_CLUSTERS", 1)
+    _, rundir, _, _ = fastq2bcl(
+        tmp_path / executor, r1, r2, threads=4, executor=executor
+    )
+    serial_files = sorted(
+        p.relative_to(serial_rundir) for p in serial_rundir.rglob("*.bcl")
+    )
+    assert serial_files == sorted(p.relative_to(rundir) for p in rundir.rglob("*.bcl"))
+    for path in serial_files:
+        assert (serial_rundir / path).read_bytes() == (rundir / path).read_bytes()
+
+
+def test_parse_threads():
+    assert parse_threads("4") == 4
+    assert parse_threads("auto") == "auto"
+    with pytest.raises(ValueError):
+        parse_threads("0")
+    with pytest.raises(ValueError):
+        parse_threads("many")
+
+
+def test_threads_auto_usage(capsys, tmp_path):
+    """CLI Tests with --threads auto"""
+    files = write_synthetic_run(tmp_path / "input", 100, "pair", length=10)
+    outdir = tmp_path / "output"
+    outdir.mkdir()
+    main(
+        [
+            "-o",
+            str(outdir),
+            "-r1",
+            str(files["r1"]),
+            "-r2",
+            str(files["r2"]),
+            "-T",
+            "auto",
+        ]
+    )
+    captured = capsys.readouterr()
+    assert "Autotune" in captured.out
+    assert len(list(outdir.rglob("*.bcl"))) == 20
+
+
+def test_interleaved_usage(tmp_path):
+    """CLI Tests with --interleaved: same run of the R1 and R2 files"""
+    files = write_synthetic_run(tmp_path / "input", 50, "pair", length=10)
+    interleaved = write_interleaved_fastq(
+        tmp_path / "interleaved.fastq.gz", files["r1"], files["r2"]
+    )
+    (tmp_path / "pair").mkdir()
+    _, pair_rundir, _, _ = fastq2bcl(tmp_path / "pair", **files)
+    outdir = tmp_path / "interleaved"
+    outdir.mkdir()
+    main(["-o", str(outdir), "-r1", str(interleaved), "--interleaved"])
+    rundir = outdir / pair_rundir.name
+    outputs = [p for p in pair_rundir.rglob("*") if p.suffix in [".bcl", ".filter"]]
+    assert len(outputs) == 21
+    for path in outputs:
+        assert (rundir / path.relative_to(pair_rundir)).read_bytes() == (
+            path.read_bytes()
+        )
+
+
+def test_validate_usage(tmp_path):
+    """CLI Tests with --validate: same levels as the reader"""
+    assert VALIDATE_LEVELS == reader.VALIDATE_LEVELS
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=10)
+    main(["-o", str(tmp_path), "-r1", str(files["r1"]), "--validate", "none"])
+    with pytest.raises(SystemExit):
+        main(["-o", str(tmp_path), "-r1", str(files["r1"]), "--validate", "all"])
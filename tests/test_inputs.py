@@ -0,0 +1,127 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import sys
+import threading
+
+import pytest
+
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.inputs import (
+    _streams,
+    detect_format,
+    is_readable_input,
+    is_stream,
+    open_fastq,
+)
+from fastq2bcl.reader import get_mask_from_files, read_first_fastq_record
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def compress_zstd(data):
+    zstandard = pytest.importorskip("zstandard")
+    return zstandard.ZstdCompressor().compress(data)
+
+
+COMPRESSORS = {
+    "plain": lambda data: data,
+    "gzip": gzip.compress,
+    "bz2": bz2.compress,
+    "xz": lzma.compress,
+    "zstd": compress_zstd,
+}
+
+
+@pytest.fixture
+def fastq(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=12)
+    return files, gzip.decompress(files["r1"].read_bytes())
+
+
+def test_detect_format():
+    assert detect_format(b"\x1f\x8b\x08\x04") == "gzip"
+    assert detect_format(b"BZh91AY") == "bz2"
+    assert detect_format(b"\x28\xb5\x2f\xfd\x00") == "zstd"
+    assert detect_format(b"\xfd7zXZ\x00\x00") == "xz"
+    assert detect_format(b"@READ") == "plain"
+    assert detect_format(b"") == "plain"
+
+
+@pytest.mark.parametrize("codec", COMPRESSORS)
+def test_open_fastq(tmp_path, fastq, codec):
+    _, data = fastq
+    path = tmp_path / f"R1.{codec}"
+    path.write_bytes(COMPRESSORS[codec](data))
+    with open_fastq(path, "rb") as f_in:
+        assert f_in.read() == data
+    with open_fastq(path) as f_in:
+        assert f_in.read() == data.decode()
+    assert not is_stream(path)
+    assert is_readable_input(path)
+
+
+def test_stdin_replay(monkeypatch, fastq):
+    _, data = fastq
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(gzip.compress(data))))
+    assert is_stream("-")
+    assert is_readable_input("-")
+    # inspecting readers do not consume the records
+    title, seq, _ = read_first_fastq_record("-")
+    assert data.startswith(f"@{title}\n{seq}\n".encode())
+    assert read_first_fastq_record("-")[0] == title
+    with open_fastq("-", "rb") as f_in:
+        assert f_in.read() == data
+    assert "-" not in _streams
+
+
+def fifo_writer(path, data):
+    thread = threading.Thread(target=lambda: path.write_bytes(data), daemon=True)
+    thread.start()
+    return thread
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="named pipes not supported")
+def test_named_pipe_conversion(tmp_path, fastq):
+    files, _ = fastq
+    (tmp_path / "files").mkdir()
+    (tmp_path / "pipes").mkdir()
+    _, file_rundir, _, file_mask = fastq2bcl(tmp_path / "files", **files)
+
+    pipes = {}
+    threads = []
+    for name in ["r1", "r2"]:
+        pipes[name] = tmp_path / f"{name}.fifo"
+        os.mkfifo(pipes[name])
+        # the pipes carry zstd and bz2 compressed fastq
+        data = gzip.decompress(files[name].read_bytes())
+        compress = COMPRESSORS["zstd" if name == "r1" else "bz2"]
+        threads.append(fifo_writer(pipes[name], compress(data)))
+    assert is_stream(pipes["r1"])
+    assert get_mask_from_files(pipes["r1"], pipes["r2"], None, None, False, False) == (
+        file_mask
+    )
+    _, rundir, _, mask = fastq2bcl(tmp_path / "pipes", **pipes)
+    for thread in threads:
+        thread.join()
+
+    assert mask == file_mask
+    outputs = [p for p in file_rundir.rglob("*") if p.suffix in [".bcl", ".filter"]]
+    assert outputs
+    for path in outputs:
+        assert (rundir / path.relative_to(file_rundir)).read_bytes() == (
+            path.read_bytes()
+        )
+
+
+def test_stream_rejects_cache(tmp_path, monkeypatch, fastq):
+    _, data = fastq
+    monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(data)))
+    with pytest.raises(ValueError, match="regular files"):
+        fastq2bcl(tmp_path, "-", cache_dir=tmp_path / "cache")
+    _streams.clear()
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from fastq2bcl.intermediate import (
+    save_intermediate,
+    load_intermediate,
+    assemble_clusters,
+    read_clusters,
+)
+from fastq2bcl.reader import read_fastq_files, read_fastq_segments
+from fastq2bcl.writer import encode_cluster_byte
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+test_datasets = [
+    ("data/test/01_single/test_single.fastq.gz", None, None, None),
+    ("data/test/02_single_with_index/single.R1.fastq.gz", None, None, None),
+    ("data/test/03_single_with_umi/single_with_umi.fastq.gz", None, None, None),
+    (
+        "data/test/09_multi_pair_different_indexes/R1.fastq.gz",
+        "data/test/09_multi_pair_different_indexes/R2.fastq.gz",
+        "data/test/09_multi_pair_different_indexes/RIndex1.fastq.gz",
+        "data/test/09_multi_pair_different_indexes/RIndex2.fastq.gz",
+    ),
+]
+
+
+def legacy_clusters(sequences):
+    """bcl bytes matrix built one cluster byte at a time"""
+    cycles = max(len(seq) for seq, _ in sequences)
+    clusters = np.zeros((cycles, len(sequences)), dtype=np.uint8)
+    for cluster, (seq, qual) in enumerate(sequences):
+        for cycle in range(len(seq)):
+            clusters[cycle, cluster] = encode_cluster_byte(seq[cycle], qual[cycle])[0]
+    return clusters
+
+
+@pytest.mark.parametrize("files", test_datasets)
+@pytest.mark.parametrize("exclude_umi", [True, False])
+@pytest.mark.parametrize("exclude_index", [True, False])
+def test_assemble_clusters(files, exclude_umi, exclude_index):
+    sequences, positions = read_fastq_files(*files, exclude_umi, exclude_index)
+    columns = read_fastq_segments(files[0], files[1], files[2], files[3])
+    clusters, cluster_positions = assemble_clusters(columns, exclude_umi, exclude_index)
+    assert np.array_equal(clusters, legacy_clusters(sequences))
+    assert cluster_positions.tolist() == [[int(x), int(y)] for x, y in positions]
+
+
+def test_read_fastq_segments():
+    columns = read_fastq_segments(
+        "data/test/03_single_with_umi/single_with_umi.fastq.gz", None, None, None
+    )
+    assert sorted(columns) == [
+        "R1",
+        "R1_lengths",
+        "UMI",
+        "UMI_lengths",
+        "filter",
+        "positions",
+    ]
+    assert columns["R1"].shape == (1, 110)
+    assert columns["UMI_lengths"].tolist() == [9]
+    assert columns["filter"].tolist() == [1]
+
+
+def test_save_and_load_intermediate(tmp_path):
+    r1 = "data/test/03_single_with_umi/single_with_umi.fastq.gz"
+    inputs = {"r1": r1, "r2": None}
+    assert load_intermediate(tmp_path, inputs) is None
+    columns = read_fastq_segments(r1, None, None, None)
+    save_intermediate(tmp_path, columns, inputs)
+    loaded = load_intermediate(tmp_path, inputs)
+    assert isinstance(loaded["R1"], np.memmap)
+    for name in columns:
+        assert np.array_equal(loaded[name], columns[name])
+    # intermediate from other inputs is ignored
+    assert load_intermediate(tmp_path, {"r1": "data/test/07_pair/R1.fastq.gz"}) is None
+
+
+def test_interrupted_save_invalidates_intermediate(tmp_path, monkeypatch):
+    r1 = "data/test/03_single_with_umi/single_with_umi.fastq.gz"
+    save_intermediate(tmp_path, read_fastq_segments(r1, None, None, None), {"r1": r1})
+    other = "data/test/01_single/test_single.fastq.gz"
+    columns = read_fastq_segments(other, None, None, None)
+    saved = []
+    save = np.save
+
+    def failing_save(file, values):
+        if saved:
+            raise OSError("disk full")
+        saved.append(save(file, values))
+
+    monkeypatch.setattr(np, "save", failing_save)
+    with pytest.raises(OSError, match="disk full"):
+        save_intermediate(tmp_path, columns, {"r1": other})
+    # a column of other inputs was written: the old inputs do not match anymore
+    assert load_intermediate(tmp_path, {"r1": r1}) is None
+
+
+def test_read_clusters_with_intermediate(tmp_path):
+    r1 = "data/test/03_single_with_umi/single_with_umi.fastq.gz"
+    clusters, positions = read_clusters(r1, None, None, None, False, True, tmp_path)
+    assert clusters.shape == (119, 1)
+    # exclude UMI slicing the saved intermediate
+    clusters, positions = read_clusters(r1, None, None, None, True, True, tmp_path)
+    assert clusters.shape == (110, 1)
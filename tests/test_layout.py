@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fastq2bcl import layout
+from fastq2bcl.layout import (
+    bcl_path,
+    create_layout,
+    plan_blocks,
+    preallocate,
+    write_block,
+    write_cycle_block,
+)
+from fastq2bcl.writer import write_cycle_column
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_preallocate_and_write_block(tmp_path):
+    path = tmp_path / "file"
+    preallocate(path, 10)
+    assert path.read_bytes() == bytes(10)
+    write_block(path, 4, b"abc")
+    assert path.read_bytes() == b"\0\0\0\0abc\0\0\0"
+
+
+def test_write_block_without_pwrite(tmp_path, monkeypatch):
+    """windows fallback: seek and write in binary mode (newline bytes kept)"""
+    monkeypatch.delattr(layout.os, "pwrite")
+    path = tmp_path / "file"
+    preallocate(path, 8)
+    write_block(path, 2, b"\n\r\n")
+    assert path.read_bytes() == b"\0\0\n\r\n\0\0\0"
+
+
+def test_create_layout(tmp_path):
+    paths = create_layout(tmp_path, [0, 2], 5)
+    assert paths == [bcl_path(tmp_path, 0), bcl_path(tmp_path, 2)]
+    assert paths[0].read_bytes() == b"\x05\0\0\0" + bytes(5)
+    assert (paths[1].parent / "s_1_1101.stats").stat().st_size == 108
+    assert not bcl_path(tmp_path, 1).parent.exists()
+    assert (tmp_path / "Data/Intensities/L001").is_dir()
+
+
+def test_plan_blocks(monkeypatch):
+    assert plan_blocks([], 10, 4) == []
+    assert plan_blocks([0, 1], 0, 4) == [(0, 0, 0), (1, 0, 0)]
+    # few clusters: one block for each cycle
+    assert plan_blocks([0, 1], 10, 4) == [(0, 0, 10), (1, 0, 10)]
+    monkeypatch.setattr(layout, "BLOCK_MIN_CLUSTERS", 2)
+    blocks = plan_blocks([0, 1], 10, 4)
+    assert len(blocks) == 10
+    assert [b[1:] for b in blocks if b[0] == 1] == [
+        (0, 2),
+        (2, 4),
+        (4, 6),
+        (6, 8),
+        (8, 10),
+    ]
+    # enough cycles for the workers
+    assert len(plan_blocks(range(100), 10, 4)) == 100
+    # bounded blocks (e.g. memory budget of worker processes)
+    blocks = plan_blocks([0], 10, 1, 100, max_clusters=4)
+    assert [b[1:] for b in blocks] == [(0, 3), (3, 6), (6, 10)]
+
+
+def test_write_cycle_blocks_in_threads(tmp_path, monkeypatch):
+    cluster_count = 1000
+    column = np.random.default_rng(0).integers(0, 256, cluster_count, dtype=np.uint8)
+    write_cycle_column(0, cluster_count, tmp_path / "column", column)
+
+    monkeypatch.setattr(layout, "BLOCK_MIN_CLUSTERS", 64)
+    path = create_layout(tmp_path / "blocks", [0], cluster_count)[0]
+    blocks = plan_blocks([0], cluster_count, 4)
+    assert len(blocks) == 15
+    with ThreadPoolExecutor(4) as pool:
+        for start, stop in [b[1:] for b in blocks]:
+            pool.submit(write_cycle_block, path, start, column[start:stop])
+    assert path.read_bytes() == bcl_path(tmp_path / "column", 0).read_bytes()
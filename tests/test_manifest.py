@@ -0,0 +1,83 @@
+from fastq2bcl.manifest import (
+    fingerprint_file,
+    new_manifest,
+    load_manifest,
+    save_manifest,
+    checkpoint_manifest,
+    is_compatible,
+    resume_manifest,
+    mark_complete,
+    is_complete,
+)
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+test_inputs = {"r1": "data/test/01_single/test_single.fastq.gz", "r2": None}
+
+
+def test_fingerprint_file():
+    fingerprint = fingerprint_file("data/test/01_single/test_single.fastq.gz")
+    assert fingerprint["path"].endswith("data/test/01_single/test_single.fastq.gz")
+    assert fingerprint["size"] > 0
+
+
+def test_new_manifest():
+    manifest = new_manifest(test_inputs, "110N", False, True)
+    assert list(manifest["inputs"]) == ["r1"]
+    assert manifest["mask"] == "110N"
+    assert manifest["completed"] == {}
+
+
+def test_save_and_load_manifest(tmp_path):
+    manifest = new_manifest(test_inputs, "110N", False, False)
+    assert load_manifest(tmp_path) is None
+    save_manifest(tmp_path, manifest)
+    assert load_manifest(tmp_path) == manifest
+
+
+def test_load_corrupted_manifest(tmp_path):
+    (tmp_path / "fastq2bcl_manifest.json").write_text("{not json")
+    assert load_manifest(tmp_path) is None
+
+
+def test_is_compatible():
+    manifest = new_manifest(test_inputs, "110N", False, False)
+    assert is_compatible(manifest, new_manifest(test_inputs, "110N", False, False))
+    assert not is_compatible(manifest, new_manifest(test_inputs, "100N", False, False))
+    assert not is_compatible(None, manifest)
+
+
+def test_mark_and_resume(tmp_path):
+    manifest = new_manifest(test_inputs, "110N", False, False)
+    manifest["cluster_count"] = 1
+    output = tmp_path / "out.bcl"
+    output.write_bytes(b"\x01\x00\x00\x00\x05")
+    mark_complete(tmp_path, manifest, output)
+    save_manifest(tmp_path, manifest)
+    assert is_complete(tmp_path, manifest, "out.bcl", 5)
+    assert not is_complete(tmp_path, manifest, "out.bcl", 6)
+
+    resumed = resume_manifest(tmp_path, new_manifest(test_inputs, "110N", False, False))
+    assert resumed["completed"] == {"out.bcl": 5}
+    discarded = resume_manifest(
+        tmp_path, new_manifest(test_inputs, "110N", True, False)
+    )
+    assert discarded["completed"] == {}
+
+    # truncated output is not complete anymore
+    output.write_bytes(b"\x01\x00")
+    assert not is_complete(tmp_path, resumed, "out.bcl", 5)
+
+
+def test_checkpoint_manifest(tmp_path):
+    manifest = new_manifest(test_inputs, "110N", False, False)
+    checkpoint_manifest(tmp_path, manifest, interval=3600)
+    assert load_manifest(tmp_path)["completed"] == {}
+    manifest["completed"]["out.bcl"] = 5
+    checkpoint_manifest(tmp_path, manifest, interval=3600)
+    assert load_manifest(tmp_path)["completed"] == {}
+    checkpoint_manifest(tmp_path, manifest, interval=0)
+    assert load_manifest(tmp_path)["completed"] == {"out.bcl": 5}
+    assert "_saved_at" not in load_manifest(tmp_path)
@@ -0,0 +1,67 @@
+import tracemalloc
+
+import pytest
+
+from fastq2bcl.cli import fastq2bcl
+from fastq2bcl.profiling import StageTimer
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+READS = 5_000
+
+# ceilings of the tracemalloc peak in bytes per cluster, cycles is the number of
+# cycles of the run. Python objects for each base (e.g. a list of ints) cost at least
+# 16 bytes per cycle for sequence and quality and break the ingest ceiling.
+CEILINGS = {
+    "ingest": lambda cycles: 8 * cycles + 512,
+    "assemble": lambda cycles: cycles + 64,
+    "write_block": lambda cycles: 16,
+    "write_filter": lambda cycles: 4,
+    "write_control": lambda cycles: 4,
+    "write_locs": lambda cycles: 64,
+}
+
+
+@pytest.fixture
+def memory_timer():
+    timer = StageTimer(memory=True, peaks=True)
+    yield timer
+    tracemalloc.stop()
+
+
+@pytest.mark.parametrize("mode", ["single", "dual_index", "umi"])
+def test_bytes_per_cluster(tmp_path, memory_timer, mode):
+    files = write_synthetic_run(tmp_path / "input", READS, mode)
+    outdir = tmp_path / "output"
+    outdir.mkdir()
+    fastq2bcl(
+        outdir,
+        files["r1"],
+        files["r2"],
+        files["i1"],
+        files["i2"],
+        None,
+        False,
+        False,
+        1,
+        timer=memory_timer,
+    )
+    stages = memory_timer.stages
+    cycles = len(list(outdir.rglob("*.bcl")))
+
+    # read and encode run one after the other: the encode peak adds to the memory
+    # kept by read
+    peaks = {
+        "ingest": stages["read"]["tracemalloc_delta"]
+        + stages["encode"]["tracemalloc_peak"],
+    }
+    for name in CEILINGS:
+        if name in stages:
+            peaks[name] = stages[name]["tracemalloc_peak"]
+    for name, ceiling in CEILINGS.items():
+        per_cluster = peaks[name] / READS
+        assert per_cluster <= ceiling(cycles), f"{name}: {per_cluster} bytes/cluster"
+    assert stages["read"]["peak_rss"] > 0
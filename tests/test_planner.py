@@ -0,0 +1,78 @@
+import gzip
+
+from fastq2bcl.planner import (
+    count_fastq_records,
+    mask_cycles,
+    estimate_output_bytes,
+    plan_conversion,
+    scan_line_offsets,
+)
+from fastq2bcl.synthetic import write_interleaved_fastq, write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_count_fastq_records(tmp_path):
+    assert count_fastq_records("data/test/01_single/test_single.fastq.gz") == 1
+    assert count_fastq_records("data/test/06_multi_samples/multi.R1.fastq.gz") == 2
+    fastq = tmp_path / "no_newline.fastq.gz"
+    with gzip.open(fastq, "wb") as f_out:
+        f_out.write(b"@r:1:A:1:1:1:1 1:N:0:1\nA\n+\nI\n" * 9 + b"@r 1:N:0:1\nA\n+\nI")
+    assert count_fastq_records(fastq) == 10
+    assert count_fastq_records(fastq, max_reads=3) == 3
+
+
+def test_scan_line_offsets(tmp_path):
+    fastq = tmp_path / "plain.fastq"
+    fastq.write_bytes(b"@r 1:N:0:1\nACGT\n+\nIIII\n" * 3 + b"@r 1:N:0:1\nA\n+\nI")
+    assert scan_line_offsets(fastq, [0, 4, 8, 12, 16]) == {0: 0, 4: 23, 8: 46, 12: 69}
+    assert scan_line_offsets(fastq, []) == {}
+    gz = tmp_path / "plain.fastq.gz"
+    gz.write_bytes(gzip.compress(fastq.read_bytes()))
+    assert scan_line_offsets(gz, [4]) is None
+
+
+def test_mask_cycles():
+    assert mask_cycles("110N") == 110
+    assert mask_cycles("296N8Y8Y309N") == 621
+
+
+def test_estimate_output_bytes(tmp_path):
+    # 1 cluster 1 cycle: bcl 5 + stats 108 + filter 13 + control 14 + locs 20
+    assert estimate_output_bytes(1, 1) == 160
+
+
+def test_plan_conversion():
+    plan = plan_conversion(
+        "data/test/05_multi_pair_double_index/R1.fastq.gz",
+        "data/test/05_multi_pair_double_index/R2.fastq.gz",
+        "data/test/05_multi_pair_double_index/RIndex1.fastq.gz",
+        "data/test/05_multi_pair_double_index/RIndex2.fastq.gz",
+        exclude_index=True,
+    )
+    assert plan["mask"] == "296N8Y8Y309N"
+    assert plan["clusters"] == 2
+    assert plan["cycles"] == 621
+    assert plan["output_bytes"] == 621 * (4 + 2 + 108) + 14 + 16 + 28
+    assert plan["recommended"]["tiles"] == 1
+    assert plan["recommended"]["chunk_size"] == 2
+
+    sampled = plan_conversion(
+        "data/test/06_multi_samples/multi.R1.fastq.gz", sample_n=1, mask_string="10N"
+    )
+    assert sampled["clusters"] == 1
+    assert sampled["input_clusters"] == 2
+    assert sampled["mask"] == "10N"
+
+
+def test_plan_conversion_interleaved(tmp_path):
+    files = write_synthetic_run(tmp_path, 10, "pair", length=12)
+    interleaved = write_interleaved_fastq(
+        tmp_path / "interleaved.fastq.gz", files["r1"], files["r2"]
+    )
+    plan = plan_conversion(interleaved, interleaved=True, max_reads=4)
+    assert plan["mask"] == "12N12N"
+    assert plan["input_clusters"] == 4
+    assert plan["memory_bytes"] == plan_conversion(**files, max_reads=4)["memory_bytes"]
@@ -0,0 +1,119 @@
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+import pytest
+
+from fastq2bcl.profiling import (
+    StageTimer,
+    peak_rss,
+    reset_peak_rss,
+    timed_call,
+    trace_event,
+)
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_trace_event():
+    event = trace_event("read", 10.0, 0.5, {"bytes": 3})
+    assert event["ph"] == "X"
+    assert event["ts"] == 10_000_000
+    assert event["dur"] == 500_000
+    assert event["pid"] == os.getpid()
+    assert event["args"] == {"bytes": 3}
+
+
+def test_timed_call():
+    result, event = timed_call("sum", sum, [1, 2, 3])
+    assert result == 6
+    assert event["name"] == "sum"
+    assert event["dur"] >= 0
+
+
+def test_stage_timer(tmp_path):
+    timer = StageTimer()
+    with timer.stage("read", nbytes=1000):
+        pass
+    with timer.stage("read", nbytes=1000):
+        pass
+    timer.add("write", 2.0, 1.0, 4_000_000)
+
+    report = {s["name"]: s for s in timer.report()["stages"]}
+    assert report["read"]["calls"] == 2
+    assert report["read"]["bytes"] == 2000
+    assert report["write"]["megabytes_per_second"] == 2.0
+    assert len(timer.trace()["traceEvents"]) == 2
+
+    timer.write_report(tmp_path / "report.json")
+    timer.write_trace(tmp_path / "trace.json")
+    assert json.loads((tmp_path / "report.json").read_text()) == timer.report()
+    assert "traceEvents" in json.loads((tmp_path / "trace.json").read_text())
+
+
+def test_peak_rss():
+    assert peak_rss() > 1024 * 1024
+
+
+def test_stage_peak_rss():
+    """each stage records its own peak, not the peak of the process lifetime"""
+    if not reset_peak_rss():
+        pytest.skip("peak RSS can not be reset")
+    size = 100 * 1024 * 1024
+    timer = StageTimer(peaks=True)
+    with timer.stage("outer"):
+        with timer.stage("allocate"):
+            data = bytearray(size)
+            data[::4096] = b"x" * len(range(0, size, 4096))
+            del data
+        with timer.stage("small"):
+            pass
+    stages = {stage["name"]: stage for stage in timer.report()["stages"]}
+    assert stages["allocate"]["peak_rss"] > stages["allocate"]["rss_start"] + size / 2
+    assert stages["small"]["peak_rss"] < stages["allocate"]["peak_rss"] - size / 2
+    # nested stages raise the peak of the stage in progress
+    assert stages["outer"]["peak_rss"] >= stages["allocate"]["peak_rss"]
+    assert timer.report()["peak_rss"] >= stages["allocate"]["peak_rss"]
+
+
+def test_stage_keeps_process_peak():
+    """without peaks=True stages do not reset the peak seen by getrusage"""
+    code = (
+        "import resource\n"
+        "from fastq2bcl.profiling import StageTimer, peak_rss\n"
+        "timer = StageTimer()\n"
+        "with timer.stage('allocate'):\n"
+        "    data = bytearray(200 * 1024 * 1024)\n"
+        "    data[::4096] = b'x' * len(range(0, len(data), 4096))\n"
+        "    del data\n"
+        "with timer.stage('small'):\n"
+        "    pass\n"
+        "stages = {s['name']: s for s in timer.report()['stages']}\n"
+        "assert 'peak_rss' not in stages['small']\n"
+        "assert stages['allocate']['peak_rss'] >= 200 * 1024 * 1024\n"
+        "print(peak_rss())\n"
+    )
+    if peak_rss() is None:
+        pytest.skip("peak RSS not available")
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert int(result.stdout) >= 200 * 1024 * 1024
+
+
+def test_stage_timer_memory():
+    timer = StageTimer(memory=True, peaks=True)
+    try:
+        with timer.stage("allocate"):
+            data = bytearray(1024 * 1024)
+            del data
+    finally:
+        tracemalloc.stop()
+    stage = timer.report()["stages"][0]
+    assert stage["tracemalloc_peak"] >= 1000 * 1000
+    assert stage["tracemalloc_delta"] < 1024 * 1024
+    assert stage["peak_rss"] > 0
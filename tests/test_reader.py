@@ -1,10 +1,22 @@
+import gzip
+
+import numpy as np
 import pytest
 
 from fastq2bcl.reader import (
     read_first_record,
     read_fastq_files,
+    read_fastq_segments,
+    iter_fastq_segments,
+    sample_records,
     get_mask_from_files,
+    iter_fastq_records,
+    record_id,
+    check_record_ids,
+    VALIDATE_LEVELS,
 )
+from fastq2bcl.planner import scan_line_offsets
+from fastq2bcl.synthetic import write_interleaved_fastq, write_synthetic_run
 
 __author__ = "Davide Rambaldi"
 __copyright__ = "Davide Rambaldi"
@@ -259,3 +271,187 @@ def test_seq_mismatch():
             True,
             True,
         )
+
+
+def write_fastq(path, count, read="1"):
+    """write a gzipped fastq with count records"""
+    with gzip.open(path, "wt") as f_out:
+        for n in range(count):
+            f_out.write(f"@run:1:ABCD:1:1101:{n}:{n} {read}:N:0:1\nACGT\n+\nIIII\n")
+    return path
+
+
+def test_read_fastq_files_max_reads(tmp_path):
+    r1 = write_fastq(tmp_path / "R1.fastq.gz", 100)
+    r2 = write_fastq(tmp_path / "R2.fastq.gz", 100, read="2")
+    seq, pos = read_fastq_files(r1, r2, None, None, True, True, max_reads=10)
+    assert len(seq) == 10
+    assert pos[-1] == ("9", "9")
+    assert seq[0][0] == "ACGTACGT"
+
+
+def test_iter_fastq_records_skip_reads(tmp_path):
+    files = write_synthetic_run(tmp_path, 30, "pair", length=8)
+    records = list(iter_fastq_records(files["r1"], files["r2"], None, None))
+    assert (
+        list(
+            iter_fastq_records(files["r1"], files["r2"], None, None, 10, skip_reads=12)
+        )
+        == records[12:22]
+    )
+    assert (
+        list(iter_fastq_records(files["r1"], files["r2"], None, None, skip_reads=40))
+        == []
+    )
+
+    # plain inputs seek to the offsets of the first kept record
+    plain = {}
+    for name in ["r1", "r2"]:
+        plain[name] = tmp_path / f"{name}.fastq"
+        plain[name].write_bytes(gzip.open(files[name]).read())
+    offsets = {name: scan_line_offsets(path, [48])[48] for name, path in plain.items()}
+    skipped = iter_fastq_records(
+        plain["r1"], plain["r2"], None, None, 10, skip_reads=12, offsets=offsets
+    )
+    assert list(skipped) == records[12:22]
+
+
+def test_iter_fastq_records_skip_interleaved(tmp_path):
+    files = write_synthetic_run(tmp_path, 20, "pair", length=8)
+    r1 = tmp_path / "interleaved.fastq.gz"
+    write_interleaved_fastq(r1, files["r1"], files["r2"])
+    records = list(iter_fastq_records(r1, None, None, None, interleaved=True))
+    skipped = iter_fastq_records(r1, None, None, None, 5, True, skip_reads=7)
+    assert list(skipped) == records[7:12]
+
+
+def test_sample_records():
+    records = list(range(1000))
+    fraction = list(sample_records(iter(records), sample_fraction=0.1, seed=1))
+    assert fraction == list(sample_records(iter(records), sample_fraction=0.1, seed=1))
+    assert fraction != list(sample_records(iter(records), sample_fraction=0.1, seed=2))
+    assert 50 < len(fraction) < 150
+    assert fraction == sorted(fraction)
+
+    reservoir = list(sample_records(iter(records), sample_n=10, seed=1))
+    assert len(reservoir) == 10
+    assert reservoir == sorted(reservoir)
+    assert list(sample_records(iter(range(5)), sample_n=10)) == list(range(5))
+    assert list(sample_records(iter(records))) == records
+
+    with pytest.raises(ValueError):
+        list(sample_records(iter(records), sample_fraction=1.5))
+    with pytest.raises(ValueError):
+        list(sample_records(iter(records), sample_fraction=0.5, sample_n=2))
+
+
+def test_read_fastq_segments_sampling(tmp_path):
+    r1 = write_fastq(tmp_path / "R1.fastq.gz", 100)
+    r2 = write_fastq(tmp_path / "R2.fastq.gz", 100, read="2")
+    columns = read_fastq_segments(r1, r2, None, None, sample_n=5, seed=3)
+    sequences, positions = read_fastq_files(
+        r1, r2, None, None, True, True, sample_n=5, seed=3
+    )
+    # same clusters in R1 and R2, same as read_fastq_files
+    assert columns["positions"].tolist() == [[int(x), int(y)] for x, y in positions]
+    assert columns["R1_lengths"].tolist() == [4] * 5
+    assert columns["R2_lengths"].tolist() == [4] * 5
+
+
+def test_iter_fastq_segments_chunks(tmp_path):
+    files = write_synthetic_run(tmp_path, 10, "dual_index", length=6)
+    columns = read_fastq_segments(**files)
+    chunks = list(iter_fastq_segments(**files, chunk_size=4))
+    assert [len(c["positions"]) for c in chunks] == [4, 4, 2]
+    for name, values in columns.items():
+        assert np.concatenate([c[name] for c in chunks]).tolist() == values.tolist()
+    # an exact number of chunks, empty inputs give one empty chunk
+    assert len(list(iter_fastq_segments(**files, chunk_size=5))) == 2
+    empty = write_fastq(tmp_path / "empty.fastq.gz", 0)
+    chunks = list(iter_fastq_segments(empty, None, None, None, chunk_size=5))
+    assert len(chunks) == 1 and len(chunks[0]["positions"]) == 0
+
+
+def test_record_id():
+    assert record_id("run:1:ABCD:1:1101:1:1 1:N:0:1") == "run:1:ABCD:1:1101:1:1"
+    assert record_id("read7/1") == record_id("read7/2") == "read7"
+
+
+def test_read_interleaved(tmp_path):
+    files = write_synthetic_run(tmp_path, 20, "pair", length=12)
+    interleaved = write_interleaved_fastq(
+        tmp_path / "interleaved.fastq.gz", files["r1"], files["r2"]
+    )
+    assert get_mask_from_files(
+        interleaved, None, None, None, False, False, interleaved=True
+    ) == get_mask_from_files(**files, exclude_umi=False, exclude_index=False)
+    assert list(iter_fastq_records(interleaved, None, None, None, 5, True)) == list(
+        iter_fastq_records(**files, max_reads=5)
+    )
+    columns = read_fastq_segments(interleaved, None, None, None, interleaved=True)
+    expected = read_fastq_segments(**files)
+    assert columns.keys() == expected.keys()
+    for name, values in expected.items():
+        assert (columns[name] == values).all()
+
+    with pytest.raises(ValueError, match="do not give R2"):
+        list(iter_fastq_records(interleaved, files["r2"], None, None, None, True))
+
+
+def test_read_interleaved_errors(tmp_path):
+    unsorted = write_fastq(tmp_path / "unsorted.fastq.gz", 4)
+    with pytest.raises(ValueError, match="Seq ID mismatch"):
+        list(iter_fastq_records(unsorted, None, None, None, None, True))
+    unpaired = tmp_path / "unpaired.fastq.gz"
+    with gzip.open(unpaired, "wt") as f_out:
+        f_out.write("@read0/1\nACGT\n+\nIIII\n@read0/2\nACGT\n+\nIIII\n")
+        f_out.write("@read1/1\nACGT\n+\nIIII\n")
+    with pytest.raises(ValueError, match="without R2"):
+        list(iter_fastq_records(unpaired, None, None, None, None, True))
+
+
+@pytest.mark.parametrize("validate", VALIDATE_LEVELS)
+def test_truncated_files(tmp_path, validate):
+    r1 = write_fastq(tmp_path / "R1.fastq.gz", 10)
+    short = write_fastq(tmp_path / "short.fastq.gz", 7, read="2")
+    with pytest.raises(ValueError, match="R2 truncated"):
+        list(iter_fastq_records(r1, short, None, None, validate=validate))
+    with pytest.raises(ValueError, match="R1 ended after 7 records, R2 not"):
+        list(iter_fastq_records(short, r1, None, None, validate=validate))
+    # max_reads stops before the end of the files
+    assert (
+        len(list(iter_fastq_records(r1, short, None, None, 5, validate=validate))) == 5
+    )
+
+
+def test_check_record_ids():
+    def batch(ids_1, ids_2):
+        return [
+            [(f"{i} 1:N:0:1", "A", "I") for i in ids_1],
+            [(f"{i} 2:N:0:1", "A", "I") for i in ids_2],
+        ]
+
+    good = batch(range(2500), range(2500))
+    bad = batch(range(2500), [*range(1500), 0, *range(1501, 2500)])
+    for validate in VALIDATE_LEVELS:
+        check_record_ids(good, validate)
+    check_record_ids(bad, "none")
+    # sampled checks clusters 0, 1000 and 2000 of the files
+    check_record_ids(bad, "sampled")
+    with pytest.raises(ValueError, match="Seq ID mismatch for record 0 R1 is 1500"):
+        check_record_ids(bad, "sampled", first=500)
+    for validate in ["batched", "full"]:
+        with pytest.raises(ValueError, match="R1 is 1500"):
+            check_record_ids(bad, validate)
+    # mates with /1 and /2 suffixes
+    check_record_ids(batch(["a/1", "b/1"], ["a/2", "b/2"]), "batched")
+    with pytest.raises(ValueError):
+        list(
+            iter_fastq_records(
+                "data/test/01_single/test_single.fastq.gz",
+                None,
+                None,
+                None,
+                validate="all",
+            )
+        )
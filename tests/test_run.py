@@ -0,0 +1,56 @@
+import pytest
+
+from fastq2bcl.run import choose_executor, mock_run_id, set_mask
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+test_fields = {
+    "instrument": "M11111",
+    "run_number": "222",
+    "flowcell_id": "000000000-K9H97",
+    "lane": "1",
+    "tile": "1101",
+    "x_pos": "19304",
+    "y_pos": "1328",
+    "UMI": "AAACGGG",
+    "read": "1",
+    "is_filtered": "N",
+    "control_number": "0",
+    "index": "1",
+}
+
+expected_mask_110N = [{"cycles": "110", "index": "N", "id": "1"}]
+expected_mask_110N10Y10Y110N = [
+    {"cycles": "110", "index": "N", "id": "1"},
+    {"cycles": "10", "index": "Y", "id": "2"},
+    {"cycles": "10", "index": "Y", "id": "3"},
+    {"cycles": "110", "index": "N", "id": "4"},
+]
+
+
+def test_mock_run_id():
+    """Mock run id Tests"""
+    assert mock_run_id(test_fields) == "YYMMDD_M11111_0222_000000000-K9H97"
+
+
+def test_set_mask():
+    """Test mask generation"""
+    assert set_mask("110N") == expected_mask_110N
+    assert set_mask("110N10Y10Y110N") == expected_mask_110N10Y10Y110N
+    with pytest.raises(ValueError):
+        set_mask(None)
+    with pytest.raises(ValueError):
+        set_mask("100")
+
+
+def test_choose_executor():
+    assert choose_executor("auto", 1, 10**6, 100) == "serial"
+    assert choose_executor("processes", 1, 10**6, 100) == "serial"
+    assert choose_executor("auto", 4, 10, 100) == "serial"
+    assert choose_executor("auto", 4, 10**6, 100) == "threads"
+    assert choose_executor("processes", 4, 10, 100) == "processes"
+    assert choose_executor("threads", 4, 10, 100) == "threads"
+    with pytest.raises(ValueError):
+        choose_executor("fibers", 4, 10, 100)
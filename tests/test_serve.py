@@ -0,0 +1,174 @@
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from fastq2bcl.cli import fastq2bcl, parse_serve_args
+from fastq2bcl.serve import (
+    CancellableTimer,
+    ConversionService,
+    JobCancelled,
+    create_server,
+    is_loopback,
+    parse_address,
+    request,
+)
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def service():
+    service = ConversionService(workers=2, executor="threads")
+    yield service
+    service.close()
+
+
+def job_options(files, outdir):
+    options = {name: str(path) for name, path in files.items() if path}
+    return dict(options, outdir=str(outdir))
+
+
+def test_parse_address():
+    assert parse_address("unix:/tmp/f.sock") == (socket.AF_UNIX, "/tmp/f.sock")
+    assert parse_address("8080")[1] == ("127.0.0.1", 8080)
+    assert parse_address("0.0.0.0:80")[1] == ("0.0.0.0", 80)
+
+
+def test_cancellable_timer():
+    cancelled = threading.Event()
+    timer = CancellableTimer(cancelled)
+    with timer.stage("read"):
+        cancelled.set()
+    with pytest.raises(JobCancelled, match="before write"):
+        with timer.stage("write"):
+            pass
+    assert list(timer.stages) == ["read"]
+
+
+def test_service_jobs(tmp_path, service):
+    files = write_synthetic_run(tmp_path / "input", 40, "pair", length=8)
+    (tmp_path / "direct").mkdir()
+    _, direct, _, _ = fastq2bcl(tmp_path / "direct", **files)
+    pool = service.pools["threads"]
+    for name in ["first", "second"]:
+        (tmp_path / name).mkdir()
+        job = service.submit(job_options(files, tmp_path / name))
+        status = service.wait(job["id"], timeout=60)
+        assert status["status"] == "done", status.get("error")
+        rundir = tmp_path / name / direct.name
+        assert status["result"]["rundir"] == str(rundir)
+        bcl = "Data/Intensities/BaseCalls/L001/C9.1/s_1_1101.bcl"
+        assert (rundir / bcl).read_bytes() == (direct / bcl).read_bytes()
+        assert "write_block" in {stage["name"] for stage in status["stages"]}
+    # the warm pool is shared by the jobs
+    assert service.pools["threads"] is pool
+
+    failed = service.submit({"outdir": str(tmp_path), "r1": str(tmp_path / "missing")})
+    assert service.wait(failed["id"], timeout=60)["status"] == "failed"
+    with pytest.raises(ValueError, match="Unknown job options"):
+        service.submit({"outdir": str(tmp_path), "r1": "R1", "executor": "x"})
+    with pytest.raises(ValueError, match="Missing job options"):
+        service.submit({"outdir": str(tmp_path)})
+    with pytest.raises(ValueError, match="stdin"):
+        service.submit({"outdir": str(tmp_path), "r1": "R1", "r2": "-"})
+
+
+def test_cancel_queued_job(tmp_path, service):
+    files = write_synthetic_run(tmp_path / "input", 10, "single", length=8)
+    release = threading.Event()
+    # keep the job runner busy
+    service.runner.submit(release.wait)
+    job = service.submit(job_options(files, tmp_path))
+    assert service.cancel(job["id"])["status"] == "cancelled"
+    release.set()
+    assert service.wait(job["id"], timeout=60)["status"] == "cancelled"
+    assert service.cancel("unknown") is None
+
+
+def test_unix_socket_api(tmp_path, service):
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=8)
+    address = f"unix:{tmp_path / 'fastq2bcl.sock'}"
+    server = create_server(address, service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert request(address, "GET", "/health") == (200, {"status": "ok", "jobs": 0})
+        code, job = request(address, "POST", "/jobs", job_options(files, tmp_path))
+        assert code == 201
+        for _ in range(600):
+            code, status = request(address, "GET", f"/jobs/{job['id']}")
+            if status["status"] not in ["queued", "running"]:
+                break
+            time.sleep(0.05)
+        assert status["status"] == "done", status.get("error")
+        assert request(address, "GET", "/jobs")[1][0]["id"] == job["id"]
+        assert request(address, "DELETE", "/jobs/unknown")[0] == 404
+        code, error = request(address, "POST", "/jobs", {"r1": "R1"})
+        assert code == 400 and "outdir" in error["error"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_serve_usage():
+    args = parse_serve_args(["--socket", "f.sock", "-T", "2"])
+    assert (args.socket, args.threads, args.jobs) == ("f.sock", 2, 1)
+    with pytest.raises(SystemExit):
+        parse_serve_args(["--socket", "f.sock", "--port", "80"])
+    assert parse_serve_args(["--port", "80", "--host", "localhost"]).port == 80
+    with pytest.raises(SystemExit):
+        parse_serve_args(["--port", "80", "--host", "0.0.0.0"])
+
+
+def test_loopback_only(service):
+    assert is_loopback("127.0.0.1") and is_loopback("localhost")
+    assert not is_loopback("0.0.0.0") and not is_loopback("10.0.0.1")
+    with pytest.raises(ValueError, match="no authentication"):
+        create_server("0.0.0.0:0", service)
+
+
+def test_tcp_rejects_web_requests(tmp_path, service):
+    files = write_synthetic_run(tmp_path / "input", 4, "single", length=8)
+    body = json.dumps(job_options(files, tmp_path))
+    server = create_server("127.0.0.1:0", service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+
+    def send(method, path, headers, data=None):
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        try:
+            connection.putrequest(method, path, skip_host=True)
+            for name, value in headers.items():
+                connection.putheader(name, value)
+            connection.putheader("Content-Length", str(len(data or "")))
+            connection.endheaders(data and data.encode())
+            return connection.getresponse().status
+        finally:
+            connection.close()
+
+    local = f"127.0.0.1:{port}"
+    try:
+        # a cross-origin "simple" request of a web page
+        text = {"Host": local, "Content-Type": "text/plain"}
+        assert send("POST", "/jobs", text, body) == 415
+        json_type = {"Content-Type": "application/json"}
+        assert send("POST", "/jobs", dict(json_type, Host="evil.example"), body) == 403
+        origin = {"Host": local, "Origin": "https://evil.example"}
+        assert send("POST", "/jobs", dict(json_type, **origin), body) == 403
+        assert send("GET", "/jobs", origin) == 403
+        assert send("DELETE", "/jobs/x", {"Host": "evil.example:80"}) == 403
+        assert not service.jobs
+        local_origin = {"Host": f"localhost:{port}", "Origin": f"http://[::1]:{port}"}
+        assert send("GET", "/health", local_origin) == 200
+        assert request(f"127.0.0.1:{port}", "GET", "/health")[0] == 200
+    finally:
+        server.shutdown()
+        server.server_close()
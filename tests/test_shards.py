@@ -0,0 +1,140 @@
+import gzip
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from fastq2bcl.bcl import read_bcl, read_locs, read_run_info
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.shards import (
+    SHARD_FILE,
+    convert_shard,
+    load_plan,
+    merge_shards,
+    plan_shards,
+)
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.verify import check_run, run_tiles, verify_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def tile_bcls(rundir, tiles, cycle):
+    cycledir = rundir / f"Data/Intensities/BaseCalls/L001/C{cycle}.1"
+    return np.concatenate([read_bcl(cycledir / f"s_1_{tile}.bcl") for tile in tiles])
+
+
+def test_plan_shards(tmp_path):
+    files = write_synthetic_run(tmp_path, 10, "pair", length=8)
+    plan = plan_shards(**files, shards=3)
+    assert plan["cluster_count"] == 10
+    assert plan["mask"] == "8N8N"
+    assert [(s["tile"], s["start"], s["stop"]) for s in plan["shards"]] == [
+        (1101, 0, 3),
+        (1102, 3, 6),
+        (1103, 6, 10),
+    ]
+    assert all(s["offsets"] == {} for s in plan["shards"])
+    with pytest.raises(ValueError, match="can not be split"):
+        plan_shards(**files, shards=11)
+
+
+def test_shards_plain_offsets(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=8)
+    for name in ["r1", "r2"]:
+        plain = tmp_path / f"{name}.fastq"
+        plain.write_bytes(gzip.open(files[name]).read())
+        files[name] = plain
+    plan = plan_shards(**files, shards=3)
+    assert plan["shards"][0]["offsets"] == {"r1": 0, "r2": 0}
+    lines = files["r1"].read_bytes().splitlines(keepends=True)
+    assert plan["shards"][1]["offsets"]["r1"] == sum(map(len, lines[: 4 * 6]))
+    shard_dirs = [
+        convert_shard(plan, shard, tmp_path / f"shard_{shard}") for shard in range(3)
+    ]
+    rundir = merge_shards(plan, shard_dirs, tmp_path)
+    assert verify_run(rundir, **files)["ok"]
+
+
+def test_shards_match_single_run(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 45, "dual_index", length=10)
+    (tmp_path / "single").mkdir()
+    _, single, _, _ = fastq2bcl(tmp_path / "single", **files)
+    plan = plan_shards(**files, shards=4)
+    shard_dirs = [
+        convert_shard(plan, shard, tmp_path / f"shard_{shard}", threads=2)
+        for shard in range(4)
+    ]
+    sheet = tmp_path / "SampleSheet.csv"
+    sheet.write_text("[Header]\n")
+    rundir = merge_shards(plan, reversed(shard_dirs), tmp_path, sample_sheet=sheet)
+
+    assert rundir.name == single.name
+    assert (rundir / "SampleSheet.csv").read_text() == "[Header]\n"
+    assert 'TileCount="4"' in (rundir / "RunInfo.xml").read_text()
+    assert read_run_info(rundir) == read_run_info(single)
+    tiles = run_tiles(rundir)
+    assert tiles == [1101, 1102, 1103, 1104]
+    assert check_run(rundir) == []
+    report = verify_run(rundir, **files)
+    assert report["ok"], report["differences"]
+    assert report["clusters"] == 45
+    # merged tiles hold the clusters of the single run in order, without copies
+    for cycle in [1, 20, 36]:
+        np.testing.assert_array_equal(
+            tile_bcls(rundir, tiles, cycle), tile_bcls(single, [1101], cycle)
+        )
+    locs = np.concatenate(
+        [read_locs(rundir / f"Data/Intensities/L001/s_1_{tile}.locs") for tile in tiles]
+    )
+    np.testing.assert_array_equal(
+        locs, read_locs(single / "Data/Intensities/L001/s_1_1101.locs")
+    )
+    bcl = "Data/Intensities/BaseCalls/L001/C1.1/s_1_1102.bcl"
+    assert (rundir / bcl).stat().st_ino == (shard_dirs[1] / bcl).stat().st_ino
+
+    with pytest.raises(ValueError, match=r"Missing shards \[3\]"):
+        merge_shards(plan, shard_dirs[:3], tmp_path / "partial")
+
+
+def test_shard_processes(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 30, "pair", length=8)
+    plan_path = tmp_path / "plan.json"
+    args = ["-r1", str(files["r1"]), "-r2", str(files["r2"])]
+    main(["split", *args, "-n", "3", "-o", str(plan_path)])
+    assert len(load_plan(plan_path)["shards"]) == 3
+
+    # each shard converted by its own process
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "fastq2bcl.cli",
+                "convert-shard",
+                str(plan_path),
+                "--shard",
+                str(shard),
+                "-o",
+                str(tmp_path / f"shard_{shard}"),
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+        for shard in range(3)
+    ]
+    assert [process.wait() for process in processes] == [0, 0, 0]
+    assert (tmp_path / "shard_2" / SHARD_FILE).is_file()
+
+    shards = [str(tmp_path / f"shard_{shard}") for shard in range(3)]
+    main(["merge", str(plan_path), *shards, "-o", str(tmp_path), "--check"])
+    rundir = tmp_path / load_plan(plan_path)["run_id"]
+    assert run_tiles(rundir) == [1101, 1102, 1103]
+
+
+def test_split_usage(tmp_path):
+    files = write_synthetic_run(tmp_path, 10, "single", length=8)
+    with pytest.raises(SystemExit):
+        main(["split", "-r1", str(files["r1"]), "--sample-n", "5"])
@@ -0,0 +1,101 @@
+import pytest
+
+from fastq2bcl import layout
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.manifest import MANIFEST_FILENAME
+from fastq2bcl.staging import prepare_staging, publish, staging_path, sync_tree
+from fastq2bcl.synthetic import write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_prepare_staging(tmp_path):
+    rundir = tmp_path / "run"
+    staging = prepare_staging(rundir)
+    assert staging == tmp_path / ".run.staging" == staging_path(rundir)
+    (staging / "partial.bcl").write_bytes(b"1")
+    # an interrupted run is resumed, or discarded
+    assert (prepare_staging(rundir, resume=True) / "partial.bcl").is_file()
+    assert not (prepare_staging(rundir) / "partial.bcl").exists()
+
+    (staging / "RunInfo.xml").write_text("new")
+    rundir.mkdir()
+    (rundir / "RunInfo.xml").write_text("old")
+    assert publish(staging, rundir, "strict") == rundir
+    assert (rundir / "RunInfo.xml").read_text() == "new"
+    assert not staging.exists()
+    assert not (tmp_path / ".run.old").exists()
+    # a published run is linked in staging to resume it, and stays published
+    assert (prepare_staging(rundir, resume=True) / "RunInfo.xml").is_file()
+    assert (rundir / "RunInfo.xml").stat().st_nlink == 2
+
+
+@pytest.mark.parametrize("durability", ["none", "batch", "strict"])
+def test_sync_tree(tmp_path, durability):
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file").write_bytes(b"data")
+    sync_tree(tmp_path, durability)
+    with pytest.raises(ValueError, match="Unknown durability"):
+        sync_tree(tmp_path, "fast")
+
+
+def test_killed_run_is_not_published(tmp_path, monkeypatch):
+    files = write_synthetic_run(tmp_path / "input", 30, "pair", length=8)
+    (tmp_path / "complete").mkdir()
+    _, complete, _, _ = fastq2bcl(tmp_path / "complete", **files)
+    write_cycle_block = layout.write_cycle_block
+
+    def crash(path, start, block):
+        if "C5.1" in str(path):
+            raise KeyboardInterrupt
+        write_cycle_block(path, start, block)
+
+    monkeypatch.setattr(layout, "write_cycle_block", crash)
+    with pytest.raises(KeyboardInterrupt):
+        fastq2bcl(tmp_path, **files)
+    rundir = tmp_path / complete.name
+    assert not rundir.exists()
+    assert (staging_path(rundir) / MANIFEST_FILENAME).is_file()
+
+    monkeypatch.setattr(layout, "write_cycle_block", write_cycle_block)
+    fastq2bcl(tmp_path, **files, resume=True, check=True)
+    assert not staging_path(rundir).exists()
+    assert {p.relative_to(rundir): p.read_bytes() for p in rundir.rglob("*.bcl")} == {
+        p.relative_to(complete): p.read_bytes() for p in complete.rglob("*.bcl")
+    }
+
+
+def test_failed_resume_keeps_published_run(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 20, "pair", length=8)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **files)
+    published = {p: p.read_bytes() for p in rundir.rglob("*") if p.is_file()}
+    other = write_synthetic_run(tmp_path / "other", 10, "pair", length=8)
+    with pytest.raises(ValueError):
+        fastq2bcl(tmp_path, files["r1"], other["r2"], resume=True)
+    assert {p: p.read_bytes() for p in published} == published
+    assert set(p for p in rundir.rglob("*") if p.is_file()) == set(published)
+
+
+def test_check_failure_is_not_published(tmp_path, monkeypatch):
+    files = write_synthetic_run(tmp_path / "input", 10, "single", length=8)
+    monkeypatch.setattr(
+        "fastq2bcl.verify.check_run", lambda rundir, workers, checksums=False: ["bad"]
+    )
+    with pytest.raises(ValueError, match="bad"):
+        _, rundir, _, _ = fastq2bcl(tmp_path, **files, check=True)
+    assert [p.name for p in tmp_path.iterdir() if p.name != "input"] == [
+        ".YYMMDD_SIM_0001_FC0001.staging"
+    ]
+
+
+def test_durability_usage(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 10, "pair", length=8)
+    args = ["-r1", str(files["r1"]), "-r2", str(files["r2"]), "-o", str(tmp_path)]
+    main(args + ["--durability", "strict"])
+    rundir = tmp_path / "YYMMDD_SIM_0001_FC0001"
+    assert (rundir / MANIFEST_FILENAME).is_file()
+    assert not staging_path(rundir).exists()
+    with pytest.raises(SystemExit):
+        main(args + ["--durability", "fast"])
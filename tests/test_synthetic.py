@@ -0,0 +1,49 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from fastq2bcl.reader import read_fastq_files, get_mask_from_files
+from fastq2bcl.synthetic import digits, write_synthetic_fastq, write_synthetic_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def test_digits():
+    assert digits(np.array([7, 1234]), 4).tobytes() == b"00071234"
+
+
+def test_write_synthetic_fastq(tmp_path):
+    fastq = write_synthetic_fastq(tmp_path / "R1.fastq.gz", 3, length=10, seed=1)
+    lines = gzip.open(fastq, "rt").read().splitlines()
+    assert len(lines) == 12
+    assert lines[0] == "@SIM:1:FC0001:1:1101:0001000:0001000 1:N:0:1"
+    assert len(lines[1]) == 10
+    again = write_synthetic_fastq(tmp_path / "again.fastq.gz", 3, length=10, seed=1)
+    assert gzip.open(again).read() == gzip.open(fastq).read()
+
+
+@pytest.mark.parametrize(
+    "mode,mask",
+    [
+        ("single", "100N"),
+        ("pair", "100N100N"),
+        ("dual_index", "100N8Y8Y100N"),
+        ("umi", "100N8Y"),
+    ],
+)
+def test_write_synthetic_run(tmp_path, mode, mask):
+    files = write_synthetic_run(tmp_path, 5, mode)
+    assert get_mask_from_files(**files, exclude_umi=False, exclude_index=False) == mask
+    sequences, positions = read_fastq_files(
+        **files, exclude_umi=False, exclude_index=False
+    )
+    assert len(sequences) == 5
+    assert positions[4] == ("0001000", "0001004")
+
+
+def test_write_synthetic_run_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        write_synthetic_run(tmp_path, 5, "triple")
@@ -0,0 +1,136 @@
+import pytest
+
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.parser import parse_seqdesc_fields
+from fastq2bcl.reader import iter_fastq_records
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.tables import (
+    binary_buffers,
+    read_table_batches,
+    table_batch,
+    table_format,
+)
+from fastq2bcl.writer import FILTER_FILE
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+def fastq_table(files):
+    """table of the records of fastq files, with the columns of a read table"""
+    records = list(iter_fastq_records(**files))
+    columns = [
+        ("r1", "sequence", "quality"),
+        ("i1", "index1", "index1_quality"),
+        ("i2", "index2", "index2_quality"),
+        ("r2", "sequence2", "quality2"),
+    ]
+    table = {"name": [r[0][0] for r in records]}
+    present = [(seq, qual) for name, seq, qual in columns if files[name]]
+    for i, (sequence, quality) in enumerate(present):
+        table[sequence] = [r[i][1] for r in records]
+        table[quality] = [r[i][2] for r in records]
+    fields = [parse_seqdesc_fields(r[0][0]) for r in records]
+    table["lane"] = [int(f["lane"]) for f in fields]
+    table["tile"] = [int(f["tile"]) for f in fields]
+    table["x"] = [int(f["x_pos"]) for f in fields]
+    table["y"] = [int(f["y_pos"]) for f in fields]
+    table["filter"] = [f["is_filtered"] != "Y" for f in fields]
+    return pa.table(table)
+
+
+def run_files(rundir):
+    return {
+        p.relative_to(rundir).as_posix(): p.read_bytes()
+        for p in rundir.rglob("*")
+        if p.is_file() and p.suffix != ".json"
+    }
+
+
+def test_binary_buffers():
+    array = pa.array(["ACG", "T", "GG"])
+    data, lengths = binary_buffers(array, "sequence")
+    assert data.tobytes() == b"ACGTGG"
+    assert lengths.tolist() == [3, 1, 2]
+    # no copy of the arrow buffer
+    assert not data.flags.owndata
+    # slices of arrays
+    data, lengths = binary_buffers(array.slice(1), "sequence")
+    assert data.tobytes() == b"TGG" and lengths.tolist() == [1, 2]
+    data, lengths = binary_buffers(pa.array(["AC", "GT"], pa.large_string()), "s")
+    assert data.tobytes() == b"ACGT"
+    data, lengths = binary_buffers(pa.array([b"AC", b"GT"], pa.binary(2)), "s")
+    assert data.tobytes() == b"ACGT" and lengths.tolist() == [2, 2]
+    with pytest.raises(ValueError, match="null values"):
+        binary_buffers(pa.array(["A", None]), "sequence")
+    with pytest.raises(ValueError, match="not a string column"):
+        binary_buffers(pa.array([1, 2]), "sequence")
+
+
+def test_table_batch():
+    batch = pa.record_batch(
+        {
+            "sequence": ["ACGT", "AC"],
+            "quality": ["IIII", "##"],
+            "lane": [1, 1],
+            "x": [5, 6],
+            "y": [7, 8],
+        }
+    )
+    result = table_batch(batch)
+    bases, phred, lengths = result["R1"]
+    assert bases.tobytes() == b"ACGTAC"
+    assert phred.tolist() == [40] * 4 + [2] * 2
+    assert result["positions"].tolist() == [[5, 7], [6, 8]]
+    assert result["lane"] == 1
+    with pytest.raises(ValueError, match="Only tile 1101"):
+        table_batch(pa.record_batch({"sequence": ["A", "C"], "tile": [1101, 1102]}))
+    with pytest.raises(ValueError, match="differ in length"):
+        table_batch(pa.record_batch({"sequence": ["AC"], "quality": ["I"]}))
+    with pytest.raises(ValueError, match="x and y"):
+        table_batch(pa.record_batch({"sequence": ["A"], "x": [1]}))
+
+
+@pytest.mark.parametrize("kind", ["parquet", "arrow", "arrows"])
+def test_table_as_fastq2bcl(tmp_path, kind):
+    """same run from fastq files and from a read table of their records"""
+    files = write_synthetic_run(tmp_path / "input", 50, "dual_index", length=12)
+    (tmp_path / "fastq").mkdir()
+    _, fastq_rundir, _, fastq_mask = fastq2bcl(tmp_path / "fastq", **files)
+
+    table = fastq_table(files)
+    path = tmp_path / f"reads.{kind}"
+    if kind == "parquet":
+        pq.write_table(table, path, row_group_size=16)
+    else:
+        writer_class = pa.ipc.new_file if kind == "arrow" else pa.ipc.new_stream
+        with writer_class(str(path), table.schema) as writer:
+            writer.write_table(table, max_chunksize=16)
+    assert table_format(path) == {"arrows": "arrow_stream"}.get(kind, kind)
+    assert len(list(read_table_batches(path, batch_size=16))) == 4
+
+    (tmp_path / "table").mkdir()
+    run_id, rundir, fields, mask = fastq2bcl(tmp_path / "table", path, threads=2)
+    assert fields is None
+    assert mask == fastq_mask
+    assert run_files(rundir) == run_files(fastq_rundir)
+
+
+def test_table_usage(tmp_path, capsys):
+    path = tmp_path / "reads.parquet"
+    pq.write_table(
+        pa.table({"sequence": ["ACGT"] * 3, "filter": [True, False, True]}), path
+    )
+    main(["-r1", str(path), "-o", str(tmp_path)])
+    assert "Read table: " in capsys.readouterr().out
+    rundir = tmp_path / "YYMMDD_SIM_0001_FC0001"
+    assert (rundir / FILTER_FILE).read_bytes()[12:] == b"\x01\x00\x01"
+    with pytest.raises(ValueError, match="do not support \\['sampling'\\]"):
+        fastq2bcl(tmp_path, path, max_reads=2)
+    assert table_format(tmp_path / "missing.parquet") is None
+    fastq = write_synthetic_run(tmp_path / "input", 1, "single")["r1"]
+    assert table_format(fastq) is None
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+from fastq2bcl.bcl import find_cycle_bcls
+from fastq2bcl.cli import fastq2bcl, main
+from fastq2bcl.layout import BCL_HEADER_SIZE
+from fastq2bcl.synthetic import write_synthetic_run
+from fastq2bcl.verify import check_run, verify_run
+
+__author__ = "Davide Rambaldi"
+__copyright__ = "Davide Rambaldi"
+__license__ = "MIT"
+
+
+@pytest.fixture
+def run(tmp_path):
+    files = write_synthetic_run(tmp_path / "input", 40, "umi", length=10)
+    _, rundir, _, _ = fastq2bcl(tmp_path, **files, exclude_umi=True)
+    return files, rundir
+
+
+def test_verify_run(run):
+    files, rundir = run
+    report = verify_run(rundir, **files, exclude_umi=True)
+    assert report["ok"]
+    assert report["clusters"] == 40
+    assert report["cycles"] == 10
+
+    # the UMI cycles are not in the run
+    report = verify_run(rundir, **files)
+    assert report["differences"] == {"cycles": 8}
+    report = verify_run(rundir, **files, exclude_umi=True, sampling={"max_reads": 5})
+    assert report["differences"] == {"cluster_count": 35}
+
+
+def test_verify_run_differences(run):
+    files, rundir = run
+    path = find_cycle_bcls(rundir)[2]
+    data = bytearray(path.read_bytes())
+    data[BCL_HEADER_SIZE + 7] ^= 1
+    path.write_bytes(bytes(data))
+    report = verify_run(rundir, **files, exclude_umi=True)
+    assert not report["ok"]
+    assert report["differences"] == {"C3.1": 1}
+    example = report["examples"][0]
+    assert example["cluster"] == 7
+    assert example["expected"][0][0][2] != example["found"][0][0][2]
+    assert example["expected"][0][1] == example["found"][0][1]
+
+
+def test_verify_usage(run, tmp_path, capsys):
+    """CLI Tests of the verify command"""
+    files, rundir = run
+    args = ["verify", str(rundir), "-r1", str(files["r1"]), "--exclude-umi"]
+    main(args + ["--report", str(tmp_path / "report.json")])
+    assert "No differences" in capsys.readouterr().out
+    assert json.loads((tmp_path / "report.json").read_text())["ok"]
+
+    with pytest.raises(SystemExit) as excinfo:
+        main(args[:-1])
+    assert excinfo.value.code == 1
+    assert "cycles" in capsys.readouterr().out
+
+
+def test_check_run(run, monkeypatch):
+    _, rundir = run
+    assert check_run(rundir, workers=2) == []
+    with monkeypatch.context() as patch:
+        # windows has no pread
+        patch.delattr("os.pread")
+        assert check_run(rundir) == []
+    assert check_run(rundir, checksums=True) == ["no checksum file"]
+
+    paths = find_cycle_bcls(rundir)
+    with open(paths[0], "r+b") as f_out:
+        f_out.truncate(20)
+    with open(paths[1], "r+b") as f_out:
+        f_out.write((41).to_bytes(4, "little"))
+    paths[2].parent.joinpath("s_1_1101.stats").unlink()
+    problems = check_run(rundir, workers=3)
+    assert problems == [
+        "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl: 20 bytes, expected 44",
+        "Data/Intensities/BaseCalls/L001/C2.1/s_1_1101.bcl: header count 41, filter 40",
+        "Data/Intensities/BaseCalls/L001/C3.1/s_1_1101.stats: missing",
+    ]
+
+    paths[3].parent.rename(rundir / "C4.1")
+    assert "RunInfo.xml has 10 cycles, 9 cycle directories" in check_run(rundir)
+
+
+def test_check_usage(tmp_path, capsys):
+    """CLI Tests with --check, --checksums and the check command"""
+    files = write_synthetic_run(tmp_path / "input", 20, "single", length=8)
+    args = ["-o", str(tmp_path), "-r1", str(files["r1"])]
+    main(args + ["--check", "--checksums", "blake2"])
+    rundir = tmp_path / "YYMMDD_SIM_0001_FC0001"
+    main(["check", str(rundir), "--verify-checksums"])
+    assert "Valid run directory" in capsys.readouterr().out
+
+    (rundir / "Data/Intensities/BaseCalls/L001/C8.1/s_1_1101.bcl").write_bytes(b"")
+    with pytest.raises(SystemExit):
+        main(["check", str(rundir), "-T", "2"])
+    assert "C8.1/s_1_1101.bcl: 0 bytes, expected 24" in capsys.readouterr().out
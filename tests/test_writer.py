@@ -1,3 +1,5 @@
+import numpy as np
+
 from fastq2bcl.writer import (
     write_run_info_xml,
     generate_run_info_xml,
@@ -12,6 +14,9 @@ from fastq2bcl.writer import (
     append_data_to_bcl,
     write_stat_file,
     write_bcl_and_stats,
+    encode_bcl_bytes,
+    encode_locs,
+    write_cycle_column,
 )
 
 __author__ = "Davide Rambaldi"
@@ -179,3 +184,25 @@ def test_write_stat_file(tmp_path):
     with open(statsout, "rb") as binfile:
         binary_content = binfile.read()
         assert binary_content == expected_stats
+
+
+def test_encode_bcl_bytes():
+    bases = np.frombuffer(b"ACGTN", dtype=np.uint8)
+    quals = np.array([1, 2, 3, 40, 40], dtype=np.uint8)
+    assert encode_bcl_bytes(bases, quals).tobytes() == b"".join(
+        encode_cluster_byte(chr(b), q) for b, q in zip(bases, quals)
+    )
+
+
+def test_encode_locs():
+    assert encode_locs([("1", "1"), (2, 3)]) == encode_loc_bytes(
+        1, 1
+    ) + encode_loc_bytes(2, 3)
+
+
+def test_write_cycle_column(tmp_path):
+    binaryout = tmp_path / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl"
+    statsout = tmp_path / "Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.stats"
+    write_cycle_column(0, 1, tmp_path, np.array([5], dtype=np.uint8))
+    assert binaryout.read_bytes() == expected_bcl
+    assert statsout.read_bytes() == expected_stats